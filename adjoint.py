@@ -0,0 +1,410 @@
+"""Discrete adjoint of a time stepping model built from dolfin solves.
+
+The model's time step is written in terms of a few operations that a `Tape` records
+while it is recording (and only executes otherwise):
+
+- `Tape.solve(F, u, ...)`: u is the solution of the residual form F(u; ...) = 0
+- `Tape.assign(assigner, targets, sources, reverse)`: a FunctionAssigner copy
+- `Tape.copy(target, source)`: target.assign(source)
+- `Tape.external(target, sources, evaluate, adjoint)`: target is computed from the sources
+  outside the forms (e.g. the orographic SMB by numpy), with an adjoint supplied by the
+  caller
+
+Misfits depend on the model Functions only. Any other update of a Function (e.g. the
+clipped grounding line indicator) is treated as independent of the controls. The adjoint of a step runs the recorded operations in
+reverse order. Each solve is differentiated with respect to every Function and Constant
+in its form, at the values they had when it ran. At bound-constrained dofs (vinewtonrsls
+active set, Dirichlet conditions), the solve rows are constraints that do not depend on
+the controls.
+
+`DiscreteAdjoint` stores only a limited number of states ("snapshots") and recomputes
+the others from the closest one, using binary splitting of the time interval as in
+revolve. With s snapshots and N steps, it needs O(N log N) forward steps for memory
+O(s) in the number of states. The gradient of a misfit therefore costs a few forward
+runs, whatever the number of controls.
+
+Gradients with respect to Functions are returned as dual vectors, i.e. the derivative
+with respect to each degree of freedom.
+
+Both flowline models use it for --misfit. In the glacier model, the orographic SMB is an
+external operation with the adjoint of orographic_smb (checked by the Taylor test of
+ltop_operator.py).
+"""
+
+import numpy as np
+import ufl
+from dolfin import (Constant, Function, PETScLUSolver, adjoint, as_backend_type, assemble,
+                    derivative, dx)
+
+
+class Tape(object):
+    "Records the operations of one time step (when `recording` is set)."
+
+    def __init__(self):
+        self.recording = False
+        self.operations = []
+        self.forms = {}
+
+    def start(self):
+        self.recording = True
+        self.operations = []
+
+    def stop(self):
+        self.recording = False
+        operations, self.operations = self.operations, []
+        return operations
+
+    def solve(self, F, u, solve, active=None):
+        """Run `solve()`, which solves F(u) = 0 for u, and record it.
+
+        `active` : callable returning the dofs of u that are fixed by bounds or boundary
+                   conditions after the solve
+        """
+        solve()
+        if self.recording:
+            self.operations.append(("solve", F, u, active() if active is not None else [],
+                                    snapshot(F, u)))
+
+    def assign(self, assigner, targets, sources, reverse):
+        """targets <- sources by `assigner`. `reverse` is the FunctionAssigner in the
+        opposite direction, which is also the transpose of the copy."""
+        assigner.assign(targets, sources)
+        if self.recording:
+            self.operations.append(("assign", targets, sources, reverse))
+
+    def copy(self, target, source):
+        "target <- source"
+        target.assign(source)
+        if self.recording:
+            self.operations.append(("copy", target, source))
+
+    def external(self, target, sources, evaluate, adjoint):
+        """Run `evaluate()`, which sets target from the sources, and record it.
+
+        `adjoint` : callable returning, for the current values, a function that maps the
+                    dual vector of target (local values) to a list with the dual vector
+                    of every source (local values) and a dict of derivatives with respect
+                    to scalar controls (used like Constants)
+        """
+        evaluate()
+        if self.recording:
+            self.operations.append(("external", target, sources, adjoint()))
+
+    def derivative(self, F, x):
+        """Cached derivative of the form F with respect to x (for a Constant, the
+        derivative in the direction 1, a form of the same rank as F)."""
+        key = (id(F), id(x))
+        if key not in self.forms:
+            if isinstance(x, Constant):
+                self.forms[key] = derivative(F, x, Constant(1.0))
+            else:
+                self.forms[key] = derivative(F, x)
+        return self.forms[key]
+
+
+def functions(F):
+    "The Functions a form depends on."
+    return [c for c in F.coefficients() if isinstance(c, Function)]
+
+
+def constants(F):
+    "The Constants a form depends on."
+    return [c for c in F.coefficients() if isinstance(c, Constant)]
+
+
+def snapshot(F, u):
+    "Values of all Functions of F (including the solution u) and Constants."
+    values = {f: f.vector().copy() for f in functions(F)}
+    values[u] = u.vector().copy()
+    values.update({c: float(c) for c in constants(F)})
+    return values
+
+
+def restore(values):
+    for c, value in values.items():
+        if isinstance(c, Function):
+            c.vector()[:] = value
+        else:
+            c.assign(value)
+
+
+class Adjoints(object):
+    "Adjoint (dual) vectors of Functions and the accumulated gradients of Constants."
+
+    def __init__(self):
+        self.vectors = {}
+        self.scalars = {}
+
+    def get(self, f):
+        if f not in self.vectors:
+            self.vectors[f] = f.vector().copy()
+            self.vectors[f].zero()
+        return self.vectors[f]
+
+    def add(self, f, v, a=1.0):
+        self.get(f).axpy(a, v)
+
+    def pop(self, f):
+        v = self.get(f).copy()
+        self.vectors[f].zero()
+        return v
+
+
+def adjoint_solve(tape, adj, F, u, active, values):
+    """Adjoint of a recorded solve: J^T lam = adj[u], then adj[x] -= (dF/dx)^T lam for every
+    input x of F."""
+    restore(values)
+
+    rhs = adj.pop(u)
+    J = as_backend_type(assemble(tape.derivative(F, u)))
+    active = np.asarray(active, dtype=np.intc)
+    if len(active):
+        # rows of constrained dofs become u_a = fixed
+        J.ident(active)
+        rhs[active] = 0.0
+    J.mat().transpose()
+
+    lam = Function(u.function_space())
+    PETScLUSolver(J).solve(lam.vector(), rhs)
+    if len(active):
+        lam.vector()[active] = 0.0
+
+    for x in functions(F):
+        if x is u:
+            continue
+        dFdx = tape.derivative(F, x)
+        adj.add(x, assemble(ufl.action(adjoint(dFdx), lam)), -1.0)
+
+    for c in constants(F):
+        dFdc = assemble(tape.derivative(F, c))
+        adj.scalars[c] = adj.scalars.get(c, 0.0) - dFdc.inner(lam.vector())
+
+
+def adjoint_operations(tape, adj, operations):
+    "Run the adjoint of the recorded operations of one step."
+    for op in reversed(operations):
+        if op[0] == "solve":
+            adjoint_solve(tape, adj, *op[1:])
+        elif op[0] == "assign":
+            targets, sources, reverse = op[1:]
+            targets = targets if isinstance(targets, (list, tuple)) else [targets]
+            sources = sources if isinstance(sources, (list, tuple)) else [sources]
+            # the transpose of the copy moves the target adjoints back to the sources
+            dual_t = [Function(t.function_space()) for t in targets]
+            for d, t in zip(dual_t, targets):
+                d.vector()[:] = adj.pop(t)
+            dual_s = [Function(s.function_space()) for s in sources]
+            reverse.assign(dual_s if len(dual_s) > 1 else dual_s[0],
+                           dual_t if len(dual_t) > 1 else dual_t[0])
+            for d, s in zip(dual_s, sources):
+                adj.add(s, d.vector())
+        elif op[0] == "copy":
+            target, source = op[1:]
+            adj.add(source, adj.pop(target))
+        elif op[0] == "external":
+            target, sources, adjoint_map = op[1:]
+            duals, derivatives = adjoint_map(adj.pop(target).get_local())
+            for s, d in zip(sources, duals):
+                v = s.vector().copy()
+                v.set_local(d)
+                v.apply("insert")
+                adj.add(s, v)
+            for c, value in derivatives.items():
+                adj.scalars[c] = adj.scalars.get(c, 0.0) + value
+
+
+class Misfit(object):
+    """A misfit that is a sum over time steps of f(assemble(form)) for a scalar form of
+    the model Functions, e.g. 0.5 * (H - H_obs)**2 * dx at the final step, or the
+    volume H * dx compared to an observed time series."""
+
+    def __init__(self, form, steps=None, observations=None):
+        """`form` : scalar form
+        `steps` : step indices (1 = after the first step) where the misfit is evaluated,
+                  None for every step
+        `observations` : if given, the misfit at the k-th evaluation is
+                         0.5 * (assemble(form) - observations[k])**2, otherwise
+                         assemble(form)
+        """
+        self.form = form
+        self.steps = steps
+        self.observations = observations
+        self.evaluations = {}
+
+    def active(self, n):
+        return self.steps is None or n in self.steps
+
+    def index(self, n):
+        return n - 1 if self.steps is None else sorted(self.steps).index(n)
+
+    def value(self, n):
+        v = assemble(self.form)
+        if self.observations is None:
+            return v
+        return 0.5 * (v - self.observations[self.index(n)]) ** 2
+
+    def add_gradient(self, n, adj):
+        "Add d(misfit at step n)/d(Functions of the form) to the adjoints."
+        scale = 1.0
+        if self.observations is not None:
+            scale = assemble(self.form) - self.observations[self.index(n)]
+        for f in functions(self.form):
+            adj.add(f, assemble(derivative(self.form, f)), scale)
+
+
+def final_thickness_misfit(H, H_obs, n_steps):
+    "0.5 * ||H - H_obs||^2 after the last step."
+    return Misfit(0.5 * (H - H_obs) ** 2 * dx, steps=[n_steps])
+
+
+def volume_misfit(H, volumes, width=1.0):
+    "0.5 * sum_n (V_n - volumes[n])^2 over all steps, V = integral of H * width."
+    return Misfit(H * width * dx, observations=volumes)
+
+
+def grounding_line_misfit(grounded, x, start, position, n_steps):
+    """0.5 * (x_gl - position)^2 after the last step, for a grounding line downstream of
+    `start`: x_gl = start + the integral of the (smooth) grounded indicator over x > start.
+
+    `grounded` : UFL expression of a grounded indicator that is differentiable in the model
+                 Functions (between 0 and 1)
+    `x` : the x coordinate (UFL)
+    """
+    form = ufl.conditional(ufl.gt(x, start), grounded, 0.0) * dx
+    return Misfit(form, steps=[n_steps], observations=[position - start])
+
+
+class DiscreteAdjoint(object):
+    """Gradient of a misfit over a time loop by the discrete adjoint.
+
+    `step(n)` : advances the model by step n (n = 1 ... n_steps) using the tape methods
+    `state` : the Functions that carry the model state from one step to the next
+    `tape` : the Tape used by `step`
+    `snapshots` : number of states kept in memory during the adjoint sweep
+    """
+
+    def __init__(self, step, state, tape, n_steps, misfit, snapshots=10):
+        self.step = step
+        self.state = state
+        self.tape = tape
+        self.n_steps = n_steps
+        self.misfit = misfit
+        self.snapshots = max(snapshots, 1)
+        self.forward_steps = 0
+
+    def save(self):
+        return [f.vector().copy() for f in self.state]
+
+    def load(self, saved):
+        for f, v in zip(self.state, saved):
+            f.vector()[:] = v
+
+    def advance(self, saved, n0, n1):
+        "State after step n1, starting from the state `saved` after step n0."
+        self.load(saved)
+        for n in range(n0 + 1, n1 + 1):
+            self.step(n)
+            self.forward_steps += 1
+        return self.save()
+
+    def functional(self):
+        "Run the model from the current state and return the misfit."
+        initial = self.save()
+        J = 0.0
+        for n in range(1, self.n_steps + 1):
+            self.step(n)
+            self.forward_steps += 1
+            if self.misfit.active(n):
+                J += self.misfit.value(n)
+        self.load(initial)
+        return J
+
+    def reverse(self, adj, saved, n0, n1, snapshots):
+        "Adjoint of steps n0 + 1 ... n1, given the state after step n0."
+        if n1 - n0 == 1:
+            self.load(saved)
+            self.tape.start()
+            self.step(n1)
+            self.forward_steps += 1
+            operations = self.tape.stop()
+            if self.misfit.active(n1):
+                self.misfit.add_gradient(n1, adj)
+            adjoint_operations(self.tape, adj, operations)
+            return
+
+        if snapshots == 0:
+            # no memory left: recompute from n0 for every step
+            for n in range(n1, n0, -1):
+                self.reverse(adj, self.advance(saved, n0, n - 1), n - 1, n, 0)
+            return
+
+        m = (n0 + n1) // 2
+        saved_m = self.advance(saved, n0, m)
+        self.reverse(adj, saved_m, m, n1, snapshots - 1)
+        del saved_m
+        self.reverse(adj, saved, n0, m, snapshots)
+
+    def gradient(self, controls):
+        """The misfit and its gradient with respect to the controls (Functions or
+        Constants) at the current initial state.
+
+        Returns J and a list with a dual vector (Functions) or a float (Constants) per
+        control.
+        """
+        initial = self.save()
+        J = self.functional()
+
+        adj = Adjoints()
+        self.reverse(adj, initial, 0, self.n_steps, self.snapshots - 1)
+        self.load(initial)
+
+        grads = []
+        for c in controls:
+            if isinstance(c, Function):
+                grads.append(adj.get(c).copy())
+            else:
+                grads.append(adj.scalars.get(c, 0.0))
+        return J, grads
+
+
+def perturb(controls, directions, h):
+    "Add h * direction to every control; returns the saved values."
+    saved = []
+    for c, d in zip(controls, directions):
+        if isinstance(c, Function):
+            saved.append(c.vector().copy())
+            c.vector().axpy(h, d)
+        else:
+            saved.append(float(c))
+            c.assign(float(c) + h * d)
+    return saved
+
+
+def reset(controls, saved):
+    for c, value in zip(controls, saved):
+        if isinstance(c, Function):
+            c.vector()[:] = value
+        else:
+            c.assign(value)
+
+
+def taylor_test(model, controls, directions, h=1e-2, levels=4):
+    """Check the gradient by the Taylor remainder |J(m + h dm) - J(m) - h dJ.dm|, which
+    has to decrease at second order in h.
+
+    Returns the remainders and their observed orders.
+    """
+    J0, grads = model.gradient(controls)
+    dJdm = sum(g.inner(d) if not isinstance(g, float) else g * d
+               for g, d in zip(grads, directions))
+
+    remainders = []
+    for k in range(levels):
+        hk = h / 2 ** k
+        saved = perturb(controls, directions, hk)
+        remainders.append(abs(model.functional() - J0 - hk * dJdm))
+        reset(controls, saved)
+
+    orders = [np.log(remainders[k - 1] / remainders[k]) / np.log(2)
+              for k in range(1, levels)]
+    return remainders, orders
@@ -0,0 +1,193 @@
+"""Time-dependent climate forcing read from memory-mapped NumPy or HDF5 files.
+
+A forcing is a time series of records, either scalars (e.g. an ELA offset) or profiles
+along the flowline (e.g. an SMB anomaly). Records are read lazily, so only the few around
+the model time are ever in memory:
+
+- NumPy: `<name>.npy` with the records (time x points for profiles), `<name>.time.npy`
+  with the record times [year] and, for profiles, `<name>.x.npy` with their coordinates
+  [m]. The records are memory-mapped.
+- HDF5: a file with the datasets `time`, `x` (profiles only) and the records, named
+  after the forcing kind unless given as FILE:DATASET. Chunk along time for fast reads.
+
+Between records the forcing is interpolated linearly in time. Before the first and after
+the last record it is held constant. Profiles are interpolated linearly in space onto
+the degrees of freedom of the Function they update.
+
+Forcings update the Constants and Functions the model forms already use, in place, so a
+change of forcing never recompiles a form.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ForcingStream(object):
+    """Records of one forcing variable and their times.
+
+    `lookahead` : number of records beyond the bracketing pair that are read ahead and
+                  kept, so that marching forward in time reads each record once
+    """
+
+    def __init__(self, filename, dataset=None, lookahead=2):
+        self.filename = filename
+        self.lookahead = lookahead
+        self.cache = OrderedDict()
+        self.reads = 0
+        self.file = None
+
+        stem, ext = os.path.splitext(filename)
+        if ext == ".npy":
+            self.records = np.load(filename, mmap_mode="r")
+            self.times = np.load(stem + ".time.npy")
+            self.x = np.load(stem + ".x.npy") if self.records.ndim > 1 else None
+        elif ext in (".h5", ".hdf5", ".nc"):
+            import h5py
+
+            self.file = h5py.File(filename, "r")
+            self.records = self.file[dataset or os.path.basename(stem)]
+            self.times = self.file["time"][:]
+            self.x = self.file["x"][:] if self.records.ndim > 1 else None
+        else:
+            raise ValueError("unknown forcing file type '{}'".format(filename))
+
+        self.times = np.asarray(self.times, dtype=float).ravel()
+        if len(self.times) != self.records.shape[0]:
+            raise ValueError("{}: {} times for {} records".format(
+                filename, len(self.times), self.records.shape[0]))
+        if np.any(np.diff(self.times) <= 0):
+            raise ValueError("{}: times have to increase".format(filename))
+
+    def record(self, k):
+        "Record k, from the cache if possible."
+        if k not in self.cache:
+            # read the bracketing pair and the look-ahead in one slice
+            last = min(k + 2 + self.lookahead, len(self.times))
+            block = np.array(self.records[k:last], dtype=float)
+            self.reads += 1
+            for j, values in enumerate(block):
+                self.cache[k + j] = values
+            # keep the records of the last two reads only
+            while len(self.cache) > 2 * (self.lookahead + 2):
+                self.cache.popitem(last=False)
+        return self.cache[k]
+
+    def __call__(self, t):
+        "The forcing at time t (a float or an array over `x`)."
+        if t <= self.times[0]:
+            return self.record(0)
+        if t >= self.times[-1]:
+            return self.record(len(self.times) - 1)
+
+        k = int(np.searchsorted(self.times, t, side="right")) - 1
+        w = (t - self.times[k]) / (self.times[k + 1] - self.times[k])
+        return (1 - w) * self.record(k) + w * self.record(k + 1)
+
+    def close(self):
+        "Close the file (the cached records stay usable)."
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.records = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ScalarForcing(object):
+    """Sets a Constant (or calls a function) to base + scale * forcing(t).
+
+    `target` : dolfin Constant, or a callable taking the value
+    """
+
+    def __init__(self, stream, target, base=0.0, scale=1.0):
+        self.stream = stream
+        self.target = target
+        self.base = base
+        self.scale = scale
+
+    def update(self, t):
+        value = self.base + self.scale * float(self.stream(t))
+        if callable(self.target) and not hasattr(self.target, "assign"):
+            self.target(value)
+        else:
+            self.target.assign(value)
+        return value
+
+
+class FieldForcing(object):
+    """Sets the degrees of freedom of a scalar Function to scale * forcing(t), interpolated
+    from the forcing coordinates to the degree of freedom coordinates."""
+
+    def __init__(self, stream, function, scale=1.0):
+        if stream.x is None:
+            raise ValueError("{} has no coordinates for a field".format(stream.filename))
+        self.stream = stream
+        self.function = function
+        self.scale = scale
+
+        # piecewise linear interpolation weights, computed once
+        x = function.function_space().tabulate_dof_coordinates().reshape((-1,))
+        xs = np.asarray(stream.x, dtype=float)
+        k = np.clip(np.searchsorted(xs, x, side="right") - 1, 0, len(xs) - 2)
+        w = np.clip((x - xs[k]) / (xs[k + 1] - xs[k]), 0.0, 1.0)
+        self.index, self.weight = k, w
+
+    def update(self, t):
+        record = self.stream(t)
+        values = (1 - self.weight) * record[self.index] + self.weight * record[self.index + 1]
+        self.function.vector().set_local(self.scale * values)
+        self.function.vector().apply("insert")
+        return values
+
+
+class Forcing(object):
+    "A set of forcings updated together."
+
+    def __init__(self):
+        self.forcings = OrderedDict()
+
+    def add(self, name, forcing):
+        self.forcings[name] = forcing
+
+    def update(self, t):
+        "Update every target to time t; returns the scalar values by name."
+        values = {}
+        for name, forcing in self.forcings.items():
+            value = forcing.update(t)
+            if np.ndim(value) == 0:
+                values[name] = value
+        return values
+
+    def close(self):
+        "Close the files of the forcings."
+        for forcing in self.forcings.values():
+            forcing.stream.close()
+
+    def __bool__(self):
+        return bool(self.forcings)
+
+
+def parse_forcing(items, kinds):
+    """KIND=FILE[:DATASET] strings to a dict kind -> ForcingStream.
+
+    `kinds` : the forcing kinds the model accepts
+    """
+    streams = {}
+    for item in items:
+        if "=" not in item:
+            raise ValueError("forcing expects KIND=FILE[:DATASET], got '{}'".format(item))
+        kind, filename = item.split("=", 1)
+        if kind not in kinds:
+            raise ValueError("unknown forcing '{}' (choose from {})".format(
+                kind, ", ".join(kinds)))
+        dataset = kind
+        if ":" in filename:
+            filename, dataset = filename.rsplit(":", 1)
+        streams[kind] = ForcingStream(filename, dataset)
+    return streams
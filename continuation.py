@@ -0,0 +1,187 @@
+"""Natural-parameter continuation of steady states.
+
+Traces the steady states of a model while a parameter moves from `start` to `end`
+(and back, for hysteresis loops). At each new parameter value, the state is predicted by
+secant extrapolation from the last two steady states and corrected by Newton's method
+on the steady system. The parameter step grows after easy corrections and is halved
+after failed ones.
+
+Folds (saddle-node points) show up in two ways:
+
+- The determinant of the steady-state Jacobian changes sign between two accepted
+  states. Every such change is recorded, and the stability label flips, since one
+  eigenvalue has crossed zero.
+- The corrector fails, or moves the state further than `max_correction` from the
+  prediction (Newton jumped onto another branch), even with the smallest step: the
+  branch has turned back. The
+  model then relaxes transiently at the new parameter value onto the branch it jumps
+  to. That branch is stable, and continuation resumes on it. Sweeping forward and
+  backward therefore traces a hysteresis loop.
+
+If no steady state is found at all (at the start, or after the relaxation past a fold),
+the sweep ends with a "failed" point, whose diagnostics are NaN.
+
+The model is given as an object with the methods
+
+    set(p)       set the parameter
+    solve()      Newton solve of the steady system from the current state; returns the
+                 number of iterations, raises RuntimeError if it does not converge
+    save()       copy of the current state
+    load(state)  restore a state
+    combine(a, b, w)  state a + w * (a - b) (secant predictor)
+    distance(a, b)  relative difference of two states
+    sign()       sign of the determinant of the steady-state Jacobian (+1 or -1)
+    relax()      run the transient model at the current parameter towards a steady state
+    diagnostics()  dict of scalars describing the current state (e.g. volume)
+"""
+
+import numpy as np
+from scipy.sparse.linalg import splu
+
+
+def permutation_sign(perm):
+    "Sign of a permutation given as an index array."
+    perm = np.asarray(perm)
+    seen = np.zeros(len(perm), dtype=bool)
+    sign = 1
+    for i in range(len(perm)):
+        if not seen[i]:
+            # a cycle of length k has sign (-1)^(k-1)
+            j, length = i, 0
+            while not seen[j]:
+                seen[j] = True
+                j = perm[j]
+                length += 1
+            if length % 2 == 0:
+                sign = -sign
+    return sign
+
+
+def determinant_sign(A):
+    """Sign of the determinant of a sparse square matrix from its LU factorization
+    (L has a unit diagonal; the row and column permutations contribute their signs)."""
+    lu = splu(A.tocsc())
+    diagonal = lu.U.diagonal()
+    if np.any(diagonal == 0):
+        return 0
+    sign = int(np.prod(np.sign(diagonal)))
+    return sign * permutation_sign(lu.perm_r) * permutation_sign(lu.perm_c)
+
+
+class Point(object):
+    def __init__(self, p, diagnostics, stable, sign, iterations, event=""):
+        self.p = p
+        self.diagnostics = diagnostics
+        self.stable = stable
+        self.sign = sign
+        self.iterations = iterations
+        self.event = event
+
+
+def sweep(model, start, end, step, min_step=None, max_step=None, grow=1.5,
+          easy_iterations=4, max_correction=0.1, report=print, points=None):
+    """Continue from `start` to `end`, starting from the model's current state. Returns
+    the list of Points.
+
+    `points` : list the Points are appended to (and returned), so that the points found
+               so far survive an unexpected error
+    """
+    direction = np.sign(end - start)
+    min_step = step / 64 if min_step is None else min_step
+    max_step = 8 * step if max_step is None else max_step
+    points = [] if points is None else points
+
+    # Start on a stable steady state
+    model.set(start)
+    try:
+        model.relax()
+        iterations = model.solve()
+    except RuntimeError as e:
+        return failed(points, start, model.diagnostics(), e, report)
+    sign = model.sign()
+    stable = True
+    p = start
+    points.append(Point(p, model.diagnostics(), stable, sign, iterations, "start"))
+    report_point(points[-1], report)
+
+    current, previous, p_previous = model.save(), None, None
+    h = step
+    while direction * (end - p) > 1e-12 * max(abs(end), 1.0):
+        p_new = p + direction * min(h, abs(end - p))
+
+        # Secant predictor along the branch
+        if previous is not None:
+            predicted = model.combine(current, previous, (p_new - p) / (p - p_previous))
+        else:
+            predicted = current
+        model.load(predicted)
+        model.set(p_new)
+
+        event = ""
+        try:
+            iterations = model.solve()
+            if model.distance(model.save(), predicted) > max_correction:
+                raise RuntimeError("the corrector left the branch")
+        except RuntimeError:
+            model.load(current)
+            if h / 2 >= min_step:
+                h /= 2
+                continue
+            # The branch turned back: jump to the branch the transient model relaxes to
+            report("no steady state continues the branch beyond {:.6g}: fold, "
+                   "relaxing to another branch".format(p))
+            model.set(p_new)
+            try:
+                model.relax()
+                iterations = model.solve()
+            except RuntimeError as e:
+                return failed(points, p_new, points[-1].diagnostics, e, report)
+            stable = True
+            sign = model.sign()
+            previous = None
+            event = "fold"
+        else:
+            new_sign = model.sign()
+            if new_sign != sign:
+                # an eigenvalue crossed zero between p and p_new
+                stable = not stable
+                event = "sign change"
+                report("Jacobian determinant changes sign between {:.6g} and {:.6g}".format(
+                    p, p_new))
+            sign = new_sign
+            previous, p_previous = current, p
+            if iterations <= easy_iterations:
+                h = min(grow * h, max_step)
+
+        p = p_new
+        current = model.save()
+        points.append(Point(p, model.diagnostics(), stable, sign, iterations, event))
+        report_point(points[-1], report)
+
+    return points
+
+
+def failed(points, p, diagnostics, error, report):
+    "End a sweep with a failed point at p."
+    report("no steady state found at {:.6g} ({}): sweep ends".format(p, error))
+    points.append(Point(p, {k: np.nan for k in diagnostics}, False, 0, 0, "failed"))
+    return points
+
+
+def report_point(point, report):
+    report("p {:.6g}: {}, {}, {} Newton iterations{}".format(
+        point.p, ", ".join("{} {:.6g}".format(k, v) for k, v in point.diagnostics.items()),
+        "stable" if point.stable else "unstable", point.iterations,
+        " ({})".format(point.event) if point.event else ""))
+
+
+def write_diagram(filename, points, name="p"):
+    "Write the bifurcation diagram as a text table."
+    keys = list(points[0].diagnostics)
+    with open(filename, "w") as f:
+        f.write("# {} {} stable det_sign iterations event\n".format(name, " ".join(keys)))
+        for point in points:
+            f.write("{:.10g} {} {:d} {:d} {:d} {}\n".format(
+                point.p, " ".join("{:.10g}".format(point.diagnostics[k]) for k in keys),
+                int(point.stable), point.sign, point.iterations,
+                point.event.replace(" ", "_") or "-"))
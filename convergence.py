@@ -0,0 +1,261 @@
+"""Resolution study of the flowline models: cells x time step x vertical quadrature x
+velocity element degree.
+
+Every combination of --nx, --dt, --quad and --degree runs as its own process (concurrently, see
+--processes) and writes a summary JSON file (see --summary of the models). Errors are
+taken against the finest run (most cells, smallest time step, most quadrature points,
+highest degree):
+
+- scalars: final volume, grounding line position (glacier model only), maximum thickness
+  and maximum erosion rate
+- surface: RMS difference of the final surface profile, interpolated linearly onto the
+  mesh of the finest run (nodes that are ice-free in either run are ignored)
+
+Observed orders are estimated along each axis from the runs that differ from the finest
+only in that parameter. The cost-versus-accuracy table lists all runs by wall time (or by
+number of degrees of freedom, --cost dofs, e.g. to compare CG2 with CG1 velocities) and
+marks the ones no cheaper run beats in accuracy. With --tol, it also names the cheapest
+run within the tolerance.
+
+For the sediment model the time step axis is --dt_max, since its time step is adaptive.
+
+With --geoms the study runs once per bed geometry, each in its own subdirectory of
+--work_dir. The CG2/CG3 against CG1 comparison is the second command below. It has not
+been run yet (it needs dolfin), so no measured table exists and the element degree
+study is not finished. Its results belong here once it has been run.
+
+    python convergence.py --nx 125 250 500 1000 --dt 2 1 0.5 --quad 2 4 6 \\
+        --args "--geom sym -e 500" --processes 8
+    python convergence.py --nx 63 125 250 500 --degree 1 2 3 --cost dofs \\
+        --geoms sym asym 1sided
+"""
+
+import itertools
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+models = dict(
+    glacier=dict(
+        script=os.path.join(here, "glacier_flowline_model.py"),
+        dt="--dt",
+        geom="--geom",
+        scalars=["volume", "gl_position", "max_thickness", "erosion_rate"],
+    ),
+    sediment=dict(
+        script=os.path.join(here, "sediment_higherorder_flowline.py"),
+        dt="--dt_max",
+        geom="--geometry",
+        scalars=["volume", "sediment_volume", "max_thickness", "erosion_rate"],
+    ),
+)
+
+
+axes = ("nx", "dt", "quad", "degree")
+
+
+def run_name(nx, dt, quad, degree):
+    return "nx{}_dt{:g}_q{}_p{}".format(nx, dt, quad, degree)
+
+
+def run_model(model, nx, dt, quad, degree, args, work_dir):
+    """Run one resolution and return its summary (with the wall time as "cost"), or None
+    if the run failed."""
+    # paths relative to work_dir, since the glacier model prefixes its restart file name
+    name = run_name(nx, dt, quad, degree)
+    cmd = [sys.executable, models[model]["script"], "--nx", str(nx), models[model]["dt"],
+           repr(float(dt)), "--quad_order", str(quad), "--degree", str(degree), "--summary",
+           name + ".json"]
+    if model == "glacier":
+        cmd += ["--batch", "-o", name]
+    else:
+        cmd += ["--headless", "--checkpoint_interval", "0", "--checkpoint", name + ".h5",
+                "--diag_file", name + ".txt"]
+    cmd += args
+
+    start = time.time()
+    # no display needed
+    env = dict(os.environ, MPLBACKEND="Agg")
+    with open(os.path.join(work_dir, name + ".log"), "w") as log:
+        result = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=work_dir,
+                                env=env)
+    elapsed = time.time() - start
+
+    if result.returncode != 0:
+        print("{} failed, see {}.log".format(name, os.path.join(work_dir, name)), flush=True)
+        return None
+
+    with open(os.path.join(work_dir, name + ".json")) as f:
+        summary = json.load(f)
+    summary["cost"] = elapsed
+    print("{} done after {:.1f} s".format(name, elapsed), flush=True)
+    return summary
+
+
+def surface_error(run, reference):
+    "RMS difference of the surface profiles on the reference mesh."
+    x, surface = np.array(run["x"]), np.array(run["surface"], dtype=float)
+    order = np.argsort(x)
+    x_ref = np.array(reference["x"])
+    s_ref = np.array(reference["surface"], dtype=float)
+    s = np.interp(x_ref, x[order], surface[order])
+    valid = np.isfinite(s) & np.isfinite(s_ref)
+    return float(np.sqrt(np.mean((s[valid] - s_ref[valid]) ** 2))) if valid.any() else np.nan
+
+
+def errors(runs, reference, scalars):
+    "Errors of every run against the reference: name -> {quantity: error}."
+    result = {}
+    for key, run in runs.items():
+        e = {q: abs(run[q] - reference[q]) for q in scalars if q in run and q in reference}
+        e["surface"] = surface_error(run, reference)
+        result[key] = e
+    return result
+
+
+def observed_orders(errs, finest, axis):
+    """Orders along one axis (see `axes`) from the runs that differ from the
+    finest run only in that parameter. Returns a list of (coarse, fine, {quantity:
+    order}) for consecutive pairs."""
+    line = sorted((key for key in errs
+                   if all(key[i] == finest[i] for i in range(len(axes)) if i != axis)
+                   and key != finest),
+                  key=lambda key: resolution(key, axis), reverse=True)
+    result = []
+    for coarse, fine in zip(line[:-1], line[1:]):
+        ratio = resolution(coarse, axis) / resolution(fine, axis)
+        orders = {}
+        for q in errs[coarse]:
+            a, b = errs[coarse][q], errs[fine][q]
+            orders[q] = np.log(a / b) / np.log(ratio) if a > 0 and b > 0 else np.nan
+        result.append((coarse, fine, orders))
+    return result
+
+
+def resolution(key, axis):
+    "Grid spacing like measure along an axis: larger is coarser."
+    nx, dt, quad, degree = key
+    return (1.0 / nx, dt, 1.0 / quad, 1.0 / degree)[axis]
+
+
+def cost_table(runs, errs, quantity, tol=None, reference=None, cost="cost"):
+    """Rows (key, cost, error, pareto) sorted by cost ("cost": wall time, or "dofs"), and
+    the cheapest run with a relative error of `quantity` below `tol`."""
+    rows = []
+    best = np.inf
+    for key in sorted(errs, key=lambda key: runs[key][cost]):
+        error = errs[key].get(quantity, np.nan)
+        pareto = error < best
+        best = min(best, error)
+        rows.append((key, runs[key][cost], error, pareto))
+
+    cheapest = None
+    if tol is not None:
+        scale = abs(reference.get(quantity, 1.0)) if quantity != "surface" else 1.0
+        for key, cost, error, pareto in rows:
+            if error <= tol * max(scale, 1e-300):
+                cheapest = key
+                break
+    return rows, cheapest
+
+
+def study(options, args, work_dir):
+    """Run the resolution study of `options` in `work_dir` and print its tables. Returns
+    False if the finest run (the reference) failed."""
+    os.makedirs(work_dir, exist_ok=True)
+    keys = list(itertools.product(sorted(set(options.nx)), sorted(set(options.dt)),
+                                  sorted(set(options.quad)), sorted(set(options.degree))))
+
+    with ThreadPoolExecutor(options.processes) as pool:
+        futures = {key: pool.submit(run_model, options.model, *key, args, work_dir)
+                   for key in keys}
+        runs = {key: f.result() for key, f in futures.items()}
+    runs = {key: run for key, run in runs.items() if run is not None}
+
+    finest = (max(options.nx), min(options.dt), max(options.quad), max(options.degree))
+    if finest not in runs:
+        print("the finest run failed, no reference")
+        return False
+    reference = runs[finest]
+    scalars = models[options.model]["scalars"]
+    errs = errors(runs, reference, scalars)
+    quantities = [q for q in scalars if q in reference] + ["surface"]
+
+    with open(os.path.join(work_dir, "errors.json"), "w") as f:
+        json.dump([dict(zip(axes, key), cost=runs[key]["cost"], dofs=runs[key].get("dofs"),
+                        errors=errs[key]) for key in errs], f, indent=1)
+
+    print("\nErrors against {}".format(run_name(*finest)))
+    print("{:>25s} {:>9s} {:>8s} ".format("run", "cost [s]", "dofs")
+          + " ".join("{:>13s}".format(q) for q in quantities))
+    for key in sorted(errs):
+        print("{:>25s} {:9.1f} {:8d} ".format(run_name(*key), runs[key]["cost"],
+                                              runs[key].get("dofs", 0))
+              + " ".join("{:13.3e}".format(errs[key][q]) for q in quantities))
+
+    for axis, name in enumerate(axes):
+        for coarse, fine, orders in observed_orders(errs, finest, axis):
+            print("order in {} from {} to {}: ".format(name, run_name(*coarse),
+                                                       run_name(*fine))
+                  + ", ".join("{} {:.2f}".format(q, orders[q]) for q in quantities))
+
+    cost = "cost" if options.cost == "time" else "dofs"
+    rows, cheapest = cost_table(runs, errs, options.quantity, options.tol, reference, cost)
+    print("\n{} versus accuracy ({}), * = no cheaper run is as accurate".format(
+        "Wall time" if cost == "cost" else "Degrees of freedom", options.quantity))
+    for key, c, error, pareto in rows:
+        print("{:>25s} {:9.1f} {:13.3e} {}".format(run_name(*key), c, error,
+                                                  "*" if pareto else ""))
+    if options.tol is not None:
+        print("cheapest run within tolerance {:g}: {}".format(
+            options.tol, run_name(*cheapest) if cheapest is not None else "none"))
+    return True
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Resolution study of the flowline models.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--model", choices=list(models), default="glacier")
+    parser.add_argument("--nx", type=int, nargs="+", default=[125, 250, 500])
+    parser.add_argument("--dt", type=float, nargs="+", default=[1.0],
+                        help="Time steps (--dt_max for the sediment model)")
+    parser.add_argument("--quad", type=int, nargs="+", default=[4],
+                        help="Vertical quadrature orders")
+    parser.add_argument("--degree", type=int, nargs="+", default=[1],
+                        help="Velocity element degrees")
+    parser.add_argument("--args", default="", help="Further model arguments for every run")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="Number of runs at a time")
+    parser.add_argument("--work_dir", default="convergence")
+    parser.add_argument("--quantity", default="volume",
+                        help="Quantity of the cost table: a scalar or 'surface'")
+    parser.add_argument("--cost", choices=["time", "dofs"], default="time",
+                        help="Cost measure of the cost table")
+    parser.add_argument("--tol", type=float, default=None,
+                        help="Relative error (absolute [m] for 'surface') the cheapest "
+                        "run has to meet")
+    parser.add_argument("--geoms", nargs="+", choices=["sym", "asym", "1sided"],
+                        default=None, help="Run the study once per bed geometry, in "
+                        "<work_dir>/<geometry>")
+    options = parser.parse_args()
+
+    args = shlex.split(options.args)
+    if options.geoms is None:
+        complete = study(options, args, options.work_dir)
+    else:
+        complete = True
+        for geom in options.geoms:
+            print("\nGeometry {}".format(geom))
+            complete &= study(options, args + [models[options.model]["geom"], geom],
+                              os.path.join(options.work_dir, geom))
+    if not complete:
+        sys.exit(1)
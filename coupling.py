@@ -0,0 +1,97 @@
+"""Acceleration of fixed-point iterations between coupled subsystems.
+
+A partitioned (split) time step defines a fixed-point map x -> G(x) on the interface
+field x, e.g. the ice state seen by the water flux and sediment solves. The classes below
+take the current iterate x and G(x), both as numpy arrays of local degree of freedom
+values, and return the next iterate. Inner products are summed over `comm` (an mpi4py
+communicator) when one is given, so the vectors can be distributed.
+"""
+
+import numpy as np
+
+
+class Relaxation(object):
+    "Constant under-relaxation, x <- x + omega (G(x) - x)."
+
+    def __init__(self, omega=1.0, comm=None):
+        self.omega = omega
+        self.comm = comm
+
+    def dot(self, a, b):
+        d = np.dot(a, b)
+        return d if self.comm is None else self.comm.allreduce(d)
+
+    def reset(self):
+        "Forget the history (call at the start of every time step)."
+        pass
+
+    def update(self, x, gx):
+        return x + self.omega * (gx - x)
+
+
+class Aitken(Relaxation):
+    """Aitken's dynamic relaxation (Irons and Tuck): the relaxation factor is updated from
+    the change of the residual between successive iterations."""
+
+    def reset(self):
+        self.r_old = None
+        self.omega_k = self.omega
+
+    def update(self, x, gx):
+        r = gx - x
+        if self.r_old is not None:
+            dr = r - self.r_old
+            dr2 = self.dot(dr, dr)
+            if dr2 > 0:
+                self.omega_k = -self.omega_k * self.dot(self.r_old, dr) / dr2
+        self.r_old = r
+        return x + self.omega_k * r
+
+
+class Anderson(Relaxation):
+    """Anderson acceleration with a history of `depth` residuals: the next iterate mixes
+    the previous G(x) so that the linearized residual is minimized in the least squares
+    sense."""
+
+    def __init__(self, depth=5, omega=1.0, comm=None):
+        super(Anderson, self).__init__(omega, comm)
+        self.depth = depth
+
+    def reset(self):
+        self.residuals = []
+        self.values = []
+
+    def update(self, x, gx):
+        r = gx - x
+        self.residuals.append(r)
+        self.values.append(gx)
+        if len(self.residuals) > self.depth + 1:
+            self.residuals.pop(0)
+            self.values.pop(0)
+
+        if len(self.residuals) == 1:
+            return x + self.omega * r
+
+        dR = np.array([b - a for a, b in zip(self.residuals[:-1], self.residuals[1:])]).T
+        dG = np.array([b - a for a, b in zip(self.values[:-1], self.values[1:])]).T
+
+        # normal equations, summed over all processes
+        A = dR.T @ dR
+        b = dR.T @ r
+        if self.comm is not None:
+            A = self.comm.allreduce(A)
+            b = self.comm.allreduce(b)
+        gamma = np.linalg.lstsq(A, b, rcond=None)[0]
+
+        return gx - dG @ gamma - (1 - self.omega) * (r - dR @ gamma)
+
+
+def accelerator(method, comm=None, omega=1.0, depth=5):
+    "Build the accelerator for `method` (none, aitken or anderson)."
+    if method == "none":
+        return Relaxation(omega, comm)
+    if method == "aitken":
+        return Aitken(omega, comm)
+    if method == "anderson":
+        return Anderson(depth, omega, comm)
+    raise ValueError("unknown acceleration method '{}'".format(method))
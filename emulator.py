@@ -0,0 +1,311 @@
+"""Gaussian process emulators of glacier_flowline_model.py trained on ensemble runs.
+
+Workflow:
+
+1. `design` draws a Latin hypercube sample of the parameter space and `write_members`
+   turns it into a members file for ensemble.py. Every run gets --param overrides and
+   writes a --summary JSON file. Parameters of the orographic SMB are named ltop.NAME
+   (e.g. ltop.Cw, with --args "--smb orog"); plain Sela, amin, ... are the linear SMB
+   and are rejected with --smb orog, which does not use them.
+2. `load_summaries` collects the completed runs into inputs X and outputs (final volume,
+   grounding line position, maximum thickness, surface profile).
+3. `Emulator` fits one Gaussian process per scalar output and per principal component
+   of the surface profiles. It predicts means and standard deviations at new points in
+   milliseconds, and `suggest` picks the next runs where the emulator is least certain.
+   Trained emulators are cached on disk, keyed by their training data.
+
+    python emulator.py design --bounds Sela=800:1200 K=1e-7:5e-7 -n 40 > members.txt
+    mpirun -n 41 python ensemble.py members.txt
+    python emulator.py train runs/*.json --suggest 8 > next_members.txt
+"""
+
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from scipy.stats import qmc
+
+scalar_outputs = ("volume", "gl_position", "max_thickness")
+
+profile_variance = 0.999
+"Fraction of the variance of the surface profiles kept by the principal components"
+
+
+def design(bounds, n, seed=None):
+    """Latin hypercube sample of `n` points.
+
+    `bounds` : dict name -> (low, high)
+
+    Returns a list of dicts name -> value.
+    """
+    names = sorted(bounds)
+    low = np.array([bounds[k][0] for k in names], dtype=float)
+    high = np.array([bounds[k][1] for k in names], dtype=float)
+    sample = qmc.scale(qmc.LatinHypercube(d=len(names), seed=seed).random(n), low, high)
+    return [dict(zip(names, row.tolist())) for row in sample]
+
+
+def write_members(points, out, prefix="runs/run", args=""):
+    "Write a members file for ensemble.py with one glacier model run per point."
+    for k, point in enumerate(points):
+        params = " ".join("--param {}={!r}".format(name, float(v)) for name, v in point.items())
+        out.write("glacier_flowline_model.py --batch {} {} -o {}_{:04d} --summary {}_{:04d}.json\n"
+                  .format(args, params, prefix, k, prefix, k).replace("  ", " "))
+
+
+def load_summaries(filenames, names=None):
+    """Inputs and outputs of completed runs.
+
+    Returns the parameter names, X (runs x parameters), the scalar outputs
+    (runs x len(scalar_outputs)) and the surface profiles (runs x vertices).
+    """
+    summaries = []
+    for filename in filenames:
+        with open(filename) as f:
+            summaries.append(json.load(f))
+    if names is None:
+        names = sorted(summaries[0]["params"])
+
+    X = np.array([[s["params"][k] for k in names] for s in summaries], dtype=float)
+    Y = np.array([[s[k] for k in scalar_outputs] for s in summaries], dtype=float)
+    profiles = np.array([s["surface"] for s in summaries], dtype=float)
+    return names, X, Y, profiles
+
+
+class GaussianProcess(object):
+    """Gaussian process regression with a squared exponential kernel with one length
+    scale per input (ARD), a signal variance and a noise variance. Hyperparameters
+    maximize the log marginal likelihood."""
+
+    def __init__(self, restarts=3, seed=0):
+        self.restarts = restarts
+        self.seed = seed
+
+    def kernel(self, A, B, log_theta):
+        ell = np.exp(log_theta[:-2])
+        d = (A[:, None, :] - B[None, :, :]) / ell
+        return np.exp(log_theta[-2]) * np.exp(-0.5 * np.sum(d**2, axis=-1))
+
+    def negative_log_likelihood(self, log_theta, X, y):
+        K = self.kernel(X, X, log_theta) + (np.exp(log_theta[-1]) + 1e-10) * np.eye(len(y))
+        try:
+            L = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return 1e25
+        alpha = cho_solve(L, y)
+        return 0.5 * y @ alpha + np.sum(np.log(np.diag(L[0])))
+
+    def fit(self, X, y):
+        "X : inputs scaled to the unit cube, y : standardized outputs"
+        rng = np.random.default_rng(self.seed)
+        d = X.shape[1]
+        best = None
+        for k in range(self.restarts):
+            start = np.concatenate([np.log(rng.uniform(0.1, 1.0, d)), [0.0, np.log(1e-4)]])
+            result = minimize(self.negative_log_likelihood, start, args=(X, y),
+                              method="L-BFGS-B",
+                              bounds=[(np.log(1e-3), np.log(1e2))] * d +
+                                     [(np.log(1e-3), np.log(1e2)), (np.log(1e-10), 0.0)])
+            if best is None or result.fun < best.fun:
+                best = result
+
+        self.log_theta = best.x
+        return self.condition(X, y)
+
+    def condition(self, X, y):
+        "Condition on the data X, y with the current hyperparameters."
+        self.X = X
+        self.y = y
+        K = self.kernel(X, X, self.log_theta) + (np.exp(self.log_theta[-1]) + 1e-10) * \
+            np.eye(len(y))
+        self.L = cho_factor(K, lower=True)
+        self.alpha = cho_solve(self.L, y)
+        return self
+
+    def predict(self, X):
+        "Mean and standard deviation (without the noise) at the inputs X."
+        Ks = self.kernel(X, self.X, self.log_theta)
+        mean = Ks @ self.alpha
+        v = cho_solve(self.L, Ks.T)
+        var = np.exp(self.log_theta[-2]) - np.sum(Ks * v.T, axis=1)
+        return mean, np.sqrt(np.maximum(var, 0.0))
+
+
+class Emulator(object):
+    """Emulator of the scalar outputs and the surface profile.
+
+    `names`, `bounds` : parameter names and (low, high) per name, for scaling
+    """
+
+    def __init__(self, names, bounds, restarts=3):
+        self.names = list(names)
+        self.low = np.array([bounds[k][0] for k in self.names], dtype=float)
+        self.high = np.array([bounds[k][1] for k in self.names], dtype=float)
+        self.restarts = restarts
+
+    def scale(self, X):
+        return (np.asarray(X, dtype=float) - self.low) / (self.high - self.low)
+
+    def fit(self, X, Y, profiles=None):
+        """Train on inputs X (runs x parameters), scalar outputs Y (runs x outputs) and
+        optionally surface profiles (runs x vertices), compressed by PCA."""
+        Z = self.scale(X)
+        targets = [Y]
+
+        self.n_scalar = Y.shape[1]
+        self.components = None
+        if profiles is not None:
+            # NaN (ice-free) surface values are replaced by the column mean
+            profiles = np.where(np.isnan(profiles), np.nanmean(profiles, axis=0), profiles)
+            self.profile_mean = profiles.mean(axis=0)
+            U, s, Vt = np.linalg.svd(profiles - self.profile_mean, full_matrices=False)
+            explained = np.cumsum(s**2) / max(np.sum(s**2), 1e-300)
+            k = int(np.searchsorted(explained, profile_variance) + 1)
+            self.components = Vt[:k]
+            targets.append((profiles - self.profile_mean) @ self.components.T)
+
+        T = np.hstack(targets)
+        self.mean = T.mean(axis=0)
+        self.std = np.where(T.std(axis=0) > 0, T.std(axis=0), 1.0)
+        self.gps = [GaussianProcess(self.restarts, seed=j).fit(Z, (T[:, j] - self.mean[j]) /
+                                                               self.std[j])
+                    for j in range(T.shape[1])]
+        return self
+
+    def predict_targets(self, X):
+        Z = np.atleast_2d(self.scale(X))
+        stats = [gp.predict(Z) for gp in self.gps]
+        mean = np.array([m for m, s in stats]).T * self.std + self.mean
+        std = np.array([s for m, s in stats]).T * self.std
+        return mean, std
+
+    def predict(self, X):
+        """Predicted scalar outputs and their standard deviations (points x outputs).
+        """
+        mean, std = self.predict_targets(X)
+        return mean[:, :self.n_scalar], std[:, :self.n_scalar]
+
+    def predict_profile(self, X):
+        """Predicted surface profiles and their standard deviations (points x vertices),
+        treating the principal component coefficients as independent."""
+        mean, std = self.predict_targets(X)
+        c_mean, c_std = mean[:, self.n_scalar:], std[:, self.n_scalar:]
+        return (self.profile_mean + c_mean @ self.components,
+                np.sqrt(c_std**2 @ self.components**2))
+
+    def suggest(self, n, candidates=4096, seed=None):
+        """Next `n` points to run: repeatedly the candidate with the largest predicted
+        standard deviation of the scalar outputs (relative to their spread), where the
+        already selected points are added to the training data with their predicted
+        values ("kriging believer"), so that the batch spreads out.
+        """
+        rng = np.random.default_rng(seed)
+        C = self.low + rng.random((candidates, len(self.names))) * (self.high - self.low)
+
+        # work on copies of the Gaussian processes of the scalar outputs
+        gps = [pickle.loads(pickle.dumps(gp)) for gp in self.gps[:self.n_scalar]]
+        Zc = self.scale(C)
+        chosen = []
+        for k in range(n):
+            std = np.sum([gp.predict(Zc)[1] for gp in gps], axis=0)
+            best = int(np.argmax(std))
+            chosen.append(C[best])
+            for gp in gps:
+                m = gp.predict(Zc[best:best + 1])[0]
+                gp.condition(np.vstack([gp.X, Zc[best]]), np.concatenate([gp.y, m]))
+        return [dict(zip(self.names, c.tolist())) for c in chosen]
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+
+def cached_emulator(names, bounds, X, Y, profiles=None, cache_dir="emulator_cache", **kwargs):
+    """Train an emulator, or load it from `cache_dir` if one was trained on the same
+    data and settings before."""
+    key = hashlib.sha1()
+    for a in (X, Y, profiles if profiles is not None else np.zeros(0)):
+        key.update(np.ascontiguousarray(a, dtype=float).tobytes())
+    key.update(repr((list(names), sorted(bounds.items()), sorted(kwargs.items()))).encode())
+    filename = os.path.join(cache_dir, key.hexdigest() + ".pickle")
+
+    if os.path.exists(filename):
+        return Emulator.load(filename)
+
+    emulator = Emulator(names, bounds, **kwargs).fit(X, Y, profiles)
+    os.makedirs(cache_dir, exist_ok=True)
+    emulator.save(filename)
+    return emulator
+
+
+def parse_bounds(items):
+    "NAME=LOW:HIGH strings to a dict name -> (low, high)"
+    bounds = {}
+    for item in items:
+        name, interval = item.split("=", 1)
+        low, high = interval.split(":")
+        bounds[name] = (float(low), float(high))
+    return bounds
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Emulators of the glacier flowline model.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    p = subparsers.add_parser("design", help="Write a members file for a Latin hypercube")
+    p.add_argument("--bounds", nargs="+", required=True, help="NAME=LOW:HIGH per parameter")
+    p.add_argument("-n", type=int, default=20, help="Number of runs")
+    p.add_argument("--seed", type=int, default=None)
+    p.add_argument("--prefix", default="runs/run", help="Output prefix of the runs")
+    p.add_argument("--args", default="", help="Further model arguments for every run")
+
+    p = subparsers.add_parser("train", help="Train (or load) an emulator and report it")
+    p.add_argument("summaries", nargs="+", help="Summary JSON files of completed runs")
+    p.add_argument("--bounds", nargs="*", default=[],
+                   help="NAME=LOW:HIGH (default: the range of the runs)")
+    p.add_argument("--cache_dir", default="emulator_cache")
+    p.add_argument("--suggest", type=int, default=0,
+                   help="Write a members file with this many new runs to stdout")
+    p.add_argument("--prefix", default="runs/next", help="Output prefix of suggested runs")
+    p.add_argument("--args", default="", help="Further model arguments for every run")
+    options = parser.parse_args()
+
+    if options.command == "design":
+        write_members(design(parse_bounds(options.bounds), options.n, options.seed),
+                      sys.stdout, options.prefix, options.args)
+    elif options.command == "train":
+        filenames = sorted(f for pattern in options.summaries for f in glob.glob(pattern))
+        names, X, Y, profiles = load_summaries(filenames)
+        bounds = {k: (X[:, j].min(), X[:, j].max()) for j, k in enumerate(names)}
+        bounds.update(parse_bounds(options.bounds))
+
+        emulator = cached_emulator(names, bounds, X, Y, profiles, options.cache_dir)
+
+        # leave-one-out error of the scalar outputs, as a quick quality check
+        if len(X) > 2:
+            errors = []
+            for k in range(len(X)):
+                keep = np.arange(len(X)) != k
+                loo = Emulator(names, bounds).fit(X[keep], Y[keep])
+                errors.append(np.fabs(loo.predict(X[k])[0][0] - Y[k]))
+            for j, name in enumerate(scalar_outputs):
+                sys.stderr.write("{}: mean leave-one-out error {:.3e}\n".format(
+                    name, np.mean([e[j] for e in errors])))
+
+        if options.suggest:
+            write_members(emulator.suggest(options.suggest), sys.stdout, options.prefix,
+                          options.args)
+    else:
+        parser.print_help()
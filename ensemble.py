@@ -0,0 +1,213 @@
+"""Run an ensemble of flowline model runs inside one MPI job.
+
+MPI_COMM_WORLD is split into groups of --ranks_per_member ranks. Each group runs one
+member at a time on its own sub-communicator (see mpi_comm), pulling the next member from
+a work queue held by rank 0, so groups that finish early take more members. At the end
+every rank's busy time is reported as a fraction of the wall time.
+
+The members file has one run per line: the model script followed by its arguments, e.g.
+
+    glacier_flowline_model.py --batch --geom sym -o sym_1 -e 500
+    sediment_higherorder_flowline.py --headless -g asym --seed 1 --checkpoint asym_1.h5
+
+Blank lines and lines starting with '#' are ignored. Members should write to distinct
+files.
+
+Members run in the interpreter of their ranks, so that they can use the sub-communicator.
+Global state is reset around each member: the dolfin parameters are restored, the numpy
+random generator is seeded with the member index (members that take a seed option still
+set their own), and the repository modules a member imported are dropped so the next one
+imports them afresh. If a member fails on one rank of a group larger than one, the other
+ranks may be stuck in its collective operations, so the group communicator is aborted
+(which in most MPI implementations ends the whole job).
+
+    mpirun -n 33 python ensemble.py members.txt
+"""
+
+import os
+import runpy
+import shlex
+import sys
+import time
+import traceback
+from argparse import ArgumentParser
+
+from mpi4py import MPI
+
+import mpi_comm
+
+READY = 1
+TASK = 2
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_members(filename):
+    "Argument lists (script first) of the members."
+    with open(filename) as members:
+        return [shlex.split(line) for line in members
+                if line.strip() and not line.lstrip().startswith("#")]
+
+
+def run_member(argv, comm, index=0):
+    """Run one member script as __main__ on `comm`, with the global state reset (see the
+    module documentation).
+
+    Returns True if it completed, False if it raised (the error is printed).
+    """
+    import matplotlib
+    import numpy as np
+
+    # members never need a display
+    matplotlib.use("Agg")
+
+    try:
+        import dolfin
+
+        saved_parameters = dolfin.parameters.copy()
+    except ImportError:
+        dolfin = None
+    saved_modules = set(sys.modules)
+    np.random.seed(index)
+
+    script = argv[0]
+    if not os.path.isabs(script):
+        script = os.path.join(here, script)
+
+    mpi_comm.set_comm(comm)
+    saved_argv = sys.argv
+    sys.argv = [script] + argv[1:]
+    try:
+        runpy.run_path(script, run_name="__main__")
+        ok = True
+    except SystemExit as e:
+        ok = not e.code
+    except Exception:
+        traceback.print_exc()
+        ok = False
+    finally:
+        sys.argv = saved_argv
+        mpi_comm.set_comm(None)
+        if dolfin is not None:
+            dolfin.parameters.update(saved_parameters)
+        for name in set(sys.modules) - saved_modules:
+            if os.path.dirname(getattr(sys.modules[name], "__file__", None) or "") == here:
+                del sys.modules[name]
+
+    if not ok and comm.size > 1:
+        # the other ranks of the group may wait in a collective of the failed member
+        print("member {} failed on rank {} of its group: aborting the group".format(
+            index, comm.rank), flush=True)
+        comm.Abort(1)
+    return ok
+
+
+def schedule(world, members, groups):
+    """Hand out members to the group leaders as they ask for work.
+
+    Returns a list of (member index, leader rank, run time, success).
+    """
+    results = []
+    next_member = 0
+    stopped = 0
+    status = MPI.Status()
+    while stopped < groups:
+        result = world.recv(source=MPI.ANY_SOURCE, tag=READY, status=status)
+        if result is not None:
+            results.append(result)
+            index, rank, elapsed, ok = result
+            print("member {} on rank {}: {} after {:.1f} s".format(
+                index, rank, "done" if ok else "FAILED", elapsed), flush=True)
+
+        if next_member < len(members):
+            world.send((next_member, members[next_member]), dest=status.Get_source(),
+                       tag=TASK)
+            next_member += 1
+        else:
+            world.send(None, dest=status.Get_source(), tag=TASK)
+            stopped += 1
+    return results
+
+
+def work(world, group):
+    """Run members on `group` until the work queue is empty.
+
+    Returns the busy time of this rank and the number of members it ran.
+    """
+    busy = 0.0
+    count = 0
+    result = None
+    while True:
+        if group.rank == 0:
+            world.send(result, dest=0, tag=READY)
+            task = world.recv(source=0, tag=TASK)
+        else:
+            task = None
+        task = group.bcast(task, root=0)
+        if task is None:
+            return busy, count
+
+        index, argv = task
+        start = time.time()
+        ok = run_member(argv, group, index)
+        elapsed = time.time() - start
+        busy += elapsed
+        count += 1
+        result = (index, world.rank, elapsed, ok)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run an ensemble of model runs in one MPI job.")
+    parser.add_argument("members",
+                        help="File with one member (script and arguments) per line")
+    parser.add_argument("--ranks_per_member", type=int, default=1,
+                        help="Size of the sub-communicator of each member")
+    options = parser.parse_args()
+
+    world = MPI.COMM_WORLD
+    members = read_members(options.members)
+    start = time.time()
+
+    if world.size == 1:
+        # No scheduler rank: run all members in order
+        busy, count, failed = 0.0, 0, 0
+        for index, argv in enumerate(members):
+            tic = time.time()
+            failed += not run_member(argv, MPI.COMM_SELF, index)
+            busy += time.time() - tic
+            count += 1
+        print("{} members, {} failed".format(count, failed))
+        stats = [(0, count, busy)]
+    else:
+        # Rank 0 schedules; the other ranks form groups of ranks_per_member
+        workers = world.size - 1
+        if workers % options.ranks_per_member:
+            raise ValueError("{} worker ranks cannot be split into groups of {}".format(
+                workers, options.ranks_per_member))
+        groups = workers // options.ranks_per_member
+
+        if world.rank == 0:
+            color = MPI.UNDEFINED
+        else:
+            color = (world.rank - 1) // options.ranks_per_member
+        group = world.Split(color, world.rank)
+
+        if world.rank == 0:
+            results = schedule(world, members, groups)
+            busy, count = 0.0, 0
+            print("{} members, {} failed".format(
+                len(results), sum(not ok for index, rank, elapsed, ok in results)))
+        else:
+            busy, count = work(world, group)
+            group.Free()
+
+        stats = world.gather((world.rank, count, busy), root=0)
+
+    wall = time.time() - start
+    if world.rank == 0:
+        print("rank  members  busy [s]  utilization")
+        for rank, count, busy in stats:
+            if rank == 0 and world.size > 1:
+                continue
+            print("{:4d} {:8d} {:9.1f} {:11.1%}".format(rank, count, busy, busy / wall))
+        print("wall time {:.1f} s".format(wall))
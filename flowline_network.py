@@ -0,0 +1,112 @@
+"""Networks of 1-D flowlines (tributaries feeding a trunk) as a single dolfin mesh.
+
+Each branch is a chain of interval cells along its own flow coordinate. A tributary's
+downstream end is the trunk vertex closest to its end coordinate, so the junction is a
+vertex shared by three (or more) cells. With continuous (CG1) elements, the thickness and
+velocity therefore match at junctions (and with the shared bed, so does the surface
+elevation). The width-weighted weak forms then sum the ice fluxes and the longitudinal
+stresses of all branches at the junction. Everything is assembled as one sparse system
+whose size grows linearly with the number of branches.
+
+The network is described by a JSON file:
+
+    {"branches": [
+        {"name": "trunk", "x0": -75000, "x1": 75000, "cells": 500, "width": 2000,
+         "ocean": true},
+        {"name": "north", "x0": -40000, "x1": 0, "cells": 150, "width": [500, 800],
+         "joins": "trunk"}
+    ]}
+
+`x0`/`x1` : upstream (divide) and downstream end [m] in the flow coordinate
+`cells` : number of cells
+`width` : width [m], constant or linearly varying from x0 to x1
+`joins` : name of the (earlier listed) branch this one flows into
+`ocean` : whether the downstream end is a marine terminus (shelf front boundary)
+"""
+
+import json
+
+import numpy as np
+
+
+def read_network(filename):
+    "The list of branch dicts of a network file, checked for consistency."
+    with open(filename) as network:
+        branches = json.load(network)["branches"]
+
+    names = []
+    for branch in branches:
+        for key in ("x0", "x1", "cells"):
+            if key not in branch:
+                raise ValueError("branch {} has no '{}'".format(branch.get("name"), key))
+        joins = branch.get("joins")
+        if joins is not None and joins not in names:
+            raise ValueError("branch {} joins '{}', which is not listed before it".format(
+                branch.get("name"), joins))
+        if joins is not None and branch.get("ocean", False):
+            raise ValueError("branch {} cannot both join another branch and end in the "
+                             "ocean".format(branch.get("name")))
+        names.append(branch.get("name", str(len(names))))
+        branch["name"] = names[-1]
+
+    return branches
+
+
+def network_mesh(branches, comm):
+    """Build the mesh of a flowline network (serial: `comm` must have one process).
+
+    Returns the mesh, the branch index of every cell (MeshFunction), the vertices at
+    marine termini, and the width of every cell (in cell order).
+    """
+    from dolfin import Mesh, MeshEditor, MeshFunction
+
+    if comm.size != 1:
+        raise ValueError("flowline networks are built on a single process "
+                         "(use ensemble.py to run many networks in parallel)")
+
+    coordinates = []
+    cells = []
+    cell_branch = []
+    cell_width = []
+    outlets = []
+    branch_vertices = {}
+
+    for index, branch in enumerate(branches):
+        x = np.linspace(branch["x0"], branch["x1"], branch["cells"] + 1)
+        ids = list(range(len(coordinates), len(coordinates) + len(x)))
+        coordinates.extend(x)
+
+        if branch.get("joins") is not None:
+            # the downstream end is the closest vertex of the branch joined
+            target = branch_vertices[branch["joins"]]
+            target_x = np.array([coordinates[v] for v in target])
+            junction = target[int(np.argmin(np.fabs(target_x - x[-1])))]
+            coordinates.pop()
+            ids[-1] = junction
+        branch_vertices[branch["name"]] = ids
+
+        if branch.get("ocean", False):
+            outlets.append(ids[-1])
+
+        w = np.broadcast_to(np.asarray(branch.get("width", 1.0), dtype=float), (2,))
+        midpoints = 0.5 * (x[:-1] + x[1:])
+        cell_width.extend(np.interp(midpoints, [x[0], x[-1]], w))
+
+        cells.extend(zip(ids[:-1], ids[1:]))
+        cell_branch.extend([index] * branch["cells"])
+
+    mesh = Mesh(comm)
+    editor = MeshEditor()
+    editor.open(mesh, "interval", 1, 1)
+    editor.init_vertices(len(coordinates))
+    for v, x in enumerate(coordinates):
+        editor.add_vertex(v, np.array([x]))
+    editor.init_cells(len(cells))
+    for c, vertices in enumerate(cells):
+        editor.add_cell(c, np.array(vertices, dtype=np.uintp))
+    editor.close()
+
+    markers = MeshFunction("size_t", mesh, 1, 0)
+    markers.array()[:] = cell_branch
+
+    return mesh, markers, outlets, np.array(cell_width)
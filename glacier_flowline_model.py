@@ -8,38 +8,131 @@
 # orographic precipitation model: Leif Anderson, University of Iceland
 #
 
-from dolfin import *
 from argparse import ArgumentParser
-import numpy as np
-import matplotlib
-import matplotlib.animation as animation
-from scipy.interpolate import interp1d
-import pickle
-import pylab as plt
-from linear_orog_precip import LTOP
-import ufl
-
-ufl.algorithms.apply_derivatives.CONDITIONAL_WORKAROUND = True
-set_log_level(30)
-import logging
-
-logging.getLogger("FFC").setLevel(logging.WARNING)
+import json
 import sys
 
-sys.setrecursionlimit(10000)
+import startup
 
+# Arguments first: --help and argument errors need none of the imports below
 parser = ArgumentParser()
 parser.add_argument("-i", dest="init_file", help="File with inital state", default=None)
 parser.add_argument("-o", dest="out_file", help="Output file", default="out")
 parser.add_argument("--smb", dest="precip_model", choices=["linear", "orog"], help="Precip model", default="linear")
+parser.add_argument("--orog_threshold", dest="orog_threshold", type=float, help="Surface change [m] (max. norm) that triggers a recomputation of the orographic SMB", default=10.0)
+parser.add_argument("--orog_max_age", dest="orog_max_age", type=int, help="Recompute the orographic SMB at least every this many steps", default=50)
+parser.add_argument("--orog_operator", dest="orog_operator", choices=["fft", "dense"], help="Orographic precipitation by FFT or by a precomputed (dense) linear operator", default="fft")
+parser.add_argument("--orog_cache", dest="orog_cache", help="Directory for cached orographic precipitation operators", default=None)
 parser.add_argument("--geom", dest="geom", choices=["sym", "asym", "1sided"], help="Bed geometry.", default="sym")
 parser.add_argument("-a", "--t_start", dest="ta", type=float, help="Start year", default=0.0)
 parser.add_argument("-e", "--t_end", dest="te", type=float, help="End year", default=250.0)
 parser.add_argument("--dt", dest="dt", type=float, help="Time step", default=1.0)
 parser.add_argument("--erosion", dest="erosion", action="store_true", help="Turn on erosion", default=False)
+parser.add_argument("--misfit", dest="misfit", choices=["thickness", "volume", "gl_position"], help="Compute the gradient of this misfit by the discrete adjoint instead of a plain run", default=None)
+parser.add_argument("--obs", dest="obs", help="Observations for --misfit: HDF5 file with H0 (thickness), text file with one volume per step (volume) or text file with the final grounding line position [m] (gl_position)", default=None)
+parser.add_argument("--snapshots", dest="snapshots", type=int, help="Number of states kept in memory by the adjoint", default=10)
+parser.add_argument("--taylor_test", dest="taylor_test", action="store_true", help="Verify the adjoint gradient by a Taylor test; exits with an error unless the remainders decrease at second order", default=False)
+parser.add_argument("--param", dest="params", action="append", metavar="KEY=VALUE", help="Override a model parameter (repeatable), e.g. --param Sela=900 --param K=1e-7; parameters of the orographic SMB take the prefix ltop., e.g. --param ltop.Cw=0.01", default=[])
+parser.add_argument("--summary", dest="summary", help="JSON file for the scalar outputs and final surface profile", default=None)
+parser.add_argument("--forcing", dest="forcing", action="append", metavar="KIND=FILE[:DATASET]", help="Time-dependent forcing (repeatable): {} from a .npy or HDF5 file (see climate_forcing)".format(", ".join(["ela_offset", "smb_anomaly", "wind_speed", "wind_direction"])), default=[])
+parser.add_argument("--field_interval", dest="field_interval", type=float, help="Years between field outputs (0: every step)", default=0.0)
+parser.add_argument("--scalar_interval", dest="scalar_interval", type=float, help="Years between rows of the scalar output <out>_scalars.txt (0: every step)", default=0.0)
+parser.add_argument("--checkpoint_interval", dest="checkpoint_interval", type=float, help="Years between restart files init_<out>.h5 (default: at the end only)", default=None)
+parser.add_argument("--event", dest="events", action="append", metavar="KIND[:VALUE]", help="Event forcing dense output (repeatable): gl_crossing:X, volume_rate:R, retries, ungrounding", default=[])
+parser.add_argument("--dense_window", dest="dense_window", type=float, help="Years of dense output after an event", default=0.0)
+parser.add_argument("--dense_interval", dest="dense_interval", type=float, help="Years between field and scalar outputs after an event (0: every step)", default=0.0)
+parser.add_argument("--stop", dest="stop", metavar="EXPRESSION", help="Stop before the end time when this holds, e.g. 'steady:1e-4:500 | max_thickness:5.1 | wall_clock:3600' (see termination); the reason goes to <out>_termination.json", default=None)
+parser.add_argument("--nx", dest="nx", type=int, help="Number of cells", default=500)
+parser.add_argument("--quad_order", dest="quad_order", type=int, help="Number of Gauss-Legendre points of the vertical quadrature (0: the default 4-point rule)", default=0)
+parser.add_argument("--degree", dest="degree", type=int, help="Polynomial degree of the (continuous) velocity elements", default=1)
+parser.add_argument("--continuation", dest="continuation", choices=["Sela", "amax", "amin", "amp"], help="Trace the steady states while this parameter goes through --cont_range (natural-parameter continuation) instead of a transient run", default=None)
+parser.add_argument("--cont_range", dest="cont_range", type=float, nargs=2, metavar=("START", "END"), help="Parameter range of the continuation", default=None)
+parser.add_argument("--cont_step", dest="cont_step", type=float, help="Initial parameter step of the continuation", default=None)
+parser.add_argument("--cont_min_step", dest="cont_min_step", type=float, help="Smallest parameter step before a fold is assumed (default: 1/64 of --cont_step)", default=None)
+parser.add_argument("--cont_max_step", dest="cont_max_step", type=float, help="Largest parameter step (default: 8 times --cont_step)", default=None)
+parser.add_argument("--cont_return", dest="cont_return", action="store_true", help="Sweep back from END to START after the forward sweep (hysteresis loop)", default=False)
+parser.add_argument("--relax_years", dest="relax_years", type=float, help="Longest transient relaxation onto a stable steady state (at the start of a sweep and after a fold)", default=5000.0)
+parser.add_argument("--relax_tol", dest="relax_tol", type=float, help="Relaxation ends when the relative volume change over 100 years is below this", default=1e-4)
+parser.add_argument("--batch", dest="batch", action="store_true", help="No visualization (and no plotting imports)", default=False)
+parser.add_argument("--import_times", dest="import_times", action="store_true", help="Report the time taken by each group of imports", default=False)
+parser.add_argument("--network", dest="network", help="JSON file describing a flowline network (see flowline_network)", default=None)
 
 options = parser.parse_args()
+if options.continuation is not None and (options.cont_range is None or options.cont_step is None):
+    parser.error("--continuation needs --cont_range and --cont_step")
+if options.misfit == "gl_position" and (options.obs is None or options.network is not None):
+    parser.error("--misfit gl_position needs --obs and a single flowline")
+
+# Forcings of the SMB model that is not selected would have no effect
+unused_forcing = dict(linear=["wind_speed", "wind_direction"], orog=["ela_offset"])[options.precip_model]
+for item in options.forcing:
+    if item.split("=", 1)[0] in unused_forcing:
+        parser.error("forcing '{}' has no effect with --smb {}".format(item.split("=", 1)[0], options.precip_model))
+
+timer = startup.ImportTimer()
+with timer("dolfin"):
+    from dolfin import *
+    import ufl
+with timer("numpy"):
+    import numpy as np
+transient = options.misfit is None and options.continuation is None
+with timer("model modules"):
+    # only the modules of the options that are set
+    from mpi_comm import get_comm
+    if options.misfit is not None:
+        import adjoint as discrete_adjoint
+    if options.forcing:
+        import climate_forcing
+    if options.network is not None:
+        import flowline_network
+    if transient:
+        import output_schedule
+    if options.stop is not None or options.continuation is not None:
+        import termination
+if options.precip_model == "orog":
+    with timer("orographic_smb"):
+        from orographic_smb import OrographicSMB
+if options.continuation is not None:
+    with timer("continuation"):
+        import scipy.sparse
+        import continuation
+if options.import_times:
+    print(timer.report())
+
+ufl.algorithms.apply_derivatives.CONDITIONAL_WORKAROUND = True
+set_log_level(30)
+import logging
+
+logging.getLogger("FFC").setLevel(logging.WARNING)
+
+sys.setrecursionlimit(10000)
 init_file = options.init_file
+
+# Parameter overrides; every key must be used by the end of the parameter definitions
+params = {}
+for p in options.params:
+    if "=" not in p:
+        parser.error("--param expects KEY=VALUE, got '{}'".format(p))
+    key, value = p.split("=", 1)
+    params[key] = float(value)
+param_values = dict(params)
+
+try:
+    forcing_streams = climate_forcing.parse_forcing(options.forcing, ["ela_offset", "smb_anomaly", "wind_speed", "wind_direction"]) if options.forcing else {}
+except (ValueError, OSError, KeyError) as e:
+    parser.error(str(e))
+
+try:
+    events = [output_schedule.parse_trigger(e) for e in options.events] if transient else []
+    stop = termination.StopCriterion(options.stop) if options.stop is not None else None
+except ValueError as e:
+    parser.error(str(e))
+
+
+def param(name, default):
+    return params.pop(name, default)
+
+
 out_file = options.out_file
 geom = options.geom
 precip_model = options.precip_model
@@ -64,44 +157,40 @@ ltop_constants["Cw"] = 0.0083  # uplift sensitivity factor [k m-3]
 ltop_constants["Hw"] = 3000  # vapor scale height
 ltop_constants["u"] = 7.5  # x-component of wind vector [m s-1]
 ltop_constants["v"] = 0  # y-component of wind vector [m s-1]
-ltop_constants["amin"] = -6.0
-ltop_constants["amax"] = 10.0
-ltop_constants["Smin"] = -400
-ltop_constants["Smax"] = 2500
-ltop_constants["Sela"] = -300
 ltop_constants["P0"] = 0.0  # background precip
 ltop_constants["P_scale"] = 8  # Precip scale factor
+
+# Orographic SMB parameters have their own namespace. The orographic SMB is the LTOP
+# precipitation alone, so the linear SMB parameters have no effect with it.
+linear_smb_keys = ["Sela", "amin", "amax", "Smin", "Smax"]
+for key in list(params):
+    if key.startswith("ltop."):
+        if key[5:] not in ltop_constants:
+            parser.error("unknown LTOP parameter '{}' (choose from {})".format(key, ", ".join("ltop." + k for k in ltop_constants)))
+        if precip_model not in "orog":
+            parser.error("'{}' has no effect without --smb orog".format(key))
+        ltop_constants[key[5:]] = params.pop(key)
+    elif key in linear_smb_keys and precip_model in "orog":
+        parser.error("'{}' is a linear SMB parameter and has no effect with --smb orog".format(key))
+    elif key in erosion_constants:
+        erosion_constants[key] = params.pop(key)
+    elif key in ltop_constants:
+        parser.error("'{}' is an LTOP parameter; use ltop.{}".format(key, key))
+
 ltop_constants["f"] = 2 * 7.2921e-5 * np.sin(ltop_constants["lat"] * np.pi / 180)  # Coriolis force
 
 
-def get_adot_from_orog_precip(ltop_constants):
+def set_wind(speed=None, direction=None):
     """
-    Calculates SMB for Linear Orographic Precipitation Model
+    Set the LTOP wind vector from a speed [m s-1] and/or a direction [degrees, 270 is west]
     """
-
-    amin = ltop_constants["amin"]
-    amax = ltop_constants["amax"]
-    Smin = ltop_constants["Smin"]
-    Smax = ltop_constants["Smax"]
-    Sela = ltop_constants["Sela"]
-    Pscale = ltop_constants["P_scale"]
-    P0 = ltop_constants["P0"]
-
-    x_a = project(X[0], Q).vector().get_local()
-    y_a = project(S, Q).vector().get_local()
-    # x_a, y_a = array_from_function(project(S, Q), Q, mesh)
-
-    XX, YY = np.meshgrid(x_a, list(range(3)))
-    Orography = np.tile(y_a, (3, 1))
-    OP = OrographicPrecipitation(XX, YY, Orography, ltop_constants, truncate=True, ounits="m year-1", tomass=False)
-
-    P = OP.P
-    P = P[1, :]
-    # smb_S =  function_from_array(x_a, P, Q, mesh)
-    smb_S = Function(Q)
-    smb_S.vector()[:] = np.ascontiguousarray(P)
-
-    return smb_S, P
+    u, v = ltop_constants["u"], ltop_constants["v"]
+    if speed is None:
+        speed = np.hypot(u, v)
+    if direction is None:
+        direction = np.degrees(np.arctan2(-u, -v)) % 360
+    ltop_constants["u"] = -np.sin(np.radians(direction)) * speed
+    ltop_constants["v"] = -np.cos(np.radians(direction)) * speed
 
 
 #
@@ -125,9 +214,9 @@ spy = 31556925.9747  # seconds per year [s year-1]
 thklim = 5.0  # Minimum thickness [m]
 g = 9.81  # gravity [m s-1]
 
-zmin = -500.0  # SMB parameters
-amin = -8.0  # [m year-1]
-amax = 10.0  # [m year-1]
+zmin = param("zmin", -500.0)  # SMB parameters
+amin = Constant(param("amin", -8.0))  # [m year-1]
+amax = Constant(param("amax", 10.0))  # [m year-1]
 c = 2.0
 
 rho = 900.0  # ice density [kg m-3]
@@ -148,27 +237,31 @@ dt = Constant(0)  # Constant time step (gets changed below)
 my_dx = 1000.0  # [m]
 x = np.arange(-L, L + my_dx, my_dx)  # [m]
 
-amp = 100.0  # Geometry oscillation parameters
-zmax = 2500.0  # [m]
+amp = param("amp", 100.0)  # Geometry oscillation parameters
+zmax = param("zmax", 2500.0)  # [m]
 x0 = 0
-sigma_x = 15e3
-sigma_x1 = 25e3
-sigma_x2 = 10e3
-
-# Correlation matrix for random topography
-N = len(x)
-corr_len = 2000.0
-corr = np.zeros((N, N))
-for i in range(N):
-    for j in range(i + 1):
-        corr[i, j] = exp(-abs(x[i] - x[j]) ** 2 / corr_len ** 2)
-        corr[j, i] = exp(-abs(x[i] - x[j]) ** 2 / corr_len ** 2)
+sigma_x = param("sigma_x", 15e3)
+sigma_x1 = param("sigma_x1", 25e3)
+sigma_x2 = param("sigma_x2", 10e3)
 
 # Amplitude of random perturbations
-rand_amp = 0.0
-cov = rand_amp ** 2 * corr
-z_noise = np.random.multivariate_normal(np.zeros(N), cov)
-iii = interp1d(x, z_noise)
+rand_amp = param("rand_amp", 0.0)
+
+if rand_amp != 0:
+    from scipy.interpolate import interp1d
+
+    # Random topography from its correlation matrix (N^2, so only when it is used)
+    N = len(x)
+    corr_len = 2000.0
+    corr = np.exp(-((x[:, np.newaxis] - x[np.newaxis, :]) ** 2) / corr_len ** 2)
+    cov = rand_amp ** 2 * corr
+    z_noise = np.random.multivariate_normal(np.zeros(N), cov)
+    iii = interp1d(x, z_noise)
+else:
+
+    def iii(x):
+        return 0.0
+
 
 # Bed elevation Expression
 class BedSym(UserExpression):
@@ -195,9 +288,12 @@ class Bed1Sided(UserExpression):
 
 
 # Basal traction Expression
+beta2_value = param("beta2", 2.5e3)
+
+
 class Beta2(UserExpression):
     def eval(self, values, x):
-        values[0] = 2.5e3
+        values[0] = beta2_value
 
 
 # Flowline width Expression - only relevent for continuity: lateral shear not considered
@@ -210,24 +306,34 @@ class Width(UserExpression):
 # MESH          #################
 #
 
-# Define a rectangular mesh
-nx = 500  # Number of cells
-mesh = IntervalMesh(nx, -L, L)  # Equal cell size
+if options.network is None:
+    # Define a rectangular mesh
+    nx = options.nx  # Number of cells
+    mesh = IntervalMesh(get_comm(), nx, -L, L)  # Equal cell size
+else:
+    # Tributaries and trunk in one mesh, joined at shared vertices
+    branches = flowline_network.read_network(options.network)
+    mesh, branch_markers, outlets, cell_width = flowline_network.network_mesh(branches, get_comm())
 
 X = SpatialCoordinate(mesh)  # Spatial coordinate
 
 ocean = MeshFunction("size_t", mesh, 0)  # Mesh function for boundary conditions
 ds = ds(subdomain_data=ocean)
 
-# Label the left and right boundary as ocean
-for f in facets(mesh):
-    if near(f.midpoint().x(), L):
-        ocean[f] = 1
-    if near(f.midpoint().x(), -L):
-        if geom in "1sided":
-            ocean[f] = 2
-        else:
+if options.network is None:
+    # Label the left and right boundary as ocean
+    for f in facets(mesh):
+        if near(f.midpoint().x(), L):
             ocean[f] = 1
+        if near(f.midpoint().x(), -L):
+            if geom in "1sided":
+                ocean[f] = 2
+            else:
+                ocean[f] = 1
+else:
+    # Marine termini of the network; all other branch ends are divides
+    for v in outlets:
+        ocean[v] = 1
 
 
 # Facet normals
@@ -239,11 +345,14 @@ normal = FacetNormal(mesh)
 
 Ecg = FiniteElement("CG", mesh.ufl_cell(), 1)
 Q = FunctionSpace(mesh, Ecg)
-EV = MixedElement(Ecg, Ecg, Ecg)
+Q_dg = FunctionSpace(mesh, FiniteElement("DG", mesh.ufl_cell(), 0))  # Cell-wise (width) space
+Ecg_u = FiniteElement("CG", mesh.ufl_cell(), options.degree)  # Velocity element
+Q_u = FunctionSpace(mesh, Ecg_u)
+EV = MixedElement(Ecg_u, Ecg_u, Ecg)
 V = FunctionSpace(mesh, EV)
 # V = MixedFunctionSpace([Q]*3)           # ubar, udef, H space
 
-ze = Function(Q)  # Zero constant function
+ze = Function(Q_u)  # Zero constant function
 
 grounded = Function(Q)  # Boolean grounded function
 grounded.vector()[:] = 1
@@ -271,8 +380,8 @@ Phi = TestFunction(V)  # Velocity test function
 u, u2, H = split(U)
 phi, phi1, xsi = split(Phi)
 
-un = Function(Q)  # Temporary velocities
-u2n = Function(Q)
+un = Function(Q_u)  # Temporary velocities
+u2n = Function(Q_u)
 
 H0 = Function(Q)
 H0.vector()[:] = rho_w / rho * thklim + 1e-3  # Initial thickness
@@ -290,25 +399,34 @@ dg = TrialFunction(Q)  # Scalar trial function
 ghat = Function(Q)  # Temp grounded
 gl = Constant(0)  # Scalar grounding line
 
-Smax = 2500.0  # above Smax, adot=amax [m]
-Smin = 200.0  # below Smin, adot=amin [m]
-Sela = 1000.0  # equilibrium line altidue [m]
+Smax = param("Smax", 2500.0)  # above Smax, adot=amax [m]
+Smin = param("Smin", 200.0)  # below Smin, adot=amin [m]
+Sela = Constant(param("Sela", 1000.0))  # equilibrium line altidue [m]
+ela_offset = Constant(0.0)  # ELA change by the forcing [m]
+ela = Sela + ela_offset
+smb_anomaly = Function(Q)  # SMB anomaly added to either SMB model [m year-1]
+
+if params:
+    parser.error("unknown parameters: {}".format(", ".join(sorted(params))))
 
 bmelt = -20.0  # sub-shelf melt rate [m year-1]
 
 if precip_model in "linear":
     adot = conditional(
-        lt(S, Sela), (-amin / (Sela - Smin)) * (S - Sela), (amax / (Smax - Sela)) * (S - Sela)
+        lt(S, ela), (-amin / (ela - Smin)) * (S - ela), (amax / (Smax - ela)) * (S - ela)
     ) * grounded + conditional(
-        lt(S, Sela),
-        (-amin / (Sela - Smin)) * (Hmid - Sela),
-        (amax / (Smax - Sela)) * (Hmid * (1 - rho / rho_w) - Sela),
+        lt(S, ela),
+        (-amin / (ela - Smin)) * (Hmid - ela),
+        (amax / (Smax - ela)) * (Hmid * (1 - rho / rho_w) - ela),
     ) * (
         1 - grounded
     )
     bdot = Constant(0.0)
 elif precip_model in "orog":
-    adot, P = get_adot_from_orog_precip(ltop_constants)
+    # One SMB Function used by the forms, updated in place when the surface has changed.
+    # It is updated at the start of a step, where the surface S is B + H0.
+    orog_smb = OrographicSMB(Q, B + H0, ltop_constants, options.orog_threshold, options.orog_max_age, options.orog_operator, options.orog_cache, fixed_padding=options.misfit is not None)
+    adot = orog_smb.smb
     bdot = conditional(gt(Hmid, np.abs(bmelt)), bmelt, -Hmid) * (1 - grounded)
 else:
     print(("precip model {} not supported".format(precip_model)))
@@ -369,8 +487,13 @@ u = VerticalBasis(u_, coef, dcoef)
 phi = VerticalBasis(phi_, coef, dcoef)
 
 # Quadrature points
-points = np.array([0.0, 0.4688, 0.8302, 1.0])
-weights = np.array([0.4876 / 2.0, 0.4317, 0.2768, 0.0476])
+if options.quad_order > 0:
+    points, weights = np.polynomial.legendre.leggauss(options.quad_order)
+    points = (points + 1) / 2.0
+    weights = weights / 2.0
+else:
+    points = np.array([0.0, 0.4688, 0.8302, 1.0])
+    weights = np.array([0.4876 / 2.0, 0.4317, 0.2768, 0.0476])
 
 vi = VerticalIntegrator(points, weights)
 
@@ -421,17 +544,28 @@ P_w = ufl.Max(-rho_w * g * B, 1e-16)
 # basal shear stress applied on grounded ice
 tau_b = beta2 * u(1) / (1.0 - normalx ** 2) * grounded
 
-# Momentum balance residual (Blatter-Pattyn/O(1)/LMLa)
+# Flowline width (cell-wise, so that branches meeting at a junction keep their own width)
+if options.network is None:
+    width = interpolate(Width(degree=0), Q_dg)
+else:
+    width = Function(Q_dg)
+    width_values = np.empty(mesh.num_cells())
+    width_values[[Q_dg.dofmap().cell_dofs(i)[0] for i in range(mesh.num_cells())]] = cell_width
+    width.vector().set_local(width_values)
+    width.vector().apply("insert")
+
+# Momentum balance residual (Blatter-Pattyn/O(1)/LMLa), integrated over the width so that
+# the stresses of all branches balance at a junction
 R = (
     -vi.intz(membrane_xx)
     - vi.intz(shear_xz)
     - phi(1) * tau_b
     - vi.intz(tau_dx) * grounded
     - vi.intz(tau_dx_f) * (1 - grounded)
-) * dx
+) * width * dx
 
 # shelf front boundary condition
-F_ocean_x = 1.0 / 2.0 * rho * g * (1 - (rho / rho_w)) * H ** 2 * Phi[0] * ds(1)
+F_ocean_x = 1.0 / 2.0 * rho * g * (1 - (rho / rho_w)) * H ** 2 * Phi[0] * width * ds(1)
 
 R += F_ocean_x
 
@@ -440,20 +574,20 @@ R += F_ocean_x
 # MASS BALANCE  ###################################
 #
 
-# SUPG parameters
+# SUPG parameters (the thickness stays CG1 whatever the velocity degree)
 h = CellDiameter(mesh)
 D = h * abs(U[0]) / 2.0
 
-# Width for including convergence/divergence
-width = interpolate(Width(degree=2), Q)
+# Cross-sectional area for including convergence/divergence
 area = Hmid * width
 
-# Add the SUPG-stabilized continuity equation to residual
+# Add the SUPG-stabilized continuity equation to residual, in conservative form for the
+# cross-sectional area, so the ice flux is conserved across junctions
 R += (
-    (H - H0) / dt * xsi
-    - xsi.dx(0) * U[0] * Hmid
-    + D * xsi.dx(0) * Hmid.dx(0)
-    - (adot + bdot - un * H0 / width * width.dx(0)) * xsi
+    (H - H0) / dt * width * xsi
+    - xsi.dx(0) * U[0] * area
+    + D * xsi.dx(0) * Hmid.dx(0) * width
+    - (adot + smb_anomaly + bdot) * width * xsi
 ) * dx + U[0] * area * xsi * ds(1)
 
 # Jacobian of coupled momentum-mass system
@@ -481,8 +615,10 @@ b_g = rhs(R_g)
 #
 # Erosion  ##########################
 #
-mdot = erosion_constants["K"] * abs(u(1)) ** erosion_constants["l"] * grounded
-R_e = ((dg - B) / dt - mdot) * psi * dx
+K_e = Constant(erosion_constants["K"])  # Erosion coefficient
+B_prev = Function(Q)  # Bed elevation before the erosion step
+mdot = K_e * abs(u(1)) ** erosion_constants["l"] * grounded
+R_e = ((dg - B_prev) / dt - mdot) * psi * dx
 A_e = lhs(R_e)
 b_e = rhs(R_e)
 
@@ -491,8 +627,8 @@ b_e = rhs(R_e)
 #
 
 # For moving data between vector functions and scalar functions
-assigner_inv = FunctionAssigner([Q, Q, Q], V)
-assigner = FunctionAssigner(V, [Q, Q, Q])
+assigner_inv = FunctionAssigner([Q_u, Q_u, Q], V)
+assigner = FunctionAssigner(V, [Q_u, Q_u, Q])
 
 #
 # Variational Solvers  ########################
@@ -520,13 +656,17 @@ mass_solver.parameters["snes_solver"]["error_on_nonconvergence"] = True
 mass_solver.parameters["snes_solver"]["linear_solver"] = "mumps"
 mass_solver.parameters["snes_solver"]["maximum_iterations"] = 100
 mass_solver.parameters["snes_solver"]["report"] = False
+if options.misfit is not None:
+    # The adjoint differentiates the discrete equations, so the solves have to satisfy them closely
+    mass_solver.parameters["snes_solver"]["relative_tolerance"] = 1e-9
+    mass_solver.parameters["snes_solver"]["absolute_tolerance"] = 1e-9
 
 # Bounds
 l_thick_bound = project(Constant(thklim), Q)
 u_thick_bound = project(Constant(1e4), Q)
 
-l_v_bound = project(-10000.0, Q)
-u_v_bound = project(10000.0, Q)
+l_v_bound = project(-10000.0, Q_u)
+u_v_bound = project(10000.0, Q_u)
 
 l_bound = Function(V)
 u_bound = Function(V)
@@ -534,13 +674,129 @@ u_bound = Function(V)
 assigner.assign(l_bound, [l_v_bound] * 2 + [l_thick_bound])
 assigner.assign(u_bound, [u_v_bound] * 2 + [u_thick_bound])
 
+# Time-dependent forcing, updating the Constants and Functions of the forms in place
+forcing = climate_forcing.Forcing() if forcing_streams else None
+if "ela_offset" in forcing_streams:
+    forcing.add("ela_offset", climate_forcing.ScalarForcing(forcing_streams["ela_offset"], ela_offset))
+if "smb_anomaly" in forcing_streams:
+    forcing.add("smb_anomaly", climate_forcing.FieldForcing(forcing_streams["smb_anomaly"], smb_anomaly))
+if "wind_speed" in forcing_streams:
+    forcing.add("wind_speed", climate_forcing.ScalarForcing(forcing_streams["wind_speed"], lambda value: set_wind(speed=value)))
+if "wind_direction" in forcing_streams:
+    forcing.add("wind_direction", climate_forcing.ScalarForcing(forcing_streams["wind_direction"], lambda value: set_wind(direction=value)))
+
 x = mesh.coordinates().ravel()
 SS = project(S)
-us = project(u(0))
-ub = project(u(1))
+us = project(u(0), Q)
+ub = project(u(1), Q)
 
 adot_p = project(adot, Q).vector().get_local()
 
+#
+# TIME STEP   ###############################
+#
+
+
+class Untaped(object):
+    "Runs the operations of a time step like adjoint.Tape, without recording them."
+
+    def solve(self, F, u, solve, active=None):
+        solve()
+
+    def assign(self, assigner, targets, sources, reverse):
+        assigner.assign(targets, sources)
+
+    def copy(self, target, source):
+        target.assign(source)
+
+    def external(self, target, sources, evaluate, adjoint):
+        evaluate()
+
+
+# Records the solves of a time step for the discrete adjoint (see adjoint.py)
+tape = discrete_adjoint.Tape() if options.misfit is not None else Untaped()
+
+# Residual of the erosion update in terms of the new bed elevation
+R_e_B = ufl.replace(R_e, {dg: B})
+
+# Thickness dofs, and the ones fixed by the ice divide condition
+H_dofs = np.array(V.sub(2).dofmap().dofs(), dtype=np.intc)
+bc_dofs = list(bc.get_boundary_values().keys()) if geom in "1sided" else []
+
+
+def active_dofs():
+    """Dofs of U that are fixed after the mass solve: thickness at its lower bound
+    (vinewtonrsls active set) and the ice divide condition."""
+    H_values = U.vector().get_local()[H_dofs]
+    return np.union1d(H_dofs[H_values <= thklim * (1 + 1e-6)], bc_dofs).astype(np.intc)
+
+
+def update_grounding():
+    solve(A_g == b_g, grounded)
+    grounded.vector()[0] = 1
+    grounded.vector()[:] = np.maximum(grounded.vector().get_local(), 0)
+    grounded.vector()[:] = np.minimum(grounded.vector().get_local(), 1)
+
+
+def erode():
+    tape.copy(B_prev, B)
+    tape.solve(R_e_B, B, lambda: solve(A_e == b_e, B))
+
+
+solver_retries = 0
+
+
+def solve_mass():
+    global solver_retries
+    # Try solving with last solution as initial guess for next solution
+    try:
+        mass_problem.set_bounds(l_bound, u_bound)
+        mass_solver.solve()
+    # If this breaks, set initial guess to zero and try again
+    except:
+        solver_retries += 1
+        assigner.assign(U, [ze, ze, H0])
+        mass_problem.set_bounds(l_bound, u_bound)
+        mass_solver.solve()
+
+
+def smb_adjoint():
+    """Adjoint of the orographic SMB for the tape. The surface it is computed from is
+    B + H0, so both get the dual vector of the surface."""
+    surface_adjoint = orog_smb.adjoint()
+
+    def adjoint(dual):
+        surface, derivatives = surface_adjoint(dual)
+        return [surface, surface], derivatives
+
+    return adjoint
+
+
+def step(t=None):
+    """Advance the forcing (from year t, none if t is None), orographic SMB, grounding
+    line, bed (with erosion) and ice by one time step."""
+    # Forcing at the middle of the (Crank-Nicolson) time step
+    if forcing and t is not None:
+        forcing.update(t + 0.5 * dt_float)
+
+    # Orographic SMB from the surface at the start of the step. For the adjoint, it is
+    # recomputed at every step, so that it is the SMB of the current surface.
+    if precip_model in "orog":
+        tape.external(orog_smb.smb, [B, H0], lambda: orog_smb.update(force=options.misfit is not None), smb_adjoint)
+
+    # Update grounding line position
+    update_grounding()
+
+    # Hard bed erosion
+    if erosion:
+        erode()
+
+    tape.solve(R, U, solve_mass, active_dofs)
+
+    # Set previous time step variables
+    tape.assign(assigner_inv, [un, u2n, H0], U, assigner)
+
+
 mass = []
 time = []
 
@@ -579,7 +835,7 @@ if init_file is not None:
     """
     Restart from file
     """
-    hdf = HDF5File(mpi_comm_world(), init_file, "r")
+    hdf = HDF5File(get_comm(), init_file, "r")
     hdf.read(mesh, "mesh", False)
     hdf.read(H0, "H0")
     hdf.read(un, "ubar")
@@ -587,104 +843,343 @@ if init_file is not None:
     hdf.read(grounded, "grounded")
     assigner.assign(U, [un, u2n, H0])
 
+#
+# GRADIENT   #################################
+#
+
+gl_smoothing = 10.0  # [m] height scale of the smooth grounded indicator of the GL misfit
+
+if options.misfit is not None:
+    n_steps = int(round((t_end - t) / dt_float))
+    if options.misfit == "thickness":
+        # Final thickness against observed thickness (zero if none are given)
+        H_obs = Function(Q)
+        if options.obs is not None:
+            hdf = HDF5File(get_comm(), options.obs, "r")
+            hdf.read(H_obs, "H0")
+            del hdf
+        misfit = discrete_adjoint.final_thickness_misfit(H0, H_obs, n_steps)
+    elif options.misfit == "volume":
+        # Ice volume (per unit width of the trunk) at every step against observations
+        volumes = np.loadtxt(options.obs) if options.obs is not None else np.zeros(n_steps)
+        misfit = discrete_adjoint.volume_misfit(H0, volumes, width)
+    else:
+        # Final grounding line position against the observed one. The grounded indicator
+        # of the model is a clipped step function, so the misfit uses a smooth version of
+        # the flotation condition, land (B >= 0) included as in gl_position(). The
+        # grounded ice is taken to extend from the left end (1sided) or the divide.
+        smooth_step = lambda z: 0.5 * (1 + ufl.tanh(z / gl_smoothing))
+        grounded_ice = smooth_step(H0 + rho_w / rho * ufl.Min(B, 0)) * smooth_step(H0 - 1.5 * rho_w / rho * thklim)
+        grounded_smooth = 1 - (1 - smooth_step(B)) * (1 - grounded_ice)
+        misfit = discrete_adjoint.grounding_line_misfit(grounded_smooth, X[0], -L if geom in "1sided" else 0.0, float(np.loadtxt(options.obs)), n_steps)
+
+    if precip_model in "linear":
+        names = ["beta2", "amin", "amax", "Sela"]
+        controls = [beta2, amin, amax, Sela]
+    else:
+        # v is across the flowline and only sets the padding, which is fixed here; the
+        # wind forcing sets u
+        names = ["beta2"] + ["ltop." + k for k in ["lat", "tau_c", "tau_f", "Nm", "Cw", "Hw", "u", "P0", "P_scale"] if not (k == "u" and ("wind_speed" in forcing_streams or "wind_direction" in forcing_streams))]
+        controls = [beta2] + [orog_smb.parameter(k[5:]) for k in names[1:]]
+    if erosion:
+        names.append("K")
+        controls.append(K_e)
+
+    model = discrete_adjoint.DiscreteAdjoint(lambda n: step(t + (n - 1) * dt_float), [U, un, u2n, H0, B, grounded], tape, n_steps, misfit, options.snapshots)
+    J_m, grads = model.gradient(controls)
+    print("Misfit {:.6e} after {} steps ({} forward steps for the gradient)".format(J_m, n_steps, model.forward_steps))
+    for name, grad in zip(names, grads):
+        print("d misfit / d {}: {}".format(name, grad if isinstance(grad, float) else "norm {:.6e}".format(grad.norm("l2"))))
+
+    dJ_dbeta2 = Function(Q)
+    dJ_dbeta2.vector()[:] = grads[0]
+    hdf = HDF5File(mesh.mpi_comm(), out_file + "_gradient.h5", "w")
+    hdf.write(mesh, "mesh")
+    hdf.write(dJ_dbeta2, "beta2")
+    for name, grad in zip(names[1:], grads[1:]):
+        hdf.attributes("beta2")[name] = grad
+    del hdf
+
+    if options.taylor_test:
+        # Relative perturbations of 1 % in a random direction (0.01 for a control that is zero)
+        directions = [beta2.vector().copy()]
+        directions[0][:] = 0.01 * beta2.vector().get_local() * np.random.randn(Q.dim())
+        directions += [0.01 * (abs(float(c)) or 1.0) for c in controls[1:]]
+        remainders, orders = discrete_adjoint.taylor_test(model, controls, directions, h=1.0)
+        print("Taylor remainders: {}".format(", ".join("{:.3e}".format(r) for r in remainders)))
+        print("Observed orders: {} (2 expected)".format(", ".join("{:.2f}".format(o) for o in orders)))
+        if min(orders) < 1.8:
+            sys.exit("Taylor test failed: the gradient is not consistent with the misfit")
+
+    sys.exit(0)
+
+# Upper glacier surface
+S_u = (B + H) * grounded + Hmid * (1 - rho / rho_w) * (1 - grounded)
+# Lower glacier surface
+S_l = B * grounded + Hmid * (-rho / rho_w) * (1 - grounded)
+
+
+def gl_position():
+    """
+    Grounding line position: the largest x of a grounded vertex
+    """
+    grounded_x = x[grounded.compute_vertex_values() > 0.5]
+    return float(grounded_x.max()) if len(grounded_x) else float("nan")
+
+
+def model_state():
+    """
+    Scalars compared by the output event triggers
+    """
+    return dict(
+        volume=assemble(H0 * width * dx),
+        gl_position=gl_position(),
+        max_thickness=H0.vector().max(),
+        retries=solver_retries,
+        grounded=assemble(grounded * width * dx),
+    )
+
+
+def write_restart(filename):
+    """
+    Save the current state for restarting purposes
+    """
+    hdf = HDF5File(mesh.mpi_comm(), filename, "w")
+    hdf.write(mesh, "mesh")
+    hdf.write(project(S), "S")
+    hdf.write(project(S_l), "Sl")
+    hdf.write(project(S_u), "Su")
+    hdf.write(project(B), "B")
+    hdf.write(H0, "H0")
+    hdf.write(un, "ubar")
+    hdf.write(u2n, "udef")
+    hdf.write(grounded, "grounded")
+    del hdf
+
+
+#
+# CONTINUATION  ##############################
+#
+
+if options.continuation is not None:
+    if precip_model not in "linear":
+        parser.error("--continuation needs --smb linear (the orographic SMB is not part of the Newton system)")
+    if options.continuation == "amp" and geom not in "1sided":
+        parser.error("the bed amplitude only enters the 1sided geometry")
+
+    class SteadyStates(object):
+        """
+        Steady states of the model for continuation.sweep
+        """
+
+        def set(self, p):
+            global amp
+            if options.continuation == "amp":
+                amp = p
+                B.interpolate(Bed1Sided(degree=2))
+            else:
+                dict(Sela=Sela, amax=amax, amin=amin)[options.continuation].assign(p)
+
+        def solve(self):
+            # No storage term (dt -> infinity) and thickness at the new state only (theta = 1);
+            # the grounded mask is iterated to the flotation condition of the steady state
+            theta.assign(1.0)
+            dt.assign(1e12)
+            iterations = 0
+            try:
+                for k in range(20):
+                    mass_problem.set_bounds(l_bound, u_bound)
+                    iterations += mass_solver.solve()[0]
+                    g = np.round(np.clip(project(ghat, Q).vector().get_local(), 0, 1))
+                    g[0] = 1
+                    if np.array_equal(g, grounded.vector().get_local()):
+                        break
+                    grounded.vector()[:] = g
+                else:
+                    raise RuntimeError("the grounding line does not settle")
+            finally:
+                theta.assign(0.5)
+                dt.assign(dt_float)
+            assigner_inv.assign([un, u2n, H0], U)
+            return iterations
+
+        def save(self):
+            return U.vector().get_local(), grounded.vector().get_local()
+
+        def load(self, state):
+            U.vector()[:] = state[0]
+            grounded.vector()[:] = state[1]
+            assigner_inv.assign([un, u2n, H0], U)
+
+        def combine(self, a, b, w):
+            return a[0] + w * (a[0] - b[0]), a[1]
+
+        def distance(self, a, b):
+            return np.linalg.norm(a[0] - b[0]) / max(np.linalg.norm(b[0]), 1e-300)
+
+        def sign(self):
+            # Jacobian of the steady system on the dofs not fixed by the bounds or the ice divide
+            theta.assign(1.0)
+            dt.assign(1e12)
+            A = as_backend_type(assemble(J, form_compiler_parameters=ffc_options)).mat()
+            theta.assign(0.5)
+            dt.assign(dt_float)
+            indptr, indices, values = A.getValuesCSR()
+            A = scipy.sparse.csr_matrix((values, indices, indptr), shape=A.getSize())
+            free = np.setdiff1d(np.arange(V.dim()), active_dofs())
+            return continuation.determinant_sign(A[free][:, free])
+
+        def relax(self):
+            steady = termination.Steady(options.relax_tol, 100.0)
+            t_relax = 0.0
+            while t_relax < options.relax_years and not steady(t_relax, model_state()):
+                step()
+                t_relax += dt_float
+            print("Relaxed for {:.0f} years".format(t_relax))
+
+        def diagnostics(self):
+            state = model_state()
+            return dict(volume=state["volume"], gl_position=state["gl_position"], max_thickness=state["max_thickness"])
+
+    start, end = options.cont_range
+    steady_states = SteadyStates()
+    points = []
+    try:
+        continuation.sweep(steady_states, start, end, options.cont_step, options.cont_min_step, options.cont_max_step, points=points)
+        if options.cont_return and points[-1].event != "failed":
+            continuation.sweep(steady_states, end, start, options.cont_step, options.cont_min_step, options.cont_max_step, points=points)
+    finally:
+        # the diagram of the states found so far, even if a sweep raised
+        if points:
+            continuation.write_diagram(out_file + "_bifurcation.txt", points, options.continuation)
+
+    print("Bifurcation diagram: {} points, {} folds, {} sign changes, {} failed".format(len(points), sum(p.event == "fold" for p in points), sum(p.event == "sign change" for p in points), sum(p.event == "failed" for p in points)))
+    if points[-1].event != "failed":
+        write_restart("init_" + out_file + ".h5")
+    sys.exit(0)
+
+# Output groups with their own intervals, dense after events
+scheduler = output_schedule.OutputScheduler(
+    dict(
+        fields=output_schedule.Group(options.field_interval, options.dense_interval),
+        scalars=output_schedule.Group(options.scalar_interval, options.dense_interval),
+        checkpoint=output_schedule.Group(options.checkpoint_interval),
+    ),
+    events,
+    options.dense_window,
+)
+
+scalar_columns = ["t", "volume", "gl_position", "max_thickness", "retries"]
+scalar_file = open(out_file + "_scalars.txt", "w")
+scalar_file.write("# " + " ".join(scalar_columns) + "\n")
+
 # Save the time series
 hdf = HDF5File(mesh.mpi_comm(), out_file + ".h5", "w")
 hdf.write(mesh, "mesh")
+if options.network is not None:
+    hdf.write(branch_markers, "branches")
 
 # Loop over time
 i = 0
+steps = 0
 while t < t_end:
     time.append(t)
 
-    # Update grounding line position
-    solve(A_g == b_g, grounded)
-    grounded.vector()[0] = 1
-    grounded.vector()[:] = np.maximum(grounded.vector().get_local(), 0)
-    grounded.vector()[:] = np.minimum(grounded.vector().get_local(), 1)
-
-    # Hard bed erosion
+    step(t)
+    steps += 1
     if erosion:
-        # Only update every update_lag years because
-        # this is computationally expensive
-        solve(A_e == b_e, B)
         print(("Erosion rate {} mm year-1".format(project(mdot).vector().max() * 1e3)))
 
-    # Try solving with last solution as initial guess for next solution
-    try:
-        mass_problem.set_bounds(l_bound, u_bound)
-        mass_solver.solve()
-    # If this breaks, set initial guess to zero and try again
-    except:
-        assigner.assign(U, [ze, ze, H0])
-        mass_problem.set_bounds(l_bound, u_bound)
-        mass_solver.solve()
-
-    # Set previous time step variables
-    assigner_inv.assign([un, u2n, H0], U)
-
-    # Upper glacier surface
-    S_u = (B + H) * grounded + Hmid * (1 - rho / rho_w) * (1 - grounded)
-    # Lower glacier surface
-    S_l = B * grounded + Hmid * (-rho / rho_w) * (1 - grounded)
-
-    us = project(u(0))
-    ub = project(u(1))
-
-    P = None
-    if precip_model in "orog":
-        adot, P = get_adot_from_orog_precip(ltop_constants)
-    adot_p = project(adot, Q).vector().get_local()
-    bdot_p = project(bdot, Q).vector().get_local()
-
-    # Save values at each time step
-    tdata.append(t)
-    Hdata.append(H0.vector().get_local())
-    Sudata.append(project(S_u).vector().get_local())
-    Sldata.append(project(S_l).vector().get_local())
-    Bdata.append(project(B).vector().get_local())
-    gldata.append(gl(0))
-    ubardata.append(un.vector().get_local())
-    udefdata.append(u2n.vector().get_local())
-    usdata.append(us.vector().get_local())
-    ubdata.append(ub.vector().get_local())
-    grdata.append(grounded.vector().get_local())
-    adotdata.append(adot_p)
-    bdotdata.append(bdot_p)
-    Pdata.append(P)
-
-    hdf.write(project(S), "S", i)
-    hdf.write(project(S_l), "Sl", i)
-    hdf.write(project(S_u), "Su", i)
-    hdf.write(project(B), "B", i)
-    hdf.write(H0, "H0", i)
-    hdf.write(un, "ubar", i)
-    hdf.write(u2n, "udef", i)
-    hdf.write(grounded, "grounded", i)
-    i += 1
+    adot_p = project(adot + smb_anomaly, Q).vector().get_local()
+
+    state = model_state()
+    output = scheduler.update(t, steps, state)
+
+    if "fields" in output:
+        us = project(u(0), Q)
+        ub = project(u(1), Q)
+
+        P = orog_smb.precipitation.copy() if precip_model in "orog" else None
+        bdot_p = project(bdot, Q).vector().get_local()
+
+        # Save values at each output step
+        tdata.append(t)
+        Hdata.append(H0.vector().get_local())
+        Sudata.append(project(S_u).vector().get_local())
+        Sldata.append(project(S_l).vector().get_local())
+        Bdata.append(project(B).vector().get_local())
+        gldata.append(gl(0))
+        ubardata.append(un.vector().get_local())
+        udefdata.append(u2n.vector().get_local())
+        usdata.append(us.vector().get_local())
+        ubdata.append(ub.vector().get_local())
+        grdata.append(grounded.vector().get_local())
+        adotdata.append(adot_p)
+        bdotdata.append(bdot_p)
+        Pdata.append(P)
+
+        hdf.write(project(S), "S", i)
+        hdf.write(project(S_l), "Sl", i)
+        hdf.write(project(S_u), "Su", i)
+        hdf.write(project(B), "B", i)
+        hdf.write(H0, "H0", i)
+        hdf.write(un, "ubar", i)
+        hdf.write(u2n, "udef", i)
+        hdf.write(grounded, "grounded", i)
+        i += 1
+
+    if "scalars" in output:
+        scalar_file.write(" ".join("{:.10g}".format(t if k == "t" else state[k]) for k in scalar_columns) + "\n")
+
+    if "checkpoint" in output:
+        write_restart("init_" + out_file + ".h5")
 
     print(("Year {:2.2f}, Hmax {:2.0f}, adotmax {:2.2f}".format(t, H0.vector().max(), adot_p.max())))
     t += dt_float
 
+    if stop is not None and stop(t, state):
+        print("Stopping at year {:.2f}: {}".format(t, stop.reason))
+        break
+
 del hdf
+if forcing:
+    forcing.close()
+if stop is not None:
+    stop.write(out_file + "_termination.json", t)
+scalar_file.close()
+print(scheduler.report())
+
+if precip_model in "orog":
+    print(orog_smb.report())
 
 # Save relevant data to pickle
 # pickle.dump((tdata,Hdata,Sudata,Sldata,Bdata,ubardata,udefdata,usdata,ubdata,grdata,gldata,adotdata,bdotdata), open(out_file + '.p', 'w'))
 
 # Save last time step for restarting purposes
-hdf = HDF5File(mesh.mpi_comm(), "init_" + out_file + ".h5", "w")
-hdf.write(mesh, "mesh")
-hdf.write(project(S), "S")
-hdf.write(project(S_l), "Sl")
-hdf.write(project(S_u), "Su")
-hdf.write(project(B), "B")
-hdf.write(H0, "H0")
-hdf.write(un, "ubar")
-hdf.write(u2n, "udef")
-hdf.write(grounded, "grounded")
+write_restart("init_" + out_file + ".h5")
+
+if options.summary is not None:
+    # Scalar outputs and the final surface profile, e.g. for training emulators
+    summary = dict(
+        params=param_values,
+        volume=assemble(H0 * width * dx),
+        gl_position=gl_position(),
+        max_thickness=H0.vector().max(),
+        dofs=V.dim(),
+        termination=stop.reason if stop is not None else "end time",
+        erosion_rate=project(mdot, Q).vector().max() if erosion else 0.0,
+        x=x.tolist(),
+        surface=project(S_u).compute_vertex_values().tolist(),
+    )
+    with open(options.summary, "w") as f:
+        json.dump(summary, f)
 
-del hdf
+if options.batch:
+    sys.exit(0)
 
 # Visualization
+import matplotlib.animation as animation
+import matplotlib.pyplot as plt
 
 
 def animate(i):
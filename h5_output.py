@@ -0,0 +1,147 @@
+"""HDF5 time series and restart checkpoints for dolfin Functions.
+
+Fields are stored by their degree of freedom vectors, gathered on rank 0, so that a
+checkpoint restores the exact state (including DG and mixed Functions) and a time series
+can be read without dolfin. Only rank 0 touches the files when writing; all ranks read
+their local range of a checkpoint.
+
+Time series layout (one file):
+
+    /coordinates          mesh coordinates
+    /time                 (steps,)
+    /<field>              (steps, dofs), chunked along time and gzip compressed
+
+Checkpoints are written to a temporary file that replaces the previous checkpoint only
+once it is complete, so an interrupted write never leaves a corrupt restart file.
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+
+def global_coordinates(mesh):
+    "Sorted vertex coordinates of a 1-D mesh across all processes."
+    local = mesh.coordinates().ravel()
+    return np.unique(np.concatenate(mesh.mpi_comm().allgather(local)))
+
+
+def gather(f):
+    "Degree of freedom values of a Function, gathered on rank 0 (empty elsewhere)."
+    return f.vector().gather_on_zero()
+
+
+def scatter(f, values):
+    "Set the local part of a Function from its global degree of freedom values."
+    first, last = f.vector().local_range()
+    f.vector().set_local(np.asarray(values[first:last], dtype=float))
+    f.vector().apply("insert")
+
+
+class TimeSeriesWriter(object):
+    "Append the degree of freedom values of a set of Functions to a chunked HDF5 file."
+
+    def __init__(self, filename, fields, coordinates, comm, chunk_steps=64, compression="gzip",
+                 compression_level=4, t_restart=None):
+        """`fields` : list of (name, Function)
+        `coordinates` : mesh coordinates stored with the series
+        `chunk_steps` : number of time steps per chunk
+        `t_restart` : when restarting, continue an existing file and drop the records
+                      written after this time
+        """
+        self.fields = fields
+        self.write_rank = comm.rank == 0
+        if not self.write_rank:
+            return
+
+        if t_restart is not None and os.path.exists(filename):
+            self.file = h5py.File(filename, "a")
+            keep = int(np.sum(self.file["time"][:] <= t_restart))
+            for name in ["time"] + [name for name, f in fields]:
+                self.file[name].resize(keep, axis=0)
+            return
+
+        self.file = h5py.File(filename, "w")
+        self.file.create_dataset("coordinates", data=coordinates)
+        self.file.create_dataset("time", shape=(0,), maxshape=(None,), dtype=float,
+                                 chunks=(chunk_steps,))
+        for name, f in fields:
+            n = f.function_space().dim()
+            self.file.create_dataset(name, shape=(0, n), maxshape=(None, n), dtype=float,
+                                     chunks=(chunk_steps, n), compression=compression,
+                                     compression_opts=compression_level, shuffle=True)
+
+    def write(self, t):
+        "Append the current values of all fields at time `t`."
+        values = [gather(f) for name, f in self.fields]
+        if not self.write_rank:
+            return
+
+        k = self.file["time"].shape[0]
+        self.file["time"].resize(k + 1, axis=0)
+        self.file["time"][k] = t
+        for (name, f), v in zip(self.fields, values):
+            self.file[name].resize(k + 1, axis=0)
+            self.file[name][k, :] = v
+        self.file.flush()
+
+    def close(self):
+        if self.write_rank:
+            self.file.close()
+
+
+def write_checkpoint(filename, fields, coordinates, comm, rng_state=None, **attributes):
+    """Write a restart file atomically.
+
+    `fields` : list of (name, Function)
+    `rng_state` : numpy RandomState state (as returned by np.random.get_state())
+    `attributes` : scalars such as the time, time step and step counter
+    """
+    values = [gather(f) for name, f in fields]
+    if comm.rank != 0:
+        return
+
+    tmp = filename + ".tmp"
+    with h5py.File(tmp, "w") as out:
+        out.create_dataset("coordinates", data=coordinates)
+        for (name, f), v in zip(fields, values):
+            out.create_dataset(name, data=v)
+        for key, value in attributes.items():
+            out.attrs[key] = value
+        if rng_state is not None:
+            algorithm, keys, pos, has_gauss, cached_gaussian = rng_state
+            rng = out.create_dataset("rng_keys", data=keys)
+            rng.attrs["algorithm"] = algorithm
+            rng.attrs["pos"] = pos
+            rng.attrs["has_gauss"] = has_gauss
+            rng.attrs["cached_gaussian"] = cached_gaussian
+        out.flush()
+        os.fsync(out.id.get_vfd_handle())
+    os.replace(tmp, filename)
+
+
+def read_checkpoint(filename, fields, coordinates=None):
+    """Restore the fields from a restart file.
+
+    Returns the attributes (dict) and the numpy RandomState state (or None).
+    Raises ValueError if `coordinates` do not match the mesh of the checkpoint.
+    """
+    with h5py.File(filename, "r") as inp:
+        stored = inp["coordinates"][:]
+        if coordinates is not None and (stored.shape != np.shape(coordinates) or
+                                        not np.allclose(stored, coordinates)):
+            raise ValueError("the mesh of '{}' differs from the current mesh".format(filename))
+
+        for name, f in fields:
+            scatter(f, inp[name][:])
+
+        attributes = dict(inp.attrs)
+
+        rng_state = None
+        if "rng_keys" in inp:
+            rng = inp["rng_keys"]
+            rng_state = (str(rng.attrs["algorithm"]), rng[:], int(rng.attrs["pos"]),
+                         int(rng.attrs["has_gauss"]), float(rng.attrs["cached_gaussian"]))
+
+    return attributes, rng_state
@@ -1,4 +1,8 @@
+import copy
+import time
+
 import numpy as np
+from scipy import fft
 
 import logging
 logger = logging.getLogger('LTOP')
@@ -55,6 +59,24 @@ class LTOP(object):
     gamma = -5.8
     "adiabatic lapse rate [K / km]"
 
+    workers = 1
+    "Number of threads used by the FFTs (-1 uses all available CPUs)"
+
+    padding = None
+    """Width of the padding added around the orography [m]. If None, it is
+    `pad_decay_lengths` times `decay_length()`"""
+
+    pad_decay_lengths = 5.0
+    "Padding width in units of the decay length of the precipitation response"
+
+    pad_mode = "constant"
+    """How the orography is extended into the padding: 'constant' (zero), 'reflect' or
+    'taper' (linear ramp from the edge values to zero)"""
+
+    single_precision = False
+    """Use float32/complex64 arithmetic. This halves the memory use; the difference from the
+    double precision result stays below 1e-5 * max(abs(P)) (typically a few times 1e-7)"""
+
     def __init__(self):
         self.update()
 
@@ -63,53 +85,183 @@ class LTOP(object):
         # make sure derived constants are up to date
         self.update()
 
-        eps = 1e-18
+        h_hat, kx, ky, shape, window = self._spectrum(orography, dx, dy)
 
-        nrows, ncols = orography.shape
+        P_hat = h_hat * self._transfer(kx, ky)
 
-        pad = max(nrows, ncols)
+        # Convert from wave domain back to space domain
+        P = fft.irfft2(P_hat, s=shape, workers=self.workers)
 
-        h = np.pad(orography, pad, 'constant')
+        # Remove padding
+        P = P[window]
+
+        return self._finish(P, truncate)
+
+    def run_batch(self, orography, dx, dy, params, truncate=True, out=None,
+                  max_memory=2**30):
+        """Compute orographic precipitation in mm/hour for many parameter sets.
+
+        `params` : sequence of dicts mapping LTOP attribute names (`direction`, `speed`,
+                   `tau_c`, `tau_f`, `Nm`, ...) to values; attributes not listed keep the
+                   values of this object
+        `out` : array of shape (len(params), nrows, ncols) that receives the results, for
+                example a numpy.memmap or an h5py dataset; allocated if None
+        `max_memory` : approximate limit [bytes] on the spectral work arrays
+
+        Every parameter set is padded as `run()` would pad it, so its result does not
+        depend on the rest of the batch. The forward transform of the orography is
+        computed once per distinct padding (once for a sweep over wind directions at a
+        fixed speed). Transfer functions are applied to chunks of parameter sets, so the
+        whole batch costs about one forward FFT per padding plus len(params) inverse FFTs.
+        """
+        params = list(params)
+
+        models = []
+        for p in params:
+            model = copy.copy(self)
+            for key, value in p.items():
+                if not hasattr(LTOP, key):
+                    raise ValueError("unknown LTOP parameter '{}'".format(key))
+                setattr(model, key, value)
+            model.update()
+            models.append(model)
+
+        if out is None:
+            out = np.empty((len(params),) + np.shape(orography), dtype=self._dtypes()[0])
+
+        # group the parameter sets by their padded shape
+        paddings = {}
+        for index, model in enumerate(models):
+            key = tuple(model._pad_widths(n, spacing, fft_real) for n, spacing, fft_real
+                        in zip(np.shape(orography), (dy, dx), (False, True)))
+            paddings.setdefault(key, []).append(index)
+
+        for indices in paddings.values():
+            h_hat, kx, ky, shape, window = models[indices[0]]._spectrum(orography, dx, dy)
+
+            # one spectral array and one padded field per parameter set
+            per_model = h_hat.nbytes + shape[0] * shape[1] * h_hat.real.itemsize
+            chunk = max(1, int(max_memory // per_model))
+
+            for start in range(0, len(indices), chunk):
+                group = indices[start:start + chunk]
+
+                P_hat = np.empty((len(group),) + h_hat.shape, dtype=h_hat.dtype)
+                for k, index in enumerate(group):
+                    np.multiply(h_hat, models[index]._transfer(kx, ky), out=P_hat[k])
+
+                P = fft.irfft2(P_hat, s=shape, axes=(-2, -1), workers=self.workers,
+                               overwrite_x=True)
+                del P_hat
+
+                for k, index in enumerate(group):
+                    out[index] = models[index]._finish(P[k][window], truncate)
+
+        return out
+
+    def _spectrum(self, orography, dx, dy):
+        """Pad the orography (see `padding` and `pad_mode`) and compute its Fourier
+        transform together with the wavenumbers. Returns the transform, the wavenumbers,
+        the padded shape and the slices that remove the padding."""
+        real = self._dtypes()[0]
+
+        widths = [self._pad_widths(n, spacing, fft_real)
+                  for n, spacing, fft_real in zip(orography.shape, (dy, dx), (False, True))]
+
+        modes = {"constant": "constant", "reflect": "reflect", "taper": "linear_ramp"}
+        if self.pad_mode not in modes:
+            raise ValueError("unknown padding mode '{}'".format(self.pad_mode))
+
+        h = np.pad(np.asarray(orography, dtype=real), widths, modes[self.pad_mode])
         nrows, ncols = h.shape
 
-        h_hat = np.fft.fft2(h)
+        # h is real, so only the non-negative x frequencies are needed
+        h_hat = fft.rfft2(h, workers=self.workers)
 
-        x_freq = np.fft.fftfreq(ncols, dx / (2 * np.pi))
-        y_freq = np.fft.fftfreq(nrows, dy / (2 * np.pi))
+        x_freq = fft.rfftfreq(ncols, dx / (2 * np.pi)).astype(real)
+        y_freq = fft.fftfreq(nrows, dy / (2 * np.pi)).astype(real)
 
         kx, ky = np.meshgrid(x_freq, y_freq)
 
+        window = tuple(slice(before, n - after) for (before, after), n in zip(widths, h.shape))
+
+        return h_hat, kx, ky, h.shape, window
+
+    def decay_length(self):
+        """Horizontal distance [m] over which the precipitation response to a point
+        perturbation of the orography decays: the distance condensed water is carried
+        downwind during conversion and fallout, plus the airflow length U/Nm of the
+        mountain wave.
+
+        With Hw > 0 the response also has algebraically decaying tails (the vertical
+        factor 1 - i m Hw is nearly constant in the wavenumber), so then the padding never
+        drops below the extent of the orography itself, see `_pad_widths`."""
+        return self.speed * (self.tau_c + self.tau_f + 1.0 / self.Nm)
+
+    def padding_width(self):
+        "Width of the padding [m] (before the floor `_pad_widths` applies if Hw > 0)."
+        if self.padding is None:
+            return self.pad_decay_lengths * self.decay_length()
+        return self.padding
+
+    def _pad_widths(self, n, spacing, fft_real):
+        """Number of padding cells before and after an axis of length `n`. If Hw > 0 and
+        `padding` is not set, this is at least `n` (the padding LTOP always used), so the
+        algebraic tails of the response are covered as well as before. The padded length
+        is rounded up to a fast FFT length. Axes of length one are not padded, so a single
+        row is treated as a ridge that is uniform in the other direction."""
+        if n == 1:
+            return (0, 0)
+
+        before = int(np.ceil(self.padding_width() / spacing))
+        if self.padding is None and self.Hw > 0:
+            before = max(before, n)
+        total = fft.next_fast_len(n + 2 * before, real=fft_real)
+
+        return (before, total - n - before)
+
+    def _transfer(self, kx, ky):
+        "Transfer function mapping orography to precipitation in the wave domain."
+        eps = 1e-18
+
+        real, cplx = self._dtypes()
+
         # Intrinsic frequency sigma = U*k + V*l
-        u0 = self.u
-        v0 = self.v
+        u0 = real(self.u)
+        v0 = real(self.v)
 
         # $\sigma = U k + V l$, see paragraph after eq 5.
         sigma = u0 * kx + v0 * ky
 
-        denominator = sigma**2 - self.f**2
+        denominator = sigma**2 - real(self.f)**2
         denominator[np.logical_and(np.fabs(denominator) < eps, denominator >= 0)] = eps
         denominator[np.logical_and(np.fabs(denominator) < eps, denominator  < 0)] = -eps
 
         m_squared = (self.Nm**2 - sigma**2) * (kx**2 + ky**2) / denominator
 
-        m = np.sqrt(np.array(m_squared, dtype=np.complex))
+        # m = sqrt(m_squared) is real where m_squared >= 0, where it takes the sign of
+        # sigma (regularization), and imaginary elsewhere. Evaluate 1 - i m Hw without
+        # forming m as a complex array.
+        propagating = m_squared >= 0
+        m_Hw = np.sqrt(np.fabs(m_squared)) * real(self.Hw)
+        m_Hw[np.logical_and(propagating, sigma < 0)] *= -1
 
-        # Regularization
-        nonzero = np.logical_and(m_squared >= 0, sigma != 0)
-        m[nonzero] *= np.sign(sigma[nonzero])
+        vertical = np.empty(sigma.shape, dtype=cplx)
+        vertical.real = np.where(propagating, 1, 1 + m_Hw)
+        vertical.imag = np.where(propagating, -m_Hw, 0)
 
-        P_hat = h_hat * (self.Cw * 1j * sigma /
-                         ((1 - 1j * m * self.Hw) *
-                          (1 + 1j * sigma * self.tau_c) *
-                          (1 + 1j * sigma * self.tau_f)))
+        # (1 + i sigma tau_c) (1 + i sigma tau_f)
+        cloud = np.empty(sigma.shape, dtype=cplx)
+        cloud.real = 1 - sigma**2 * real(self.tau_c * self.tau_f)
+        cloud.imag = sigma * real(self.tau_c + self.tau_f)
 
-        # Convert from wave domain back to space domain
-        P = np.real(np.fft.ifft2(P_hat))
+        vertical *= cloud
+        del cloud
 
-        # Remove padding
-        if pad > 0:
-            P = P[pad:-pad, pad:-pad]
+        return (real(self.Cw) * 1j) * sigma / vertical
 
+    def _finish(self, P, truncate):
+        "Convert to mm/hour, add background precipitation, truncate and scale."
         # convert to mm hr-1
         P *= 3600
 
@@ -124,6 +276,12 @@ class LTOP(object):
 
         return P
 
+    def _dtypes(self):
+        "Real and complex floating point types used by the FFTs."
+        if self.single_precision:
+            return np.float32, np.complex64
+        return np.float64, np.complex128
+
     def update(self):
         "Update derived constants"
 
@@ -161,25 +319,24 @@ def triangle_ridge_exact(x, u, Cw, tau, A=500.0, d=50e3):
 
     xc = Ut * np.log(2 - np.exp(-d / Ut))
 
-    def P(x):
-        if x < 0 and x >= -d:
-            return C * (1.0 - np.exp(-(x + d) / Ut))
-        elif x >= 0 and x <= xc:
-            return C * (np.exp(-x / Ut) * (2 - np.exp(-d / Ut)) - 1)
-        else:
-            return 0
+    x = np.asarray(x, dtype=float)
 
-    try:
-        return 3600 * np.array([P(t) for t in x])
-    except TypeError:
-        return 3600 * P(x)
+    upwind = np.logical_and(x < 0, x >= -d)
+    downwind = np.logical_and(x >= 0, x <= xc)
 
-def max_error(spacing, direction):
-    """Compute the maximum precipitation error compared to the "triangle ridge" exact
-    solution.
+    # evaluate both branches on clipped arguments to avoid overflow outside their ranges
+    P = np.where(upwind, C * (1.0 - np.exp(-(np.clip(x, -d, 0) + d) / Ut)), 0.0)
+    P = np.where(downwind, C * (np.exp(-np.clip(x, 0, xc) / Ut) * (2 - np.exp(-d / Ut)) - 1), P)
+
+    return 3600 * P
+
+def triangle_ridge_solution(spacing, direction, **settings):
+    """Compute the precipitation along the wind across the "triangle ridge" and the
+    corresponding exact solution.
 
     `spacing` : grid spacing, meters
     `direction` : wind direction, degrees
+    `settings` : other LTOP attributes, e.g. `padding` or `pad_mode`
 
     """
     model = LTOP()
@@ -189,6 +346,8 @@ def max_error(spacing, direction):
     model.Hw = 0.0
     model.direction = direction
     model.latitude = 0.0
+    for key, value in settings.items():
+        setattr(model, key, value)
 
     if direction == 90 or direction == 270:
         # east or west
@@ -216,6 +375,12 @@ def max_error(spacing, direction):
     else:
         P_exact = triangle_ridge_exact(t,  model.speed, model.Cw, model.tau_f)
 
+    return P, P_exact
+
+def max_error(spacing, direction, **settings):
+    """Compute the maximum precipitation error compared to the "triangle ridge" exact
+    solution (see `triangle_ridge_solution`)."""
+    P, P_exact = triangle_ridge_solution(spacing, direction, **settings)
     return np.max(np.fabs(P - P_exact))
 
 def convergence_rate(dxs, error, direction, plot):
@@ -255,6 +420,121 @@ def ltop_test(plot=False):
     assert convergence_rate(dxs, max_error, 180, plot) > 1.9
     assert convergence_rate(dxs, max_error, 270, plot) > 1.9
 
+def reference_error(spacing, direction, reference_padding=2000e3, **settings):
+    """Compute the maximum precipitation error on the "triangle ridge" compared to a run
+    padded by `reference_padding` [m]. Unlike `max_error`, this works for Hw > 0, where
+    there is no exact solution.
+
+    `settings` : LTOP attributes, e.g. `Hw`, `speed` or `pad_decay_lengths`
+    """
+    if direction == 90 or direction == 270:
+        x, dx, y, dy = triangle_ridge_grid(dx=spacing)
+        orography = np.tile(triangle_ridge(x), (len(y), 1))
+    else:
+        x, dx, y, dy = triangle_ridge_grid(dy=spacing)
+        orography = np.tile(triangle_ridge(y), (len(x), 1)).T
+
+    def run(**extra):
+        model = LTOP()
+        model.direction = direction
+        model.latitude = 0.0
+        for key, value in dict(settings, **extra).items():
+            setattr(model, key, value)
+        return model.run(orography, dx, dy)
+
+    return np.max(np.fabs(run() - run(padding=reference_padding)))
+
+def padding_report(pad_decay_lengths=(1, 5, 10, 20, 40), spacing=250, direction=270,
+                   pad_mode="constant", Hw=0.0, speed=LTOP.speed):
+    """Compute the "triangle ridge" error and the cost of LTOP.run as a function of the
+    padding width. With Hw = 0 the error is taken against the exact solution, otherwise
+    against a run with 2000 km of padding.
+
+    Returns a list of (decay lengths, padding [m], padded shape, max. error [mm hr-1],
+    run time [s]) tuples.
+    """
+    if direction == 90 or direction == 270:
+        x, dx, y, dy = triangle_ridge_grid(dx=spacing)
+    else:
+        x, dx, y, dy = triangle_ridge_grid(dy=spacing)
+    orography = np.zeros((len(y), len(x)))
+
+    rows = []
+    for n in pad_decay_lengths:
+        settings = dict(pad_decay_lengths=n, pad_mode=pad_mode, speed=speed)
+
+        model = LTOP()
+        model.tau_c = 0.0
+        model.Hw = Hw
+        for key, value in settings.items():
+            setattr(model, key, value)
+
+        start = time.time()
+        if Hw == 0:
+            error = max_error(spacing, direction, **settings)
+        else:
+            error = reference_error(spacing, direction, Hw=Hw, tau_c=0.0, **settings)
+        elapsed = time.time() - start
+
+        shape = model._spectrum(orography, dx, dy)[3]
+        # padding along the wind, including the floor of `_pad_widths`
+        if direction == 90 or direction == 270:
+            padding = model._pad_widths(len(x), dx, True)[0] * dx
+        else:
+            padding = model._pad_widths(len(y), dy, False)[0] * dy
+
+        rows.append((n, padding, shape, error, elapsed))
+
+    return rows
+
+def regional_dem(nrows=500, ncols=2000, spacing=250.0, peaks=60, h_max=2500.0, seed=0):
+    """A synthetic regional DEM: `peaks` Gaussian mountains of random position, width and
+    height on a grid of nrows x ncols points. Returns the orography and the spacing."""
+    rng = np.random.default_rng(seed)
+    x = np.arange(ncols) * spacing
+    y = np.arange(nrows) * spacing
+    orography = np.zeros((nrows, ncols))
+    for k in range(peaks):
+        x0, y0 = rng.uniform(0, x[-1]), rng.uniform(0, y[-1])
+        sigma = rng.uniform(3e3, 15e3)
+        bump_x = np.exp(-(x - x0)**2 / (2 * sigma**2))
+        bump_y = np.exp(-(y - y0)**2 / (2 * sigma**2))
+        orography += rng.uniform(0.2, 1.0) * h_max * np.outer(bump_y, bump_x)
+    return orography, spacing
+
+def dem_padding_report(orography, spacing, pad_decay_lengths=(1, 2, 5, 10), Hw=0.0,
+                       speed=LTOP.speed, direction=270):
+    """Compute the size, run time and error of LTOP.run on a DEM as a function of the
+    padding width. The reference is the padding of max(nrows, ncols) cells on every side
+    that LTOP used before `padding` existed.
+
+    Returns a list of (decay lengths, padded shape, padded size / DEM size, max. error
+    relative to the largest precipitation, run time [s]) tuples; the first row is the
+    reference (decay lengths None).
+    """
+    def run(**settings):
+        model = LTOP()
+        model.Hw = Hw
+        model.speed = speed
+        model.direction = direction
+        for key, value in settings.items():
+            setattr(model, key, value)
+        start = time.time()
+        P = model.run(orography, spacing, spacing)
+        elapsed = time.time() - start
+        shape = tuple(n + sum(model._pad_widths(n, spacing, fft_real))
+                      for n, fft_real in zip(orography.shape, (False, True)))
+        return P, shape, elapsed
+
+    P_ref, shape, elapsed = run(padding=max(orography.shape) * spacing)
+    scale = np.max(np.fabs(P_ref))
+    rows = [(None, shape, np.prod(shape) / orography.size, 0.0, elapsed)]
+    for n in pad_decay_lengths:
+        P, shape, elapsed = run(pad_decay_lengths=n)
+        rows.append((n, shape, np.prod(shape) / orography.size,
+                     np.max(np.fabs(P - P_ref)) / scale, elapsed))
+    return rows
+
 def gaussian_bump(xmin, xmax, ymin, ymax, dx, dy, h_max=500.0,
                   x0=-25e3, y0=0.0, sigma_x=15e3, sigma_y=15e3):
     "Create the setup needed to reproduce Fig 4c in SB2004"
@@ -276,4 +556,20 @@ if __name__ == "__main__":
     def log_fit_plot(x, p, label):
         plt.plot(np.log10(x), np.polyval(p, np.log10(x)), label=label)
 
+    for Hw, speed in ((0.0, LTOP.speed), (2500.0, 10.0)):
+        print("Hw {:g} m, speed {:g} m/s".format(Hw, speed))
+        print("decay lengths  padding [km]  padded shape  max. error [mm/hr]  time [s]")
+        for n, padding, shape, error, elapsed in padding_report(Hw=Hw, speed=speed):
+            print("{:13.1f}  {:12.1f}  {:>12}  {:18.3e}  {:8.3f}".format(
+                n, padding / 1e3, "{}x{}".format(*shape), error, elapsed))
+
+    orography, spacing = regional_dem()
+    for Hw, speed in ((0.0, 15.0), (2500.0, 15.0)):
+        print("{}x{} DEM, Hw {:g} m, speed {:g} m/s".format(*orography.shape, Hw, speed))
+        print("decay lengths  padded shape  size / DEM size  rel. error  time [s]")
+        for n, shape, size, error, elapsed in dem_padding_report(orography, spacing, Hw=Hw,
+                                                                 speed=speed):
+            print("{:>13}  {:>12}  {:15.1f}  {:10.2e}  {:8.3f}".format(
+                "old" if n is None else n, "{}x{}".format(*shape), size, error, elapsed))
+
     ltop_test(plot=True)
@@ -0,0 +1,275 @@
+"""The linear LTOP response along a flowline as a precomputed matrix.
+
+Before truncation, `LTOP.run` is a linear map from the orography to the precipitation.
+For a single row of n points with a fixed spacing and fixed parameters, this map is an
+n x n matrix A, so each evaluation of the precipitation becomes one matrix-vector product
+followed by the conversion, background precipitation, truncation and scaling of
+`LTOP._finish`. This replaces the padding and the forward and inverse FFT of the padded
+row at every time step.
+
+With the default zero padding, A[i, j] = k[(i - j) mod N], where k is the impulse response
+of the transfer function on the padded row of length N (a circulant kernel). Other
+padding modes are linear in the orography too; for them A is built by applying LTOP to
+unit impulses. A is stored dense: with Hw > 0 the response has slowly decaying tails, so
+truncating A to a band costs several percent of accuracy at widths that still make the
+sparse product slower than the dense one on flowline sizes.
+
+Operators are cached on disk, keyed on the row size, spacing and parameters.
+
+`Linearization` differentiates the precipitation of a row with respect to the orography
+and the parameters, for the discrete adjoint of the glacier model (see adjoint.py).
+"""
+
+import hashlib
+import os
+
+import numpy as np
+from scipy import fft
+
+from linear_orog_precip import LTOP
+
+
+def ltop_model(constants, padding=None):
+    """An LTOP object from the glacier model's `ltop_constants` dict (lat, tau_c, tau_f,
+    Nm, Cw, Hw, u, v, P0, P_scale).
+
+    `padding` : fixed padding width [m], see `LTOP.padding`
+    """
+    model = LTOP()
+    model.latitude = constants["lat"]
+    model.tau_c = constants["tau_c"]
+    model.tau_f = constants["tau_f"]
+    model.Nm = constants["Nm"]
+    model.Hw = constants["Hw"]
+    model.P0 = constants["P0"]
+    model.P_scale = constants["P_scale"]
+    # LTOP derives Cw from the reference density
+    model.rho_Sref = constants["Cw"] * model.gamma / model.Theta_m
+    model.speed = np.hypot(constants["u"], constants["v"])
+    model.direction = np.degrees(np.arctan2(-constants["u"], -constants["v"])) % 360
+    model.padding = padding
+    model.update()
+    return model
+
+
+class PrecipitationOperator(object):
+    """Precipitation in mm/hour along a row of orography, as A @ orography followed by
+    `LTOP._finish`.
+
+    `model` : LTOP object holding the parameters
+    `matrix` : n x n numpy array
+    """
+
+    def __init__(self, model, matrix):
+        self.model = model
+        self.matrix = matrix
+
+    def __call__(self, orography, truncate=True):
+        return self.model._finish(self.matrix @ np.asarray(orography, dtype=float), truncate)
+
+
+def kernel_matrix(model, n, dx):
+    "The matrix of the zero-padded linear response from its circulant kernel."
+    before, after = model._pad_widths(n, dx, True)
+    N = n + before + after
+
+    kx = fft.rfftfreq(N, dx / (2 * np.pi))[np.newaxis, :]
+    T = model._transfer(kx, np.zeros_like(kx))
+    k = fft.irfft(T[0], n=N)
+
+    i = np.arange(n)
+    return k[(i[:, np.newaxis] - i[np.newaxis, :]) % N]
+
+
+def impulse_matrix(model, n, dx):
+    "The matrix of the linear response, built by applying LTOP to unit impulses."
+    widths = model._pad_widths(n, dx, True)
+    modes = {"constant": "constant", "reflect": "reflect", "taper": "linear_ramp"}
+    if model.pad_mode not in modes:
+        raise ValueError("unknown padding mode '{}'".format(model.pad_mode))
+
+    # row j of the padded identity is the impulse at j
+    h = np.pad(np.eye(n), ((0, 0), widths), modes[model.pad_mode])
+    N = h.shape[1]
+
+    kx = fft.rfftfreq(N, dx / (2 * np.pi))[np.newaxis, :]
+    T = model._transfer(kx, np.zeros_like(kx))
+    P = fft.irfft(fft.rfft(h, axis=-1) * T, n=N, axis=-1)[:, widths[0]:widths[0] + n]
+
+    return P.T
+
+
+def cache_key(model, n, dx):
+    "Hash of everything the operator matrix depends on."
+    model.update()
+    settings = (n, float(dx), model.pad_mode, model.padding_width(),
+                model.single_precision, model.f, model.u, model.v, model.Cw, model.Nm,
+                model.Hw, model.tau_c, model.tau_f)
+    return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+
+def precipitation_operator(model, n, dx, cache_dir=None):
+    """The precipitation operator of a row of `n` points with spacing `dx`.
+
+    `cache_dir` : directory to load the matrix from and save it to
+    """
+    model.update()
+
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "ltop_{}.npz".format(cache_key(model, n, dx)))
+        if os.path.exists(filename):
+            return PrecipitationOperator(model, np.load(filename)["matrix"])
+
+    if model.pad_mode == "constant":
+        matrix = kernel_matrix(model, n, dx)
+    else:
+        matrix = impulse_matrix(model, n, dx)
+
+    if filename is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first, so that concurrent runs never read a partial one
+        tmp = "{}.{}.tmp.npz".format(filename[:-4], os.getpid())
+        np.savez(tmp, matrix=matrix)
+        os.replace(tmp, filename)
+
+    return PrecipitationOperator(model, matrix)
+
+
+def operator_error(model, orography, dx, truncate=True):
+    """Largest difference [mm/hour] between the operator and `LTOP.run` for a row of
+    orography, relative to the largest precipitation."""
+    orography = np.asarray(orography, dtype=float)
+    P_run = model.run(orography[np.newaxis, :], dx, dx, truncate)[0]
+    P_op = precipitation_operator(model, len(orography), dx)(orography, truncate)
+    return np.max(np.fabs(P_op - P_run)) / max(np.max(np.fabs(P_run)), 1e-300)
+
+
+class Linearization(object):
+    """Derivatives of the precipitation of a row of orography at one orography and set
+    of parameters, for reverse mode (adjoint) differentiation.
+
+    `make_model` : function returning the LTOP object of a dict of parameters (e.g.
+                   `ltop_model`). It has to keep the padding fixed, since the padding
+                   width otherwise jumps with the parameters.
+    `parameters` : dict of parameters
+    `orography` : row of orography
+    `dx` : spacing
+    `operator` : the PrecipitationOperator of the parameters (built if None)
+
+    The derivative with respect to the orography is exact; the truncation counts where
+    it is not active. Derivatives with respect to the parameters are central differences
+    of the untruncated `LTOP.run`, with steps of 1e-6 times the parameter (1e-6 for a
+    parameter that is zero).
+    """
+
+    def __init__(self, make_model, parameters, orography, dx, operator=None, truncate=True):
+        self.make_model = make_model
+        self.parameters = dict(parameters)
+        self.orography = np.array(orography, dtype=float)
+        self.dx = dx
+
+        model = make_model(self.parameters)
+        if operator is None:
+            operator = precipitation_operator(model, len(self.orography), dx)
+        self.matrix = operator.matrix
+        # see LTOP._finish
+        self.scale = 3600 * model.P_scale
+        self.active = np.ones(len(self.orography), dtype=bool)
+        if truncate:
+            self.active = 3600 * (self.matrix @ self.orography) + model.P0 > 0
+
+    def response(self, parameters):
+        "Untruncated precipitation for other parameters."
+        model = self.make_model(parameters)
+        return model.run(self.orography[np.newaxis, :], self.dx, self.dx, truncate=False)[0]
+
+    def adjoint(self, dual, names=()):
+        """The dual vector of the orography, and a dict of the derivatives with respect to
+        the parameters `names`, given the dual vector of the precipitation (the derivative
+        of a function of it)."""
+        dual = np.where(self.active, dual, 0.0)
+        orography = self.scale * (self.matrix.T @ dual)
+
+        derivatives = {}
+        for name in names:
+            value = self.parameters[name]
+            h = 1e-6 * (abs(value) or 1.0)
+            up = dict(self.parameters, **{name: value + h})
+            down = dict(self.parameters, **{name: value - h})
+            derivatives[name] = float(dual @ (self.response(up) - self.response(down))) / (2 * h)
+        return orography, derivatives
+
+
+def taylor_test(make_model, parameters, orography, dx, names, h=1.0, levels=4, seed=0,
+                truncate=False):
+    """Check `Linearization` by the Taylor remainder of J = w . P for random weights w,
+    which has to decrease at second order in h. The orography is perturbed by up to 10 m
+    times h and every parameter in `names` by 1 % times h (0.01 times h if it is zero).
+    The truncation is off by default: where the precipitation crosses zero it has a kink,
+    which makes the remainders irregular.
+
+    Returns the remainders and their observed orders.
+    """
+    rng = np.random.RandomState(seed)
+    orography = np.asarray(orography, dtype=float)
+    weights = rng.randn(len(orography))
+    d_orography = 10.0 * rng.uniform(-1, 1, len(orography))
+    d_parameters = {name: 0.01 * (abs(parameters[name]) or 1.0) * rng.choice([-1, 1])
+                    for name in names}
+
+    def functional(step):
+        p = dict(parameters)
+        for name in names:
+            p[name] += step * d_parameters[name]
+        model = make_model(p)
+        return weights @ model.run((orography + step * d_orography)[np.newaxis, :], dx, dx,
+                                   truncate)[0]
+
+    J0 = functional(0.0)
+    dual_orography, derivatives = Linearization(make_model, parameters, orography, dx,
+                                                truncate=truncate).adjoint(weights, names)
+    dJ = dual_orography @ d_orography + sum(derivatives[k] * d_parameters[k] for k in names)
+
+    remainders = [abs(functional(h / 2**k) - J0 - h / 2**k * dJ) for k in range(levels)]
+    orders = [np.log(remainders[k - 1] / remainders[k]) / np.log(2) for k in range(1, levels)]
+    return remainders, orders
+
+
+if __name__ == "__main__":
+    import time
+
+    model = LTOP()
+    model.latitude = 0.0
+    x = np.arange(-75e3, 75e3 + 300.0, 300.0)
+    orography = 2500 * np.exp(-x**2 / (2 * 15e3**2))
+    dx = x[1] - x[0]
+
+    start = time.time()
+    operator = precipitation_operator(model, len(x), dx)
+    build = time.time() - start
+
+    start = time.time()
+    for k in range(100):
+        operator(orography)
+    apply = (time.time() - start) * 10
+
+    start = time.time()
+    for k in range(100):
+        model.run(orography[np.newaxis, :], dx, dx)
+    run = (time.time() - start) * 10
+
+    print("error      build [s]  apply [ms]  run [ms]")
+    print("{:9.2e} {:10.3f} {:11.3f} {:9.3f}".format(
+        operator_error(model, orography, dx), build, apply, run))
+
+    # Derivatives at the glacier model's LTOP parameters, with the padding kept fixed
+    constants = dict(lat=0.0, tau_c=750.0, tau_f=750.0, Nm=0.005, Cw=0.0083, Hw=3000.0,
+                     u=7.5, v=0.0, P0=0.0, P_scale=8.0)
+    # half a cell below the width, so that the cells of the padding come out the same
+    padding = (ltop_model(constants)._pad_widths(len(x), dx, True)[0] - 0.5) * dx
+    names = ["lat", "tau_c", "tau_f", "Nm", "Cw", "Hw", "u", "P0", "P_scale"]
+    remainders, orders = taylor_test(lambda c: ltop_model(c, padding), constants, orography,
+                                     dx, names, h=0.125, levels=5)
+    print("\nTaylor remainders: {}".format(", ".join("{:.3e}".format(r) for r in remainders)))
+    print("Observed orders: {} (2 expected)".format(", ".join("{:.2f}".format(o) for o in orders)))
@@ -0,0 +1,211 @@
+"""Verification of the LTOP model against exact solutions.
+
+Two analytic cases are available, both for zero conversion time, zero water vapor scale
+height and no Coriolis force, where the precipitation is the upslope condensation source
+carried downwind by the fallout time:
+
+- "triangle": the triangle ridge of `linear_orog_precip.triangle_ridge` (truncated
+  solution, second order convergence expected),
+- "gaussian": the Gaussian bump of `linear_orog_precip.gaussian_bump` (untruncated
+  solution; the FFT solution is spectrally accurate, so errors stay at the level set by the
+  padding and domain size).
+
+Every (case, spacing, direction) combination runs in a process pool. The result is a table
+of errors, observed orders and timings that can be printed or checked without a display:
+
+    python ltop_verification.py --spacings 2000 1000 500 250
+"""
+
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.special import erfc, erfcx
+
+from linear_orog_precip import LTOP, gaussian_bump, triangle_ridge_solution
+
+cases = ("triangle", "gaussian")
+
+directions = (0, 90, 180, 270)
+
+wind_direction = {0: "north", 90: "east", 180: "south", 270: "west"}
+
+min_order = 1.9
+"Smallest acceptable observed order for the triangle ridge"
+
+max_relative_error = 1e-5
+"Largest acceptable error relative to max(abs(P)) for the Gaussian bump"
+
+
+def gaussian_bump_exact(t, s, u, Cw, tau, h_max=500.0, t0=-25e3, s0=0.0, sigma_t=15e3,
+                        sigma_s=15e3):
+    """The exact (untruncated) precipitation corresponding to the Gaussian bump.
+
+    `t` : along-wind coordinate (increasing downwind)
+    `s` : cross-wind coordinate
+    `t0`, `s0`, `sigma_t`, `sigma_s` : center and widths of the bump in these coordinates
+
+    The condensation source Cw u dh/dt is convolved with the fallout kernel
+    exp(-t / (u tau)) / (u tau), which has a closed form in terms of erfc.
+    """
+    Ut = u * tau
+    z = np.asarray(t) - t0
+
+    # exp(sigma_t**2 / (2 Ut**2) - z / Ut) * erfc(a), evaluated without overflow
+    a = (sigma_t / Ut - z / sigma_t) / np.sqrt(2)
+    E = np.where(a >= 0,
+                 erfcx(np.maximum(a, 0)) * np.exp(-z**2 / (2 * sigma_t**2)),
+                 np.exp(sigma_t**2 / (2 * Ut**2) - np.maximum(z, sigma_t**2 / Ut) / Ut) *
+                 erfc(np.minimum(a, 0)))
+
+    h = h_max * np.exp(-z**2 / (2 * sigma_t**2))
+    profile = h / Ut - h_max * sigma_t * np.sqrt(np.pi / 2) * E / Ut**2
+
+    return 3600 * Cw * u * np.exp(-(np.asarray(s) - s0)**2 / (2 * sigma_s**2)) * profile
+
+
+def model_for(direction):
+    "LTOP model set up for the exact solutions."
+    model = LTOP()
+    model.tau_c = 0.0
+    model.Hw = 0.0
+    model.direction = direction
+    model.latitude = 0.0
+    model.update()
+    return model
+
+
+def triangle_error(spacing, direction):
+    "Maximum error [mm hr-1] for the triangle ridge, and the maximum exact precipitation."
+    P, P_exact = triangle_ridge_solution(spacing, direction)
+
+    return np.max(np.fabs(P - P_exact)), np.max(np.fabs(P_exact))
+
+
+def gaussian_error(spacing, direction, x0=-25e3, y0=0.0):
+    "Maximum error [mm hr-1] for the Gaussian bump, and the maximum exact precipitation."
+    model = model_for(direction)
+
+    X, Y, orography = gaussian_bump(-100e3, 200e3, -150e3, 150e3, spacing, spacing,
+                                    x0=x0, y0=y0)
+    P = model.run(orography, spacing, spacing, truncate=False)
+
+    # along-wind and cross-wind coordinates and the bump center in them
+    t, s, t0, s0 = {0: (-Y, X, -y0, x0),
+                    90: (-X, Y, -x0, y0),
+                    180: (Y, X, y0, x0),
+                    270: (X, Y, x0, y0)}[direction]
+
+    P_exact = gaussian_bump_exact(t, s, model.speed, model.Cw, model.tau_f, t0=t0, s0=s0)
+
+    return np.max(np.fabs(P - P_exact)), np.max(np.fabs(P_exact))
+
+
+def run_case(case, spacing, direction):
+    "Run one verification case and return a row of the results table."
+    error = {"triangle": triangle_error, "gaussian": gaussian_error}[case]
+
+    start = time.time()
+    max_error, P_max = error(spacing, direction)
+    elapsed = time.time() - start
+
+    return dict(case=case, spacing=spacing, direction=direction, error=max_error,
+                relative_error=max_error / P_max, time=elapsed)
+
+
+def observed_orders(rows):
+    """Add observed orders to the rows: `order` between each spacing and the next coarser
+    one, and `fit_order` fitted over all spacings of the same case and direction."""
+    groups = {}
+    for row in rows:
+        groups.setdefault((row["case"], row["direction"]), []).append(row)
+
+    for group in groups.values():
+        group.sort(key=lambda row: -row["spacing"])
+
+        dxs = np.array([row["spacing"] for row in group], dtype=float)
+        errors = np.array([row["error"] for row in group])
+
+        fit = np.polyfit(np.log10(dxs), np.log10(errors), 1)[0] if len(group) > 1 else np.nan
+
+        for k, row in enumerate(group):
+            row["fit_order"] = fit
+            if k == 0:
+                row["order"] = np.nan
+            else:
+                row["order"] = (np.log(errors[k - 1] / errors[k]) /
+                                np.log(dxs[k - 1] / dxs[k]))
+
+    return rows
+
+
+def verification_table(spacings=(2000, 1000, 500, 250), directions=directions, cases=cases,
+                       processes=None):
+    """Run the spacing x direction matrix for each case in a process pool.
+
+    `processes` : size of the pool (None uses all CPUs, 0 runs serially)
+
+    Returns a list of dicts with keys case, spacing, direction, error, relative_error,
+    time, order and fit_order.
+    """
+    jobs = [(case, spacing, direction)
+            for case in cases for direction in directions for spacing in spacings]
+
+    if processes == 0:
+        rows = [run_case(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            rows = list(pool.map(run_case, *zip(*jobs)))
+
+    return observed_orders(rows)
+
+
+def format_table(rows):
+    "Format the results of `verification_table` as text."
+    lines = ["{:>9} {:>6} {:>9} {:>12} {:>12} {:>6} {:>6} {:>8}".format(
+        "case", "wind", "dx [m]", "error", "rel. error", "order", "fit", "time [s]")]
+
+    for row in rows:
+        lines.append("{:>9} {:>6} {:9.1f} {:12.3e} {:12.3e} {:6.2f} {:6.2f} {:8.3f}".format(
+            row["case"], wind_direction.get(row["direction"], row["direction"]),
+            row["spacing"], row["error"], row["relative_error"], row["order"],
+            row["fit_order"], row["time"]))
+
+    return "\n".join(lines)
+
+
+def check(rows):
+    """Assert that the triangle ridge converges at second order and that the Gaussian bump
+    errors are at the round-off/padding level."""
+    for row in rows:
+        if row["case"] == "triangle":
+            assert row["fit_order"] > min_order, (
+                "triangle ridge, wind from the {}: order {:.2f}".format(
+                    wind_direction.get(row["direction"]), row["fit_order"]))
+        elif row["case"] == "gaussian":
+            assert row["relative_error"] < max_relative_error, (
+                "Gaussian bump, wind from the {}, dx = {}: relative error {:.3e}".format(
+                    wind_direction.get(row["direction"]), row["spacing"],
+                    row["relative_error"]))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Verify LTOP against exact solutions.")
+    parser.add_argument("--spacings", type=float, nargs="+", default=[2000, 1000, 500, 250],
+                        help="Grid spacings [m]")
+    parser.add_argument("--directions", type=float, nargs="+", default=list(directions),
+                        choices=directions, help="Wind directions [degrees]")
+    parser.add_argument("--cases", nargs="+", default=list(cases), choices=cases,
+                        help="Exact solutions to compare to")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of processes (0 runs serially)")
+    options = parser.parse_args()
+
+    start = time.time()
+    rows = verification_table(options.spacings, options.directions, options.cases,
+                              options.processes)
+    print(format_table(rows))
+    print("total time {:.2f} s".format(time.time() - start))
+
+    check(rows)
@@ -0,0 +1,23 @@
+"""The MPI communicator the model scripts build their meshes and files on.
+
+By default this is MPI_COMM_WORLD. The ensemble launcher (ensemble.py) sets it to a
+sub-communicator before running a member, so that the member's mesh, solvers and HDF5
+files live on that sub-communicator only.
+"""
+
+_comm = None
+
+
+def get_comm():
+    "The communicator for meshes and files (MPI_COMM_WORLD unless set)."
+    if _comm is None:
+        from mpi4py import MPI
+
+        return MPI.COMM_WORLD
+    return _comm
+
+
+def set_comm(comm):
+    "Use `comm` for the meshes and files created from now on (None resets)."
+    global _comm
+    _comm = comm
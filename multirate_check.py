@@ -0,0 +1,132 @@
+"""Long-run comparison of multi-rate stepping with lockstep stepping in the sediment model.
+
+Runs sediment_higherorder_flowline.py once in lockstep (--substeps 1) and once per
+multi-rate setting (every --substeps value for every --fast subsystem, and optionally
+--adaptive_substeps), concurrently (see --processes). Every run writes its diagnostics
+table at every step. The ice volume, sediment volume and grounding line position of
+each multi-rate run are compared with the lockstep run, interpolated linearly in time
+onto the times of the multi-rate run:
+
+- drift: largest difference over the run, and the difference at the end, relative to
+  the largest lockstep value for the volumes and in meters for the grounding line
+- cost: wall time, and the speed-up over lockstep
+
+Multi-rate stepping stays behind --unvalidated_multirate in the model until this
+comparison has been run over a long run (the model default is 10000 years) on each
+geometry and its drift is acceptable.
+
+    python multirate_check.py --substeps 2 4 8 --fast ice sed --adaptive \\
+        --args "--geometry 1sided" --processes 8
+"""
+
+import itertools
+import os
+import shlex
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+model_script = os.path.join(here, "sediment_higherorder_flowline.py")
+
+quantities = [("volume", "rel"), ("sediment_volume", "rel"), ("gl_position", "m")]
+
+
+def run_name(substeps, fast, adaptive):
+    if substeps == 1 and not adaptive:
+        return "lockstep"
+    return "{}_{}".format(fast, "adaptive" if adaptive else substeps)
+
+
+def run_model(substeps, fast, adaptive, args, work_dir):
+    """Run one setting and return (wall time, diagnostics table as a dict of columns), or
+    None if the run failed."""
+    name = run_name(substeps, fast, adaptive)
+    cmd = [sys.executable, model_script, "--headless", "--diag_interval", "1", "--diag_file",
+           name + ".txt", "--substeps", str(substeps), "--fast", fast]
+    if adaptive:
+        cmd += ["--adaptive_substeps"]
+    if substeps > 1 or adaptive:
+        cmd += ["--unvalidated_multirate"]
+    cmd += args
+
+    start = time.time()
+    env = dict(os.environ, MPLBACKEND="Agg")
+    with open(os.path.join(work_dir, name + ".log"), "w") as log:
+        result = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, cwd=work_dir,
+                                env=env)
+    elapsed = time.time() - start
+
+    if result.returncode != 0:
+        print("{} failed, see {}.log".format(name, os.path.join(work_dir, name)), flush=True)
+        return None
+    print("{} done after {:.1f} s".format(name, elapsed), flush=True)
+    return elapsed, read_table(os.path.join(work_dir, name + ".txt"))
+
+
+def read_table(filename):
+    "The diagnostics table of a run as a dict of columns."
+    with open(filename) as f:
+        header = f.readline().lstrip("#").split()
+    values = np.atleast_2d(np.loadtxt(filename))
+    return dict(zip(header, values.T))
+
+
+def drift(table, lockstep, quantity, unit):
+    """Largest and final difference of a quantity from lockstep, on the times of `table`
+    (relative to the largest lockstep value if `unit` is "rel")."""
+    reference = np.interp(table["t"], lockstep["t"], lockstep[quantity])
+    difference = np.fabs(table[quantity] - reference)
+    if unit == "rel":
+        difference = difference / max(np.nanmax(np.fabs(lockstep[quantity])), 1e-300)
+    if not np.isfinite(difference).any():
+        return np.nan, np.nan
+    return float(np.nanmax(difference)), float(difference[-1])
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compare multi-rate with lockstep stepping.",
+                            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--substeps", type=int, nargs="+", default=[2, 4, 8],
+                        help="Numbers of sub-steps per macro step")
+    parser.add_argument("--fast", nargs="+", choices=["ice", "sed"], default=["ice", "sed"],
+                        help="Subsystems that take the sub-steps")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Also run --adaptive_substeps for every --fast subsystem")
+    parser.add_argument("--args", default="", help="Further model arguments for every run")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="Number of runs at a time")
+    parser.add_argument("--work_dir", default="multirate")
+    options = parser.parse_args()
+
+    os.makedirs(options.work_dir, exist_ok=True)
+    args = shlex.split(options.args)
+    settings = [(1, "ice", False)]
+    settings += [(n, fast, False)
+                 for fast, n in itertools.product(options.fast, sorted(set(options.substeps)))
+                 if n > 1]
+    if options.adaptive:
+        settings += [(1, fast, True) for fast in options.fast]
+
+    with ThreadPoolExecutor(options.processes) as pool:
+        futures = {s: pool.submit(run_model, *s, args, options.work_dir) for s in settings}
+        runs = {s: f.result() for s, f in futures.items()}
+
+    if runs[settings[0]] is None:
+        sys.exit("the lockstep run failed, no reference")
+    lockstep_time, lockstep = runs[settings[0]]
+
+    print("\nDrift from lockstep over {:g} years (max / final)".format(lockstep["t"][-1]))
+    print("{:>14s} {:>9s} {:>8s} ".format("run", "time [s]", "speed-up")
+          + " ".join("{:>23s}".format("{} [{}]".format(q, unit)) for q, unit in quantities))
+    for s in settings[1:]:
+        if runs[s] is None:
+            continue
+        elapsed, table = runs[s]
+        print("{:>14s} {:9.1f} {:8.2f} ".format(run_name(*s), elapsed, lockstep_time / elapsed)
+              + " ".join("{:11.3e} {:11.3e}".format(*drift(table, lockstep, q, unit))
+                         for q, unit in quantities))
@@ -0,0 +1,202 @@
+"""Surface mass balance from the linear theory of orographic precipitation (LTOP).
+
+`OrographicSMB` owns one Function that the model forms use as the SMB and updates its
+values in place. Precipitation is recomputed only when the surface has changed by more
+than `threshold` (maximum norm) since the last computation, when the LTOP parameters
+have changed (e.g. by a wind forcing), or when the last computation is `max_age` updates
+old. In between, the SMB of the last computation is reused. At every recomputation, the
+change of the SMB is recorded as the error that reusing it incurred.
+
+On a fixed mesh, the linear LTOP response can be precomputed as a matrix (see
+ltop_operator), so that each recomputation is a matrix-vector product.
+
+For the discrete adjoint, `adjoint()` differentiates the last computation with respect to
+the surface and the LTOP parameters (see ltop_operator.Linearization). The SMB is then
+recomputed at every update (`update(force=True)`) and the padding is kept fixed
+(`fixed_padding`), so that it is a differentiable function of both.
+"""
+
+import logging
+
+import numpy as np
+from dolfin import Function, project
+from mpi4py import MPI
+
+import ltop_operator
+from ltop_operator import ltop_model
+
+logger = logging.getLogger("OrographicSMB")
+
+mm_per_hour_to_m_per_year = 24 * 365.25 / 1000.0
+
+
+class LTOPParameter(object):
+    """One entry of the ltop_constants dict as a control of the discrete adjoint (see
+    adjoint.py), used like a dolfin Constant."""
+
+    def __init__(self, constants, name):
+        self.constants = constants
+        self.name = name
+
+    def __float__(self):
+        return float(self.constants[self.name])
+
+    def assign(self, value):
+        self.constants[self.name] = float(value)
+
+
+def interpolation_matrix(x, xp):
+    "The matrix of np.interp(x, xp, values) as a function of the values (xp increasing)."
+    return np.column_stack([np.interp(x, xp, e) for e in np.eye(len(xp))])
+
+
+class OrographicSMB(object):
+    """Orographic precipitation [m year-1] along a flowline as the SMB.
+
+    `Q` : scalar function space of the SMB
+    `surface` : UFL expression of the surface elevation
+    `constants` : the ltop_constants dict; read at every update, so changes (e.g. of the
+                  wind) take effect at the next update
+    `threshold` : surface change [m] (maximum norm) that triggers a recomputation
+    `max_age` : number of updates after which the SMB is recomputed in any case
+    `operator` : "fft" (LTOP.run) or "dense" (precomputed LTOP operator)
+    `cache_dir` : directory where precomputed operators are cached
+    `fixed_padding` : keep the padding of the first computation, instead of the padding
+                      of the current parameters
+    """
+
+    def __init__(self, Q, surface, constants, threshold=10.0, max_age=50, operator="fft",
+                 cache_dir=None, fixed_padding=False):
+        self.Q = Q
+        self.surface = surface
+        self.constants = constants
+        self.threshold = threshold
+        self.max_age = max_age
+        self.operator = operator
+        self.cache_dir = cache_dir
+        self.fixed_padding = fixed_padding
+        self.padding = None
+        self.operators = {}
+        self.parameters = {}
+
+        self.smb = Function(Q)
+        self.precipitation = np.zeros(self.smb.vector().local_size())
+
+        # LTOP is non-local, so every process works with the whole flowline
+        self.comm = Q.mesh().mpi_comm()
+        self.x_local = Q.tabulate_dof_coordinates().reshape((-1,))
+        sizes = self.comm.allgather(len(self.x_local))
+        self.x = np.concatenate(self.comm.allgather(self.x_local))
+        self.offset = sum(sizes[:self.comm.rank])
+        # LTOP needs a regular grid: precipitation is computed on a grid with the spacing
+        # of the mesh and interpolated to the degrees of freedom
+        self.grid = np.linspace(self.x.min(), self.x.max(), len(np.unique(self.x)))
+
+        self.last_surface = None
+        self.last_constants = None
+        self.age = 0
+        self.updates = 0
+        self.recomputes = 0
+        self.max_error = 0.0
+
+    def model(self, constants):
+        "The LTOP object of a dict of parameters, with the padding fixed if it is."
+        dx = self.grid[1] - self.grid[0]
+        if self.fixed_padding and self.padding is None:
+            before = ltop_model(constants)._pad_widths(len(self.grid), dx, True)[0]
+            # half a cell below the width, so that the cells of the padding come out the same
+            self.padding = (before - 0.5) * dx
+        return ltop_model(constants, self.padding)
+
+    def dense_operator(self, model):
+        """The precomputed operator of an LTOP object. The matrix is cached; P0 and
+        P_scale do not enter it, so they are taken from `model`."""
+        dx = self.grid[1] - self.grid[0]
+        key = ltop_operator.cache_key(model, len(self.grid), dx)
+        if key not in self.operators:
+            self.operators[key] = ltop_operator.precipitation_operator(
+                model, len(self.grid), dx, self.cache_dir).matrix
+        return ltop_operator.PrecipitationOperator(model, self.operators[key])
+
+    def orography(self, surface):
+        "The (global) surface interpolated to the grid."
+        order = np.argsort(self.x)
+        return np.interp(self.grid, self.x[order], surface[order])
+
+    def run(self, surface):
+        "Precipitation [m year-1] at the local degrees of freedom for the (global) surface."
+        model = self.model(self.constants)
+        orography = self.orography(surface)[np.newaxis, :]
+        dx = self.grid[1] - self.grid[0]
+        if self.operator == "fft":
+            P = model.run(orography, dx, dx, truncate=True)[0]
+        else:
+            P = self.dense_operator(model)(orography[0])
+        return np.interp(self.x_local, self.grid, P) * mm_per_hour_to_m_per_year
+
+    def update(self, force=False):
+        """Recompute the SMB if needed. Returns True if it was recomputed."""
+        self.updates += 1
+        self.age += 1
+
+        local = project(self.surface, self.Q).vector().get_local()
+        surface = np.concatenate(self.comm.allgather(local))
+        constants = dict(self.constants)
+        if not (force or self.last_surface is None or self.age >= self.max_age
+                or constants != self.last_constants
+                or np.max(np.fabs(surface - self.last_surface)) > self.threshold):
+            return False
+
+        P = self.run(surface)
+        if self.last_surface is not None:
+            error = self.comm.allreduce(np.max(np.fabs(P - self.precipitation), initial=0.0),
+                                        op=MPI.MAX)
+            self.max_error = max(self.max_error, error)
+            logger.info("recomputed after %d updates; SMB change %.3e m year-1",
+                        self.age, error)
+
+        self.precipitation = P
+        self.smb.vector().set_local(P)
+        self.smb.vector().apply("insert")
+        self.last_surface = surface
+        self.last_constants = constants
+        self.age = 0
+        self.recomputes += 1
+        return True
+
+    def parameter(self, name):
+        "The LTOP parameter `name` as a control of the adjoint."
+        if name not in self.parameters:
+            self.parameters[name] = LTOPParameter(self.constants, name)
+        return self.parameters[name]
+
+    def adjoint(self):
+        """The adjoint of the last computation, for adjoint.Tape.external: a function that
+        maps the dual vector of the SMB (local values) to the dual vector of the surface
+        (local values) and a dict of the derivatives with respect to the parameters
+        requested by `parameter`."""
+        dx = self.grid[1] - self.grid[0]
+        model = self.model(self.last_constants)
+        linearization = ltop_operator.Linearization(
+            self.model, self.last_constants, self.orography(self.last_surface), dx,
+            self.dense_operator(model))
+        order = np.argsort(self.x)
+        to_grid = interpolation_matrix(self.grid, self.x[order])
+        from_grid = interpolation_matrix(self.x_local, self.grid)
+
+        def adjoint(dual):
+            # every process holds part of the SMB, but the whole precipitation
+            dual_P = self.comm.allreduce(from_grid.T @ dual * mm_per_hour_to_m_per_year,
+                                         op=MPI.SUM)
+            dual_orography, derivatives = linearization.adjoint(dual_P, list(self.parameters))
+            dual_surface = np.empty(len(self.x))
+            dual_surface[order] = to_grid.T @ dual_orography
+            local = dual_surface[self.offset:self.offset + len(self.x_local)]
+            return local, {self.parameters[k]: v for k, v in derivatives.items()}
+
+        return adjoint
+
+    def report(self):
+        return ("Orographic SMB: {} recomputations in {} updates, largest SMB change "
+                "at a recomputation {:.3e} m year-1".format(
+                    self.recomputes, self.updates, self.max_error))
@@ -0,0 +1,140 @@
+"""Output scheduling with per-group intervals and event-triggered dense output.
+
+Every output group (e.g. fields, scalars, checkpoints) has its own interval, in model
+years or in time steps. When an event trigger fires, the groups with a dense interval
+use that interval instead until `window` model years have passed since the last event.
+This keeps the output sparse during quiet periods but resolves the transitions
+(grounding line crossing a position, fast volume change, solver retries, ungrounding).
+
+Triggers compare the model state of consecutive steps. The state is a dict of scalars,
+updated by the model at every step:
+
+    gl_position      grounding line position [m]
+    volume           ice volume [m3 per unit width]
+    retries          number of solver retries or failed steps so far
+    grounded         grounded area [m2 per unit width]
+
+Triggers are given as KIND[:VALUE]:
+
+    gl_crossing:X    the grounding line crosses x = X [m]
+    volume_rate:R    |d volume / dt| exceeds R [m3 year-1]
+    retries          the solver retried a step
+    ungrounding      the grounded area decreased
+"""
+
+import numpy as np
+
+
+class Group(object):
+    """Output every `interval` (0: every step, None: never) model years or steps; during
+    event windows every `dense_interval` (None: no change)."""
+
+    def __init__(self, interval, dense_interval=None, unit="years"):
+        if unit not in ("years", "steps"):
+            raise ValueError("unknown interval unit '{}'".format(unit))
+        self.interval = interval
+        self.dense_interval = dense_interval
+        self.unit = unit
+        self.last = None
+        self.count = 0
+
+    def due(self, t, step, dense):
+        "Whether the group is written at time t after `step` steps (and record it)."
+        interval = self.dense_interval if dense and self.dense_interval is not None \
+            else self.interval
+        if interval is None:
+            return False
+
+        clock = t if self.unit == "years" else step
+        if self.last is None or clock - self.last >= interval - 1e-9 * max(abs(clock), 1.0):
+            self.last = clock
+            self.count += 1
+            return True
+        return False
+
+
+class Trigger(object):
+    "Fires when `condition(previous, current, dt)` holds for the state `key`."
+
+    def __init__(self, name, key, condition):
+        self.name = name
+        self.key = key
+        self.condition = condition
+
+    def fired(self, previous, current, dt):
+        if previous is None or self.key not in current or self.key not in previous:
+            return False
+        return bool(self.condition(previous[self.key], current[self.key], dt))
+
+
+def crossing(value):
+    return lambda a, b, dt: (a - value) * (b - value) < 0 or (a != value and b == value)
+
+
+def rate_above(rate):
+    return lambda a, b, dt: dt > 0 and abs(b - a) / dt > rate
+
+
+def parse_trigger(spec):
+    "A Trigger from KIND[:VALUE] (see the module documentation)."
+    kind, _, value = spec.partition(":")
+    if kind in ("gl_crossing", "volume_rate"):
+        if not value:
+            raise ValueError("event '{}' needs a value ({}:VALUE)".format(kind, kind))
+        value = float(value)
+    if kind == "gl_crossing":
+        return Trigger(spec, "gl_position", crossing(value))
+    if kind == "volume_rate":
+        return Trigger(spec, "volume", rate_above(value))
+    if kind == "retries":
+        return Trigger(spec, "retries", lambda a, b, dt: b > a)
+    if kind == "ungrounding":
+        return Trigger(spec, "grounded", lambda a, b, dt: b < a)
+    raise ValueError("unknown event '{}' (gl_crossing:X, volume_rate:R, retries or "
+                     "ungrounding)".format(kind))
+
+
+class OutputScheduler(object):
+    """Decides which output groups are written after each step.
+
+    `groups` : dict name -> Group
+    `triggers` : list of Triggers
+    `window` : length [model years] of the dense output after an event
+    `keys` : the state keys the model provides; triggers of other keys are an error
+    """
+
+    def __init__(self, groups, triggers=(), window=0.0, keys=None):
+        self.groups = groups
+        self.triggers = list(triggers)
+        self.window = window
+        self.dense_until = -np.inf
+        self.previous = None
+        self.t_previous = None
+        self.events = []
+
+        if keys is not None:
+            for trigger in self.triggers:
+                if trigger.key not in keys:
+                    raise ValueError("event '{}' is not available in this model".format(
+                        trigger.name))
+
+    def update(self, t, step, state):
+        "Evaluate the triggers for the state after a step; returns the groups due."
+        if self.previous is not None:
+            dt = t - self.t_previous
+            for trigger in self.triggers:
+                if trigger.fired(self.previous, state, dt):
+                    self.events.append((t, trigger.name))
+                    self.dense_until = t + self.window
+                    print("Event {} at year {:.2f}: dense output until year {:.2f}".format(
+                        trigger.name, t, self.dense_until))
+        self.previous = dict(state)
+        self.t_previous = t
+
+        dense = t <= self.dense_until
+        return set(name for name, group in self.groups.items() if group.due(t, step, dense))
+
+    def report(self):
+        return "Output: {}; {} events".format(
+            ", ".join("{} {}".format(name, group.count) for name, group in self.groups.items()),
+            len(self.events))
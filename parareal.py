@@ -0,0 +1,203 @@
+"""Parareal parallel-in-time driver for sediment_higherorder_flowline.py.
+
+The time interval is split into slices. The coarse propagator G and the fine propagator F
+are both runs of the sediment model over one slice, started from and ending in a
+checkpoint file (see h5_output); they differ only in their command line arguments, e.g.
+a larger --dt_max for G. Parareal iteration k updates the slice boundary states by
+
+    U[n + 1] = G(U_new[n]) + F(U_old[n]) - G(U_old[n])
+
+where the fine runs of all slices are independent and run concurrently. The iteration
+stops when the slice boundary states change by less than a relative tolerance. Since
+iteration k reproduces the fine solution on the first k slices exactly, at most as many
+iterations as slices are needed.
+
+Both propagators must use the same mesh, because the corrections are computed on the
+degree of freedom vectors of the checkpoints.
+
+    python parareal.py --slices 8 --t_end 10000 --coarse_args "--dt_max 20" --serial
+"""
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+model_script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "sediment_higherorder_flowline.py")
+
+nonnegative = ("H", "H_", "h_s", "h_s_")
+"Fields clipped at zero after a correction (thicknesses)"
+
+not_state = ("coordinates", "rng_keys")
+"Datasets of a checkpoint that are not part of the model state"
+
+
+def run_model(args, t_end, init_file, out_file):
+    """Run the model up to `t_end`, starting from `init_file` (None starts from the
+    initial state at t = 0), and write the final state to `out_file`.
+
+    Returns the wall time of the run.
+    """
+    cmd = [sys.executable, model_script, "--headless", "-e", repr(float(t_end)),
+           "--checkpoint", out_file, "--checkpoint_interval", "0", "--diag_file",
+           os.path.splitext(out_file)[0] + ".txt"]
+    if init_file is not None:
+        cmd += ["-i", init_file]
+    cmd += args
+
+    start = time.time()
+    with open(os.path.splitext(out_file)[0] + ".log", "w") as log:
+        subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, check=True)
+    return time.time() - start
+
+
+def read_state(filename):
+    "Model state (field name -> degree of freedom values) of a checkpoint."
+    with h5py.File(filename, "r") as inp:
+        return {name: inp[name][:] for name in inp if name not in not_state}
+
+
+def write_state(filename, template, state):
+    """Write a checkpoint with the fields of `state` and everything else (time, time step,
+    random state, ...) from the checkpoint `template`."""
+    tmp = filename + ".tmp"
+    shutil.copyfile(template, tmp)
+    with h5py.File(tmp, "r+") as out:
+        for name, values in state.items():
+            if name in nonnegative:
+                values = np.maximum(values, 0.0)
+            out[name][...] = values
+    os.replace(tmp, filename)
+
+
+def state_change(new, old):
+    "Largest relative change of any field between two states."
+    return max(np.linalg.norm(new[name] - old[name]) / max(np.linalg.norm(new[name]), 1e-16)
+               for name in new)
+
+
+def parareal(t_end, slices, coarse_args, fine_args, work_dir, processes=None, tol=1e-3,
+             max_iterations=None):
+    """Run Parareal over [0, t_end].
+
+    `processes` : number of concurrent fine runs (None: one per slice)
+
+    Returns the checkpoint file of the final state and a dict with the number of
+    iterations, the wall time, the time spent in coarse and fine runs and the sum of
+    the fine run times of the first iteration (an estimate of the serial run time).
+    """
+    if max_iterations is None:
+        max_iterations = slices
+    os.makedirs(work_dir, exist_ok=True)
+    t = np.linspace(0.0, t_end, slices + 1)
+
+    def path(kind, k, n):
+        return os.path.join(work_dir, "{}_{:02d}_{:03d}.h5".format(kind, k, n))
+
+    stats = dict(iterations=0, coarse=0.0, fine=0.0, fine_serial=0.0)
+    start = time.time()
+
+    # U[n]: state at t[n] of the current iterate (None is the initial state)
+    U = [None] + [path("U", 0, n) for n in range(1, slices + 1)]
+    G_old = [None] * (slices + 1)
+
+    # Initial guess: one serial coarse sweep
+    for n in range(slices):
+        stats["coarse"] += run_model(coarse_args, t[n + 1], U[n], U[n + 1])
+        G_old[n + 1] = U[n + 1]
+
+    with ThreadPoolExecutor(max_workers=processes or slices) as pool:
+        for k in range(1, max_iterations + 1):
+            stats["iterations"] = k
+
+            # Fine runs on all slices that are not converged yet (the first k - 1 slices
+            # are exact after k - 1 iterations)
+            F = [None] * (slices + 1)
+            jobs = {n: pool.submit(run_model, fine_args, t[n + 1], U[n], path("F", k, n + 1))
+                    for n in range(k - 1, slices)}
+            for n, job in jobs.items():
+                elapsed = job.result()
+                stats["fine"] += elapsed
+                if k == 1:
+                    stats["fine_serial"] += elapsed
+                F[n + 1] = path("F", k, n + 1)
+
+            # Serial coarse sweep with corrections
+            U_new = list(U)
+            U_new[k] = F[k]
+            change = 0.0
+            for n in range(k, slices):
+                G_new = path("G", k, n + 1)
+                stats["coarse"] += run_model(coarse_args, t[n + 1], U_new[n], G_new)
+
+                g_new, f_old, g_old = read_state(G_new), read_state(F[n + 1]), read_state(
+                    G_old[n + 1])
+                corrected = {name: g_new[name] + f_old[name] - g_old[name] for name in g_new}
+
+                U_new[n + 1] = path("U", k, n + 1)
+                write_state(U_new[n + 1], G_new, corrected)
+                change = max(change, state_change(corrected, read_state(U[n + 1])))
+                G_old[n + 1] = G_new
+
+            U = U_new
+            print("Parareal iteration {}: relative change {:.3e}".format(k, change))
+            if change < tol:
+                break
+
+    stats["wall"] = time.time() - start
+    return U[slices], stats
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.description = "Parareal driver for the sediment flowline model."
+    parser.add_argument("-e", "--t_end", dest="t_end", type=float, default=10000.0,
+                        help="End year")
+    parser.add_argument("--slices", dest="slices", type=int, default=8,
+                        help="Number of time slices")
+    parser.add_argument("--processes", dest="processes", type=int, default=None,
+                        help="Number of concurrent fine runs (default: one per slice)")
+    parser.add_argument("--coarse_args", dest="coarse_args", default="--dt_max 10",
+                        help="Model arguments of the coarse propagator")
+    parser.add_argument("--fine_args", dest="fine_args", default="",
+                        help="Model arguments of the fine propagator")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+                        help="Seed of the initial velocity perturbations (shared by all runs)")
+    parser.add_argument("--tol", dest="tol", type=float, default=1e-3,
+                        help="Relative change of the slice boundary states to stop at")
+    parser.add_argument("--max_iterations", dest="max_iterations", type=int, default=None,
+                        help="Maximum number of Parareal iterations (default: slices)")
+    parser.add_argument("--work_dir", dest="work_dir", default="parareal",
+                        help="Directory for the checkpoints and logs of all runs")
+    parser.add_argument("--serial", dest="serial", action="store_true", default=False,
+                        help="Also run the fine propagator serially and compare")
+    options = parser.parse_args()
+
+    seed = ["--seed", str(options.seed)]
+    coarse_args = shlex.split(options.coarse_args) + seed
+    fine_args = shlex.split(options.fine_args) + seed
+
+    final, stats = parareal(options.t_end, options.slices, coarse_args, fine_args,
+                            options.work_dir, options.processes, options.tol,
+                            options.max_iterations)
+
+    print("Parareal: {} iterations, wall time {:.1f} s (coarse {:.1f} s, fine {:.1f} s "
+          "summed over runs)".format(stats["iterations"], stats["wall"], stats["coarse"],
+                                     stats["fine"]))
+    print("Estimated speed-up against a serial fine run: {:.2f}".format(
+        stats["fine_serial"] / stats["wall"]))
+
+    if options.serial:
+        serial_file = os.path.join(options.work_dir, "serial.h5")
+        t_serial = run_model(fine_args, options.t_end, None, serial_file)
+        print("Serial fine run: {:.1f} s, speed-up {:.2f}, relative difference {:.3e}".format(
+            t_serial, t_serial / stats["wall"],
+            state_change(read_state(serial_file), read_state(final))))
@@ -4,23 +4,19 @@
 
 # Author: Douglas Brinkerhoff, 2021
 # License: GNU GPLv3`
-# Requires Python3 and libraries: matplotlib, fenics 2019.1, numpy
+# Requires Python3 and libraries: matplotlib, fenics 2019.1, numpy, h5py
 ####################################################################################
 ####################################################################################
 ####################################################################################
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-import matplotlib
-import dolfin as df
-import ufl
-import matplotlib.pyplot as plt
-import numpy as np
+import sys
+import time
+import json
 
-df.parameters['form_compiler']['optimize'] = True
-df.parameters['form_compiler']['cpp_optimize'] = True
-df.parameters['form_compiler']['quadrature_degree'] = 2
-df.parameters['allow_extrapolation'] = True
+import startup
 
+# Arguments first: --help and argument errors need none of the imports below
 parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
 parser.description = "Variational Inference of PDD parameters."
 parser.add_argument(
@@ -31,8 +27,355 @@ parser.add_argument(
     help="Geometry",
     default="asym",
 )
+parser.add_argument(
+    "--rebuild_solvers",
+    dest="rebuild_solvers",
+    action="store_true",
+    help="Rebuild the solvers at every time step (for timing comparisons)",
+    default=False,
+)
+parser.add_argument(
+    "-e", "--t_end", dest="t_end", type=float, help="End year", default=10000.0
+)
+parser.add_argument(
+    "--substeps",
+    dest="substeps",
+    type=int,
+    help="Number of fast sub-steps per slow (macro) step; 1 is lockstep. Values above 1 "
+    "are not yet validated against lockstep over a long run and need "
+    "--unvalidated_multirate (see multirate_check.py)",
+    default=1,
+)
+parser.add_argument(
+    "--fast",
+    dest="fast",
+    choices=["ice", "sed"],
+    help="Subsystem that takes the sub-steps: ice, or sediment/bedrock and water flux",
+    default="ice",
+)
+parser.add_argument(
+    "--adaptive_substeps",
+    dest="adaptive_substeps",
+    action="store_true",
+    help="Adapt the number of sub-steps to the change of the coupling fields "
+    "(not yet validated, see --substeps)",
+    default=False,
+)
+parser.add_argument(
+    "--unvalidated_multirate",
+    dest="unvalidated_multirate",
+    action="store_true",
+    help="Allow multi-rate stepping (--substeps above 1, --adaptive_substeps) before its "
+    "long-run comparison with lockstep stepping has been run",
+    default=False,
+)
+parser.add_argument(
+    "--max_substeps",
+    dest="max_substeps",
+    type=int,
+    help="Maximum number of sub-steps with --adaptive_substeps",
+    default=64,
+)
+parser.add_argument(
+    "--coupling_tol",
+    dest="coupling_tol",
+    type=float,
+    help="Target relative change of the coupling fields per macro step",
+    default=1e-2,
+)
+parser.add_argument(
+    "--final_state",
+    dest="final_state",
+    help="HDF5 file the final state is written to",
+    default=None,
+)
+parser.add_argument(
+    "--summary",
+    dest="summary",
+    help="JSON file for the final scalars (volumes, erosion rate) and surface profile",
+    default=None,
+)
+parser.add_argument(
+    "--nx",
+    dest="nx",
+    type=int,
+    help="Number of cells",
+    default=500,
+)
+parser.add_argument(
+    "--quad_order",
+    dest="quad_order",
+    type=int,
+    help="Number of Gauss-Legendre points of the vertical quadrature",
+    default=4,
+)
+parser.add_argument(
+    "--reference",
+    dest="reference",
+    help="HDF5 final state (see --final_state) to compare the final state with",
+    default=None,
+)
+parser.add_argument(
+    "--transport",
+    dest="transport",
+    choices=["fem", "sweep"],
+    help="Solver for the water flux: back-substitution with the LU factors of the assembled "
+    "operator, or a tridiagonal solve in the cell order (see upwind_sweep; about as fast)",
+    default="fem",
+)
+parser.add_argument(
+    "--headless",
+    "--batch",
+    dest="headless",
+    action="store_true",
+    help="Run without plotting (no display required, and no plotting imports)",
+    default=False,
+)
+parser.add_argument(
+    "--import_times",
+    dest="import_times",
+    action="store_true",
+    help="Report the time taken by each group of imports",
+    default=False,
+)
+parser.add_argument(
+    "--diag_interval",
+    dest="diag_interval",
+    type=int,
+    help="Number of time steps between diagnostics (plot update and scalar table row)",
+    default=10,
+)
+parser.add_argument(
+    "--diag_file",
+    dest="diag_file",
+    help="Text file the table of scalar diagnostics is written to (default: none)",
+    default=None,
+)
+parser.add_argument(
+    "--flush_interval",
+    dest="flush_interval",
+    type=int,
+    help="Number of diagnostic rows kept in memory before they are written to --diag_file",
+    default=100,
+)
+parser.add_argument(
+    "-i", dest="init_file", help="Checkpoint file to restart from", default=None
+)
+parser.add_argument(
+    "-o",
+    "--out_file",
+    dest="out_file",
+    help="HDF5 file for the time series of the prognostic fields",
+    default=None,
+)
+parser.add_argument(
+    "--output_interval",
+    dest="output_interval",
+    type=float,
+    help="Model time [years] between records of the time series",
+    default=100.0,
+)
+parser.add_argument(
+    "--checkpoint",
+    dest="checkpoint",
+    help="Checkpoint file, rewritten atomically every --checkpoint_interval steps "
+    "(default: none)",
+    default=None,
+)
+parser.add_argument(
+    "--checkpoint_interval",
+    dest="checkpoint_interval",
+    type=int,
+    help="Number of time steps between checkpoints (0 only writes the final state)",
+    default=100,
+)
+parser.add_argument(
+    "--coupling",
+    dest="coupling",
+    choices=["split", "iterate", "monolithic"],
+    help="Coupling of water flux, sediment and ice within a time step: one pass of the "
+    "split solves, split solves iterated to --coupling_iteration_tol, or one Newton "
+    "system for all fields",
+    default="split",
+)
+parser.add_argument(
+    "--acceleration",
+    dest="acceleration",
+    choices=["none", "aitken", "anderson"],
+    help="Acceleration of the coupling iteration (--coupling iterate)",
+    default="aitken",
+)
+parser.add_argument(
+    "--coupling_iteration_tol",
+    dest="coupling_iteration_tol",
+    type=float,
+    help="Relative change of the interface (ice) state at which the coupling iteration stops",
+    default=1e-4,
+)
+parser.add_argument(
+    "--max_coupling_iterations",
+    dest="max_coupling_iterations",
+    type=int,
+    help="Maximum number of coupling iterations before the time step is reduced",
+    default=20,
+)
+parser.add_argument(
+    "--dt_max",
+    dest="dt_max",
+    type=float,
+    help="Maximum time step [years]",
+    default=1.0,
+)
+parser.add_argument(
+    "--seed",
+    dest="seed",
+    type=int,
+    help="Seed for the random initial velocity perturbations",
+    default=None,
+)
+parser.add_argument(
+    "--event",
+    dest="events",
+    action="append",
+    metavar="KIND[:VALUE]",
+    help="Event forcing dense output (repeatable): volume_rate:R (ice volume) or retries",
+    default=[],
+)
+parser.add_argument(
+    "--dense_window",
+    dest="dense_window",
+    type=float,
+    help="Model time [years] of dense output after an event",
+    default=0.0,
+)
+parser.add_argument(
+    "--dense_interval",
+    dest="dense_interval",
+    type=float,
+    help="Model time [years] between time series records after an event (diagnostics "
+    "are then computed every step)",
+    default=0.0,
+)
+parser.add_argument(
+    "--stop",
+    dest="stop",
+    metavar="EXPRESSION",
+    help="Stop before --t_end when this holds, e.g. 'steady:1e-4:500 | wall_clock:3600' "
+    "(see termination); volume is the ice volume",
+    default=None,
+)
+parser.add_argument(
+    "--stop_file",
+    dest="stop_file",
+    help="JSON file recording why the run ended",
+    default="termination.json",
+)
+parser.add_argument(
+    "--degree",
+    dest="degree",
+    type=int,
+    help="Polynomial degree of the continuous velocity and thickness projection elements",
+    default=1,
+)
+parser.add_argument(
+    "--misfit",
+    dest="misfit",
+    choices=["thickness", "volume", "gl_position"],
+    help="Compute the gradient of this misfit with respect to beta2, be, cc, k, amin and "
+    "amax by the discrete adjoint instead of a plain run (lockstep split coupling, with "
+    "the time steps of a run without failed steps)",
+    default=None,
+)
+parser.add_argument(
+    "--obs",
+    dest="obs",
+    help="Observations for --misfit: HDF5 final state (see --final_state) for thickness, "
+    "text file with one ice volume per step for volume, text file with the final "
+    "grounding line position [m] for gl_position",
+    default=None,
+)
+parser.add_argument(
+    "--snapshots",
+    dest="snapshots",
+    type=int,
+    help="Number of states kept in memory by the adjoint",
+    default=10,
+)
+parser.add_argument(
+    "--taylor_test",
+    dest="taylor_test",
+    action="store_true",
+    help="Verify the adjoint gradient by a Taylor test; exits with an error unless the "
+    "remainders decrease at second order",
+    default=False,
+)
+parser.add_argument(
+    "--gradient",
+    dest="gradient",
+    help="HDF5 file the gradient of --misfit is written to (default: none)",
+    default=None,
+)
 options = parser.parse_args()
+multirate = options.substeps > 1 or options.adaptive_substeps
+if options.misfit is not None and (multirate or options.coupling != "split"):
+    parser.error("--misfit needs lockstep split coupling (--coupling split, no sub-steps)")
+if options.misfit == "gl_position" and options.obs is None:
+    parser.error("--misfit gl_position needs --obs")
+if multirate and options.coupling != "split":
+    parser.error("sub-stepping requires --coupling split")
+if multirate and not options.unvalidated_multirate:
+    parser.error(
+        "multi-rate stepping is not yet validated against lockstep; run "
+        "multirate_check.py first, or pass --unvalidated_multirate"
+    )
+
+timer = startup.ImportTimer()
+with timer("dolfin"):
+    import dolfin as df
+    import ufl
+with timer("numpy"):
+    import numpy as np
+with timer("model modules"):
+    import h5_output
+    import output_schedule
+    import termination
+    from mpi_comm import get_comm
+    if options.misfit is not None:
+        import adjoint as discrete_adjoint
+if options.import_times:
+    print(timer.report())
+
+df.parameters['form_compiler']['optimize'] = True
+df.parameters['form_compiler']['cpp_optimize'] = True
+df.parameters['allow_extrapolation'] = True
+
+# Exact for the products of two velocity basis functions
+df.parameters["form_compiler"]["quadrature_degree"] = 2 * options.degree
+try:
+    stop = (
+        termination.StopCriterion(options.stop, keys=["volume", "max_thickness"])
+        if options.stop is not None
+        else None
+    )
+    scheduler = output_schedule.OutputScheduler(
+        dict(
+            series=output_schedule.Group(options.output_interval, options.dense_interval),
+            diagnostics=output_schedule.Group(
+                options.diag_interval, 1 if options.events else None, unit="steps"
+            ),
+            checkpoint=output_schedule.Group(
+                options.checkpoint_interval or None, unit="steps"
+            ),
+        ),
+        [output_schedule.parse_trigger(e) for e in options.events],
+        options.dense_window,
+        keys=["volume", "retries"],
+    )
+except ValueError as e:
+    parser.error(str(e))
 geom = options.geometry
+rebuild_solvers = options.rebuild_solvers
+substeps = max(options.substeps, 1)
 
 
 ##########################################################
@@ -101,7 +444,8 @@ h_0 = df.Constant(0.1)  # Subglacial cavity depth
 k = df.Constant(0.7)
 
 dt_float = 0.1  # Time step
-dt = df.Constant(dt_float)
+dt = df.Constant(dt_float)  # Ice time step
+dt_sed = df.Constant(dt_float)  # Sediment/bedrock time step
 
 if geom == "1sided":
     L = 45000.0  # Characteristic domain length
@@ -180,8 +524,8 @@ class Beta2(df.UserExpression):
 ##########################################################
 
 # Define a rectangular mesh
-nx = 500
-mesh = df.IntervalMesh(nx, -L, L)
+nx = options.nx
+mesh = df.IntervalMesh(get_comm(), nx, -L, L)
 
 # Define boundaries
 ocean = df.MeshFunction("size_t", mesh, 1, 0)
@@ -206,13 +550,17 @@ nhat = df.FacetNormal(mesh)[0]
 E_cg = df.FiniteElement("CG", mesh.ufl_cell(), 1)
 Q_cg = df.FunctionSpace(mesh, E_cg)
 
+# Velocity (and CG thickness projection) Function Space, CG1 unless --degree is given
+E_u = df.FiniteElement("CG", mesh.ufl_cell(), options.degree)
+Q_u = df.FunctionSpace(mesh, E_u)
+
 # DG0 Function Space
 E_dg = df.FiniteElement("DG", mesh.ufl_cell(), 0)
 Q_dg = df.FunctionSpace(mesh, E_dg)
 
 # Mixed element for coupled velocity-thickness solve
-# (depth-averaged velocity, deformational velocity, DG0 thickness, CG1 thickness projection)
-E_glac = df.MixedElement([E_cg, E_cg, E_dg, E_cg])
+# (depth-averaged velocity, deformational velocity, DG0 thickness, CG thickness projection)
+E_glac = df.MixedElement([E_u, E_u, E_dg, E_u])
 V_g = df.FunctionSpace(mesh, E_glac)
 
 # Mixed element for coupled sediment stuff
@@ -221,7 +569,7 @@ V_g = df.FunctionSpace(mesh, E_glac)
 E_sed = df.MixedElement([E_cg, E_dg, E_dg, E_cg, E_dg])
 V_sed = df.FunctionSpace(mesh, E_sed)
 
-zero_cg = df.Function(Q_cg)
+zero_u = df.Function(Q_u)
 
 #########################################################
 #################  FUNCTIONS  ###########################
@@ -246,11 +594,11 @@ B, Qs, h_s, h_s_, h_eff = df.split(T)
 psi_B, psi_Q, psi_h, psi_h_, psi_eff = df.split(Psi)
 
 # Functions to hold results from previous time step
-ubar0 = df.Function(Q_cg)
-udef0 = df.Function(Q_cg)
+ubar0 = df.Function(Q_u)
+udef0 = df.Function(Q_u)
 
 H0 = df.Function(Q_dg)
-H0_ = df.Function(Q_cg)
+H0_ = df.Function(Q_u)
 
 H0.vector()[:] = 25
 H0_.vector()[:] = 25
@@ -424,7 +772,7 @@ def tau_dx():
     return rho * g * H_ * S.dx(0) * phibar
 
 
-points, weights = full_quad(4)
+points, weights = full_quad(options.quad_order)
 
 vi = VerticalIntegrator(points, weights)
 
@@ -553,11 +901,11 @@ else:
 h = df.CellDiameter(mesh)
 dhsdt = (h_s("+") - h_s("-")) / (0.5 * (h("+") + h("-")))
 R_hs = (
-    psi_h * ((h_s - h_s0) / dt + rho_r / rho_s * Bdot - ddot + edot) * df.dx
+    psi_h * ((h_s - h_s0) / dt_sed + rho_r / rho_s * Bdot - ddot + edot) * df.dx
     + df.avg(k_diff) * dhsdt * psih_jump * df.dS
 )
 # Bedrock evolution (Eq 2)
-R_B = psi_B * ((B - B0) / dt - Bdot) * df.dx
+R_B = psi_B * ((B - B0) / dt_sed - Bdot) * df.dx
 # ??
 R_hsx = psi_h_ * (h_s - h_s_) * df.dx
 # Effective thickness ?
@@ -572,8 +920,8 @@ J_sed = df.derivative(R_sed, T, dT)
 #####################################################################
 
 # For moving data between vector functions and scalar functions
-assigner_inv_g = df.FunctionAssigner([Q_cg, Q_cg, Q_dg, Q_cg], V_g)
-assigner_g = df.FunctionAssigner(V_g, [Q_cg, Q_cg, Q_dg, Q_cg])
+assigner_inv_g = df.FunctionAssigner([Q_u, Q_u, Q_dg, Q_u], V_g)
+assigner_g = df.FunctionAssigner(V_g, [Q_u, Q_u, Q_dg, Q_u])
 
 assigner_inv_s = df.FunctionAssigner([Q_cg, Q_dg, Q_dg, Q_cg, Q_dg], V_sed)
 assigner_s = df.FunctionAssigner(V_sed, [Q_cg, Q_dg, Q_dg, Q_cg, Q_dg])
@@ -586,11 +934,11 @@ assigner_s = df.FunctionAssigner(V_sed, [Q_cg, Q_dg, Q_dg, Q_cg, Q_dg])
 l_thick_bound = df.project(df.Constant(thklim), Q_dg)
 u_thick_bound = df.project(df.Constant(1e4), Q_dg)
 
-l_thick_bound_ = df.project(df.Constant(thklim), Q_cg)
-u_thick_bound_ = df.project(df.Constant(1e4), Q_cg)
+l_thick_bound_ = df.project(df.Constant(thklim), Q_u)
+u_thick_bound_ = df.project(df.Constant(1e4), Q_u)
 
-l_v_bound = df.project(-100000.0, Q_cg)
-u_v_bound = df.project(100000.0, Q_cg)
+l_v_bound = df.project(-100000.0, Q_u)
+u_v_bound = df.project(100000.0, Q_u)
 
 l_bound = df.Function(V_g)
 u_bound = df.Function(V_g)
@@ -598,59 +946,353 @@ u_bound = df.Function(V_g)
 assigner_g.assign(l_bound, [l_v_bound] * 2 + [l_thick_bound] + [l_thick_bound_])
 assigner_g.assign(u_bound, [u_v_bound] * 2 + [u_thick_bound] + [u_thick_bound_])
 
+# Coupling fields: the water flux and sediment forms see the ice state through U_c and
+# the ice forms see the sediment state through T_c. In lockstep these are copies of the
+# latest states; with multi-rate stepping (--substeps) the slow subsystem sees the time
+# average of the fast one over the macro step.
+U_c = df.Function(V_g)
+T_c = df.Function(V_sed)
+
+R_c = ufl.replace(R, {T: T_c})
+J_c = df.derivative(R_c, U, dU)
+
+R_sed_c = ufl.replace(R_sed, {U: U_c})
+J_sed_c = df.derivative(R_sed_c, T, dT)
+
+b_Qw_c = ufl.replace(b_Qw, {U: U_c})
+
 # Define variational solver for the momentum problem
-mass_problem = df.NonlinearVariationalProblem(R, U, bcs=[], J=J)
+mass_problem = df.NonlinearVariationalProblem(R_c, U, bcs=[], J=J_c)
 mass_problem.set_bounds(l_bound, u_bound)
 
-sed_problem = df.NonlinearVariationalProblem(R_sed, T, J=J_sed)
+sed_problem = df.NonlinearVariationalProblem(R_sed_c, T, J=J_sed_c)
+
+
+def make_sed_solver():
+    sed_solver = df.NonlinearVariationalSolver(sed_problem)
+    sed_solver.parameters["nonlinear_solver"] = "newton"
+
+    sed_solver.parameters["newton_solver"]["relative_tolerance"] = 1e-2
+    sed_solver.parameters["newton_solver"]["absolute_tolerance"] = 1e-2
+    sed_solver.parameters["newton_solver"]["error_on_nonconvergence"] = True
+    sed_solver.parameters["newton_solver"]["linear_solver"] = "gmres"
+    sed_solver.parameters["newton_solver"]["maximum_iterations"] = 10
+    sed_solver.parameters["newton_solver"]["report"] = True
+    sed_solver.parameters["newton_solver"]["relaxation_parameter"] = 0.7
+    #sed_solver.parameters['newton_solver']['krylov_solver']['relative_tolerance'] = 1e-3
+    if options.misfit is not None:
+        # The adjoint differentiates the discrete equations, so the solves have to
+        # satisfy them closely
+        sed_solver.parameters["newton_solver"]["relative_tolerance"] = 1e-9
+        sed_solver.parameters["newton_solver"]["absolute_tolerance"] = 1e-9
+        sed_solver.parameters["newton_solver"]["maximum_iterations"] = 50
+    return sed_solver
+
+
+def make_mass_solver():
+    mass_solver = df.NonlinearVariationalSolver(mass_problem)
+    mass_solver.parameters["nonlinear_solver"] = "snes"
+
+    mass_solver.parameters["snes_solver"]["method"] = "vinewtonrsls"
+    mass_solver.parameters["snes_solver"]["relative_tolerance"] = 1e-2
+    mass_solver.parameters["snes_solver"]["absolute_tolerance"] = 1e-2
+    mass_solver.parameters["snes_solver"]["error_on_nonconvergence"] = True
+    mass_solver.parameters["snes_solver"]["linear_solver"] = "gmres"
+    mass_solver.parameters["snes_solver"]["maximum_iterations"] = 10
+    mass_solver.parameters["snes_solver"]["report"] = True
+    #mass_solver.parameters['snes_solver']['krylov_solver']['relative_tolerance'] = 1e-3
+    if options.misfit is not None:
+        mass_solver.parameters["snes_solver"]["relative_tolerance"] = 1e-9
+        mass_solver.parameters["snes_solver"]["absolute_tolerance"] = 1e-9
+        mass_solver.parameters["snes_solver"]["maximum_iterations"] = 50
+    return mass_solver
+
+
+# The solvers (and their PETSc SNES/KSP objects, Jacobian matrices and sparsity patterns)
+# are built once and reused by every time step, including the retries with a reduced dt.
+sed_solver = make_sed_solver()
+mass_solver = make_mass_solver()
+
+# The water flux operator only depends on the flow direction, which does not change, so
+# it is assembled and factorized once. Only the right hand side (melt) is reassembled.
+A_Qw_mat = df.assemble(A_Qw)
+b_Qw_vec = df.assemble(b_Qw_c)
+Qw_solver = df.LUSolver(A_Qw_mat)
+
+
+
+class Untaped(object):
+    "Runs the solves and copies of a time step like adjoint.Tape, without recording them."
+
+    def solve(self, F, u, solve, active=None):
+        solve()
+
+    def assign(self, assigner, targets, sources, reverse):
+        assigner.assign(targets, sources)
+
+    def copy(self, target, source):
+        target.assign(source)
+
+
+# Records the solves of a time step for the discrete adjoint (see adjoint.py)
+tape = discrete_adjoint.Tape() if options.misfit is not None else Untaped()
+
+# Residual of the water flux solve in terms of Qw
+R_Qw_c = ufl.replace(R_Qw, {dQ: Qw, U: U_c})
+
+# Thickness dofs of the ice solve (DG and CG projection), bounded below by thklim
+H_dofs = np.concatenate(
+    [V_g.sub(2).dofmap().dofs(), V_g.sub(3).dofmap().dofs()]
+).astype(np.intc)
+
+
+def ice_active_dofs():
+    """Dofs of U that are fixed after the ice solve: thickness at its lower bound
+    (vinewtonrsls active set)."""
+    H_values = U.vector().get_local()[H_dofs]
+    return H_dofs[H_values <= thklim * (1 + 1e-6)]
+
+
+if options.transport == "sweep":
+    from upwind_sweep import UpwindSweep
+
+    # Cells ordered along flow_dir; the left boundary only carries an outflow term for
+    # the two-sided geometries
+    transport_sweep = UpwindSweep(
+        Q_dg.tabulate_dof_coordinates().ravel(),
+        flow_dir.vector().get_local(),
+        outflow=(geom != "1sided", True),
+    )
+
+if options.coupling == "iterate":
+    import coupling
+
+    interface = coupling.accelerator(options.acceleration, comm=mesh.mpi_comm())
+
+if options.coupling == "monolithic":
+    # One mixed space holding the ice, sediment and water flux unknowns. The split forms
+    # are moved onto its components with ufl.replace, so they stay the single definition
+    # of the physics.
+    E_mono = df.MixedElement(list(E_glac.sub_elements()) + list(E_sed.sub_elements()) + [E_dg])
+    V_mono = df.FunctionSpace(mesh, E_mono)
+    Z = df.Function(V_mono)
+    z = df.split(Z)
+    z_test = df.split(df.TestFunction(V_mono))
+
+    U_m = df.as_vector(z[0:4])
+    T_m = df.as_vector(z[4:9])
+    mono_map = {
+        U: U_m,
+        T: T_m,
+        Qw: z[9],
+        dQ: z[9],
+        Phi: df.as_vector(z_test[0:4]),
+        Psi: df.as_vector(z_test[4:9]),
+        psi: z_test[9],
+    }
+    R_mono = ufl.replace(R + R_sed + R_Qw, mono_map)
+    J_mono = df.derivative(R_mono, Z)
+
+    mono_spaces = [Q_u, Q_u, Q_dg, Q_u, Q_cg, Q_dg, Q_dg, Q_cg, Q_dg, Q_dg]
+    assigner_mono = df.FunctionAssigner(V_mono, mono_spaces)
+    assigner_inv_mono = df.FunctionAssigner(mono_spaces, V_mono)
+
+    # Only the ice thickness is bounded, as in the split ice solve
+    big_dg = df.project(df.Constant(1e12), Q_dg)
+    big_cg = df.project(df.Constant(1e12), Q_cg)
+    l_big_dg = df.project(df.Constant(-1e12), Q_dg)
+    l_big_cg = df.project(df.Constant(-1e12), Q_cg)
+    l_mono = df.Function(V_mono)
+    u_mono = df.Function(V_mono)
+    assigner_mono.assign(
+        l_mono,
+        [l_v_bound, l_v_bound, l_thick_bound, l_thick_bound_]
+        + [l_big_cg, l_big_dg, l_big_dg, l_big_cg, l_big_dg, l_big_dg],
+    )
+    assigner_mono.assign(
+        u_mono,
+        [u_v_bound, u_v_bound, u_thick_bound, u_thick_bound_]
+        + [big_cg, big_dg, big_dg, big_cg, big_dg, big_dg],
+    )
+
+    mono_problem = df.NonlinearVariationalProblem(R_mono, Z, J=J_mono)
+    mono_problem.set_bounds(l_mono, u_mono)
+
+    mono_solver = df.NonlinearVariationalSolver(mono_problem)
+    mono_solver.parameters["nonlinear_solver"] = "snes"
+    mono_solver.parameters["snes_solver"]["method"] = "vinewtonrsls"
+    mono_solver.parameters["snes_solver"]["relative_tolerance"] = 1e-2
+    mono_solver.parameters["snes_solver"]["absolute_tolerance"] = 1e-2
+    mono_solver.parameters["snes_solver"]["error_on_nonconvergence"] = True
+    mono_solver.parameters["snes_solver"]["linear_solver"] = "lu"
+    mono_solver.parameters["snes_solver"]["maximum_iterations"] = 20
+    mono_solver.parameters["snes_solver"]["report"] = True
+
+# Accumulated wall time [s] per part of the time step
+timings = dict(setup=0.0, water=0.0, sediment=0.0, ice=0.0, coupled=0.0)
 
 ######################################################################
 #######################   SOLUTION   #################################
 ######################################################################
 
 
-### PLOTTING ###
-plt.ion()
-fig, ax = plt.subplots(nrows=4, sharex=True, figsize=(10, 12))
+### DIAGNOSTICS ###
+def compute_diagnostics():
+    # Every diagnostic field is projected once per diagnostic step
+    thk = H0_.compute_vertex_values()
+    bed = B0.compute_vertex_values()
+    sed = h_s0.compute_vertex_values()
+    dry = thk <= (thklim + 1e-2)
+
+    fields = dict(
+        bed=bed,
+        surface=df.project(S).compute_vertex_values(),
+        bottom=df.project(Base).compute_vertex_values(),
+        sed_surface=bed + sed,
+        Qw=df.project(Qw).compute_vertex_values(),
+        us=np.abs(df.project(u(0)).compute_vertex_values()),
+        ub=np.abs(df.project(u(1)).compute_vertex_values()),
+        h_s=sed,
+    )
+    for name in ("surface", "bottom", "us", "ub"):
+        fields[name][dry] = np.nan
+
+    # Grounding line: the largest x of an ice covered, grounded vertex
+    grounded_ice = (df.project(ghat, Q_cg).compute_vertex_values() > 0.5) & ~dry
+    x_vertices = mesh.coordinates().ravel()
+    gl_position = x_vertices[grounded_ice].max() if grounded_ice.any() else np.nan
+
+    scalars = [
+        counter,
+        t,
+        dt_float,
+        substeps,
+        H0.vector().max(),
+        df.assemble(h_s0 * df.dx),
+        np.abs(fields["Qw"]).max(),
+        np.nanmax(fields["us"], initial=0.0),
+        df.assemble(H0 * df.dx),
+        gl_position,
+    ]
+    return fields, scalars
+
+
+diag_header = "step t dt substeps H_max sediment_volume Qw_max us_max volume gl_position"
+diag_rows = []
+if options.diag_file is not None and options.init_file is None:
+    with open(options.diag_file, "w") as diag_out:
+        diag_out.write("# " + diag_header + "\n")
+
+
+def flush_diagnostics():
+    if options.diag_file is not None and diag_rows:
+        with open(options.diag_file, "a") as diag_out:
+            np.savetxt(diag_out, np.array(diag_rows))
+        del diag_rows[:]
+
+
+if not options.headless:
+    import matplotlib.pyplot as plt
+
+    plt.ion()
+    fig, ax = plt.subplots(nrows=4, sharex=True, figsize=(10, 12))
+
+    x = mesh.coordinates()
+    BB = B0.compute_vertex_values()
+    SS = df.project(S).compute_vertex_values()
+    Ba = df.project(Base).compute_vertex_values()
+    (ph_bed,) = ax[0].plot(x, BB, "k-", lw=2.0)
+    (ph_surface,) = ax[0].plot(x, SS, "c-", lw=1.0)
+    (ph_bottom,) = ax[0].plot(x, Ba, "c-", lw=1.0)
+    (ph_sed,) = ax[0].plot(x, SS, "g-", lw=1.0)
+    ax[0].plot(x, np.zeros_like(x), "b:", lw=1.0)
+    ax[0].set_ylabel("Elevation")
+    ax[0].set_ylim(-500, 3000)
+
+    (ph_v,) = ax[1].plot(x, np.zeros_like(x), "k-", lw=1.0)
+    ax[1].set_ylabel("Water flux")
+
+    (ph_us,) = ax[2].plot(x, np.zeros_like(x), "r-", lw=1.0)
+    (ph_ub,) = ax[2].plot(x, np.zeros_like(x), "k-", lw=1.0)
+    ax[2].set_ylim(0, 500)
+    ax[2].set_ylabel("Abs(Speed) (m/a)")
+
+    (ph_hs,) = ax[3].plot(x, np.zeros_like(x), "k-", lw=1.0)
+    ax[3].set_ylabel("Sed. Thk.")
+    ax[3].set_xlabel("Dist.")
+
+    plt.pause(0.00001)
+
+
+def plot_diagnostics(fields):
+    ph_bed.set_ydata(fields["bed"])
+    ph_surface.set_ydata(fields["surface"])
+    ph_bottom.set_ydata(fields["bottom"])
+    ph_sed.set_ydata(fields["sed_surface"])
 
-x = mesh.coordinates()
-BB = B0.compute_vertex_values()
-SS = df.project(S).compute_vertex_values()
-Ba = df.project(Base).compute_vertex_values()
-(ph_bed,) = ax[0].plot(x, BB, "k-", lw=2.0)
-(ph_surface,) = ax[0].plot(x, SS, "c-", lw=1.0)
-(ph_bottom,) = ax[0].plot(x, Ba, "c-", lw=1.0)
-(ph_sed,) = ax[0].plot(x, SS, "g-", lw=1.0)
-ax[0].plot(x, np.zeros_like(x), "b:", lw=1.0)
-ax[0].set_ylabel("Elevation")
-ax[0].set_ylim(-500, 3000)
+    Qw_max = np.abs(fields["Qw"]).max()
+    ph_v.set_ydata(fields["Qw"])
+    ax[1].set_ylim(-Qw_max, Qw_max)
 
-(ph_v,) = ax[1].plot(x, np.zeros_like(x), "k-", lw=1.0)
-ax[1].set_ylabel("Water flux")
+    ph_us.set_ydata(fields["us"])
+    ph_ub.set_ydata(fields["ub"])
 
-(ph_us,) = ax[2].plot(x, np.zeros_like(x), "r-", lw=1.0)
-(ph_ub,) = ax[2].plot(x, np.zeros_like(x), "k-", lw=1.0)
-ax[2].set_ylim(0, 500)
-ax[2].set_ylabel("Abs(Speed) (m/a)")
+    ph_hs.set_ydata(fields["h_s"])
+    ax[3].set_ylim(0, fields["h_s"].max() + 10)
 
-(ph_hs,) = ax[3].plot(x, np.zeros_like(x), "k-", lw=1.0)
-ax[3].set_ylabel("Sed. Thk.")
-ax[3].set_xlabel("Dist.")
+    fig.canvas.start_event_loop(0.001)
+    fig.canvas.draw_idle()
 
-plt.pause(0.00001)
 
 # Time interval
 t = 0.0
-t_end = 10000.0
+t_end = options.t_end
 
 counter = 0
 
 # Maximum time step!!  Increase with caution.
-dt_max = 1.0
+dt_max = options.dt_max
+
+# Everything needed to continue a run exactly, see h5_output
+checkpoint_fields = [
+    ("ubar", ubar0),
+    ("udef", udef0),
+    ("H", H0),
+    ("H_", H0_),
+    ("B", B0),
+    ("Qs", Qs0),
+    ("h_s", h_s0),
+    ("h_s_", h_s_0),
+    ("h_eff", h_eff0),
+    ("Qw", Qw),
+    ("U_c", U_c),
+    ("T_c", T_c),
+]
+output_fields = [
+    ("B", B0),
+    ("h_s", h_s0),
+    ("Qs", Qs0),
+    ("h_eff", h_eff0),
+    ("H", H0),
+    ("ubar", ubar0),
+    ("udef", udef0),
+    ("Qw", Qw),
+]
+coordinates = h5_output.global_coordinates(mesh)
+t_output = t
+
+if options.init_file is not None:
+    # Restore the random state first, so that the initial velocity guesses below
+    # are drawn exactly as in the original run
+    restart, rng_state = h5_output.read_checkpoint(options.init_file, [], coordinates)
+    np.random.set_state(rng_state)
+elif options.seed is not None:
+    np.random.seed(options.seed)
+rng_state = np.random.get_state()
 
 # Initialization stuff
-ubarinit = df.Function(Q_cg)
-udefinit = df.Function(Q_cg)
+ubarinit = df.Function(Q_u)
+udefinit = df.Function(Q_u)
 ubarinit.vector()[:] += (
     1e-1 * np.random.randn(ubar0.vector().get_local().shape[0]) + 100.0
 )
@@ -659,98 +1301,420 @@ ubar0.vector()[:] += 1e-1 * np.random.randn(ubar0.vector().get_local().shape[0])
 udef0.vector()[:] += 1e-3 * np.random.randn(udef0.vector().get_local().shape[0])
 assigner_g.assign(U, [ubar0, udef0, H0, H0_])
 assigner_s.assign(T, [B0, Qs0, h_s0, h_s_0, h_eff0])
+U_c.assign(U)
+T_c.assign(T)
+
+if options.init_file is not None:
+    h5_output.read_checkpoint(options.init_file, checkpoint_fields, coordinates)
+    assigner_g.assign(U, [ubar0, udef0, H0, H0_])
+    assigner_s.assign(T, [B0, Qs0, h_s0, h_s_0, h_eff0])
+    t = float(restart["t"])
+    t_output = float(restart["t_output"])
+    # The time step settings of this run apply from the first step on: the checkpoint may
+    # come from a run with other settings (e.g. the coarse propagator of parareal.py)
+    dt_float = min(float(restart["dt_float"]), dt_max)
+    counter = int(restart["counter"])
+    if options.adaptive_substeps:
+        substeps = min(max(int(restart["substeps"]), 1), options.max_substeps)
+    print("restarting at t = {} from {}".format(t, options.init_file))
+
+if options.out_file is not None:
+    series = h5_output.TimeSeriesWriter(
+        options.out_file,
+        output_fields,
+        coordinates,
+        mesh.mpi_comm(),
+        t_restart=t if options.init_file is not None else None,
+    )
+    if options.init_file is None:
+        series.write(t)
+        t_output += options.output_interval
+
+# Intervals continue from the start or the restart
+scheduler.groups["series"].last = t_output - options.output_interval
+scheduler.groups["diagnostics"].last = counter
+scheduler.groups["checkpoint"].last = counter
+
+
+def write_checkpoint():
+    h5_output.write_checkpoint(
+        options.checkpoint,
+        checkpoint_fields,
+        coordinates,
+        mesh.mpi_comm(),
+        rng_state=rng_state,
+        t=t,
+        t_output=t_output,
+        dt_float=dt_float,
+        counter=counter,
+        substeps=substeps,
+    )
 
-# Loop over time
-while t < t_end:
-    try:  # If the solvers don't converge, reduce the time step and try again.
-        print(t, dt_float, H0.vector().max(), df.assemble(h_s0 * df.dx))
-
-        assigner_s.assign(T, [B0, Qs0, h_s0, h_s_0, h_eff0])
-        assigner_g.assign(U, [ubar0, udef0, H0, H0_])
-
-        # Solve for water flux
-        df.solve(A_Qw == b_Qw, Qw)
-
-        # Solve for sediment variables
-        print("solving sed")
-        sed_solver = df.NonlinearVariationalSolver(sed_problem)
-        sed_solver.parameters["nonlinear_solver"] = "newton"
-
-        sed_solver.parameters["newton_solver"]["relative_tolerance"] = 1e-2
-        sed_solver.parameters["newton_solver"]["absolute_tolerance"] = 1e-2
-        sed_solver.parameters["newton_solver"]["error_on_nonconvergence"] = True
-        sed_solver.parameters["newton_solver"]["linear_solver"] = "gmres"
-        sed_solver.parameters["newton_solver"]["maximum_iterations"] = 10
-        sed_solver.parameters["newton_solver"]["report"] = True
-        sed_solver.parameters["newton_solver"]["relaxation_parameter"] = 0.7
-        #sed_solver.parameters['newton_solver']['krylov_solver']['relative_tolerance'] = 1e-3
-
-        sed_solver.solve()
-
-        # Solve for ice velocity and thickness
-        print("solving mass")
-        assigner_g.assign(U, [ubarinit, zero_cg, H0, H0_])
-        mass_solver = df.NonlinearVariationalSolver(mass_problem)
-        mass_solver.parameters["nonlinear_solver"] = "snes"
-
-        mass_solver.parameters["snes_solver"]["method"] = "vinewtonrsls"
-        mass_solver.parameters["snes_solver"]["relative_tolerance"] = 1e-2
-        mass_solver.parameters["snes_solver"]["absolute_tolerance"] = 1e-2
-        mass_solver.parameters["snes_solver"]["error_on_nonconvergence"] = True
-        mass_solver.parameters["snes_solver"]["linear_solver"] = "gmres"
-        mass_solver.parameters["snes_solver"]["maximum_iterations"] = 10
-        mass_solver.parameters["snes_solver"]["report"] = True
-        #mass_solver.parameters['snes_solver']['krylov_solver']['relative_tolerance'] = 1e-3
-        mass_solver.solve()
-
-        assigner_inv_s.assign([B0, Qs0, h_s0, h_s_0, h_eff0], T)
-        assigner_inv_g.assign([ubar0, udef0, H0, H0_], U)
 
-        # Increase time step if solvers complete successfully
-        dt_float = min(1.05 * dt_float, dt_max)
-        dt.assign(dt_float)
-
-        # Do some plotting
-        thk = H0_.compute_vertex_values()
-        bed = B0.compute_vertex_values()
-        surface = df.project(S).compute_vertex_values()
-        surface[thk <= (thklim + 1e-2)] = np.nan
-        bottom = df.project(Base).compute_vertex_values()
-        bottom[thk <= (thklim + 1e-2)] = np.nan
-
-        grounded = df.project(ghat, Q_dg)
-        g_ = grounded.compute_vertex_values()
-        sed_surface = bed + h_s0.compute_vertex_values()
-
-        ph_bed.set_ydata(bed)
-        ph_surface.set_ydata(surface)
-        ph_bottom.set_ydata(bottom)
-        ph_sed.set_ydata(sed_surface)
-
-        ph_v.set_ydata(df.project(Qw).compute_vertex_values())
-        ax[1].set_ylim(
-            -df.project(Qw).compute_vertex_values().max(),
-            df.project(Qw).compute_vertex_values().max(),
+def solve_water():
+    # Solve for water flux
+    def solve():
+        if options.transport == "sweep":
+            df.assemble(b_Qw_c, tensor=b_Qw_vec)
+            Qw.vector().set_local(transport_sweep.solve(b_Qw_vec.get_local()))
+            Qw.vector().apply("insert")
+        elif rebuild_solvers:
+            df.solve(A_Qw == b_Qw_c, Qw)
+        else:
+            df.assemble(b_Qw_c, tensor=b_Qw_vec)
+            Qw_solver.solve(Qw.vector(), b_Qw_vec)
+
+    tic = time.perf_counter()
+    tape.solve(R_Qw_c, Qw, solve)
+    timings["water"] += time.perf_counter() - tic
+
+
+def solve_sediment(dt_step):
+    # Solve for sediment variables
+    print("solving sed")
+    dt_sed.assign(dt_step)
+    tic = time.perf_counter()
+    # initial guess
+    assigner_s.assign(T, [B0, Qs0, h_s0, h_s_0, h_eff0])
+    tape.solve(R_sed_c, T, lambda: sed_solver.solve())
+    timings["sediment"] += time.perf_counter() - tic
+    tape.assign(assigner_inv_s, [B0, Qs0, h_s0, h_s_0, h_eff0], T, assigner_s)
+
+
+def solve_ice(dt_step):
+    # Solve for ice velocity and thickness
+    print("solving mass")
+    dt.assign(dt_step)
+    # initial guess
+    assigner_g.assign(U, [ubarinit, zero_u, H0, H0_])
+    tic = time.perf_counter()
+    tape.solve(R_c, U, lambda: mass_solver.solve(), ice_active_dofs)
+    timings["ice"] += time.perf_counter() - tic
+    tape.assign(assigner_inv_g, [ubar0, udef0, H0, H0_], U, assigner_g)
+
+
+def solve_iterated(dt_step, saved):
+    # Repeat water flux -> sediment -> ice until the ice state seen by the water flux
+    # and sediment solves (U_c) no longer changes. Every pass restarts from the state at
+    # the beginning of the step.
+    interface.reset()
+    U_c.assign(saved[state.index(U_c)])
+    for k in range(1, options.max_coupling_iterations + 1):
+        for f, f_saved in zip(state[:-2], saved[:-2]):
+            f.assign(f_saved)
+        solve_water()
+        solve_sediment(dt_step)
+        T_c.assign(T)
+        solve_ice(dt_step)
+
+        change = relative_change(U, U_c)
+        print("coupling iteration {}: relative change {:.3e}".format(k, change))
+        if change < options.coupling_iteration_tol:
+            U_c.assign(U)
+            return k
+
+        x = interface.update(U_c.vector().get_local(), U.vector().get_local())
+        U_c.vector().set_local(x)
+        U_c.vector().apply("insert")
+
+    raise RuntimeError("coupling iteration did not converge")
+
+
+def solve_monolithic(dt_step):
+    # Newton on the water flux, sediment and ice fields together
+    print("solving coupled system")
+    dt.assign(dt_step)
+    dt_sed.assign(dt_step)
+    assigner_mono.assign(
+        Z, [ubarinit, zero_u, H0, H0_, B0, Qs0, h_s0, h_s_0, h_eff0, Qw]
+    )
+    tic = time.perf_counter()
+    iterations, converged = mono_solver.solve()
+    timings["coupled"] += time.perf_counter() - tic
+    assigner_inv_mono.assign(
+        [ubar0, udef0, H0, H0_, B0, Qs0, h_s0, h_s_0, h_eff0, Qw], Z
+    )
+    assigner_g.assign(U, [ubar0, udef0, H0, H0_])
+    assigner_s.assign(T, [B0, Qs0, h_s0, h_s_0, h_eff0])
+    U_c.assign(U)
+    T_c.assign(T)
+    return iterations
+
+
+def relative_change(f, f_old):
+    return (f.vector() - f_old.vector()).norm("l2") / max(f.vector().norm("l2"), 1e-16)
+
+
+# Everything a failed macro step has to be rolled back to
+state = [ubar0, udef0, H0, H0_, B0, Qs0, h_s0, h_s_0, h_eff0, U_c, T_c]
+
+######################################################################
+#######################   GRADIENT   #################################
+######################################################################
+
+if options.misfit is not None:
+    # The time steps of a lockstep run without failed steps: growing by 5 % from dt_float
+    # up to dt_max, the last one shortened to end at t_end
+    dts = []
+    t_n, dt_n = t, dt_float
+    while t_end - t_n > 1e-9 * max(t_end, 1.0):
+        dts.append(min(dt_n, t_end - t_n))
+        t_n += dts[-1]
+        dt_n = min(1.05 * dt_n, dt_max)
+    n_steps = len(dts)
+
+    def step(n):
+        # Lockstep split step n, as in the time loop with --substeps 1
+        solve_water()
+        solve_sediment(dts[n - 1])
+        tape.copy(T_c, T)
+        solve_ice(dts[n - 1])
+        tape.copy(U_c, U)
+
+    if options.misfit == "thickness":
+        # Final ice thickness against the observed one
+        H_obs = df.Function(Q_dg)
+        hdf = df.HDF5File(mesh.mpi_comm(), options.obs, "r")
+        hdf.read(H_obs, "H")
+        del hdf
+        misfit = discrete_adjoint.final_thickness_misfit(H0, H_obs, n_steps)
+    elif options.misfit == "volume":
+        # Ice volume at every step against observations
+        volumes = np.loadtxt(options.obs) if options.obs is not None else np.zeros(n_steps)
+        misfit = discrete_adjoint.volume_misfit(H0, volumes)
+    else:
+        # Final grounding line position against the observed one: the flotation
+        # indicator ghat of the ice covered part, smooth as the melt rate's ice mask,
+        # extending from the left end (1sided) or the divide
+        misfit = discrete_adjoint.grounding_line_misfit(
+            ghat * sigmoid(H - (thklim + df.Constant(1))),
+            df.SpatialCoordinate(mesh)[0],
+            -L if geom == "1sided" else x0,
+            float(np.loadtxt(options.obs)),
+            n_steps,
+        )
+
+    names = ["beta2", "be", "cc", "k", "amin", "amax"]
+    controls = [beta2, be, cc, k, amin, amax]
+    model = discrete_adjoint.DiscreteAdjoint(
+        step, state, tape, n_steps, misfit, options.snapshots
+    )
+    J_m, grads = model.gradient(controls)
+    print(
+        "Misfit {:.6e} after {} steps ({} forward steps for the gradient)".format(
+            J_m, n_steps, model.forward_steps
+        )
+    )
+    for name, grad in zip(names, grads):
+        print(
+            "d misfit / d {}: {}".format(
+                name,
+                grad if isinstance(grad, float) else "norm {:.6e}".format(grad.norm("l2")),
+            )
+        )
+
+    if options.gradient is not None:
+        dJ_dbeta2 = df.Function(Q_cg)
+        dJ_dbeta2.vector()[:] = grads[0]
+        hdf = df.HDF5File(mesh.mpi_comm(), options.gradient, "w")
+        hdf.write(mesh, "mesh")
+        hdf.write(dJ_dbeta2, "beta2")
+        for name, grad in zip(names[1:], grads[1:]):
+            hdf.attributes("beta2")[name] = grad
+        del hdf
+
+    if options.taylor_test:
+        # Relative perturbations of 1 % in a random direction
+        directions = [beta2.vector().copy()]
+        directions[0][:] = (
+            0.01 * beta2.vector().get_local() * np.random.randn(Q_cg.dim())
+        )
+        directions += [0.01 * float(c) for c in controls[1:]]
+        remainders, orders = discrete_adjoint.taylor_test(
+            model, controls, directions, h=1.0
+        )
+        print("Taylor remainders: " + ", ".join("{:.3e}".format(r) for r in remainders))
+        print(
+            "Observed orders: {} (2 expected)".format(
+                ", ".join("{:.2f}".format(o) for o in orders)
+            )
         )
-        us_ = df.project(u(0)).compute_vertex_values()
-        ub_ = df.project(u(1)).compute_vertex_values()
-        us_[thk <= (thklim + 1e-2)] = np.nan
-        ub_[thk <= (thklim + 1e-2)] = np.nan
+        if min(orders) < 1.8:
+            sys.exit("Taylor test failed: the gradient is not consistent with the misfit")
+
+    sys.exit(0)
+
+# Coupling iterations (Newton iterations for --coupling monolithic) and failed steps
+coupling_iterations = 0
+failures = 0
+t_start = t
+wall_start = time.perf_counter()
 
-        ph_us.set_ydata(np.abs(us_))
-        ph_ub.set_ydata(np.abs(ub_))
+# Loop over time
+while t_end - t > 1e-9 * max(t_end, 1.0):
+    saved = [f.copy(deepcopy=True) for f in state]
+    saved_scalars = (t, counter, dt_float, substeps, coupling_iterations)
+    try:  # If the solvers don't converge, reduce the time step and try again.
+        print(t, dt_float, substeps, H0.vector().max())
+
+        tic = time.perf_counter()
+        if rebuild_solvers:
+            sed_solver = make_sed_solver()
+            mass_solver = make_mass_solver()
+        timings["setup"] += time.perf_counter() - tic
+
+        # dt_float is the step of the fast subsystem, the slow one takes the macro step.
+        # The last step is shortened to end exactly at t_end.
+        dt_step = min(dt_float, (t_end - t) / substeps)
+        dt_macro = substeps * dt_step
+
+        if options.coupling == "iterate":
+            iterations = solve_iterated(dt_step, saved)
+            change = 0.0
+        elif options.coupling == "monolithic":
+            iterations = solve_monolithic(dt_step)
+            change = 0.0
+        elif options.fast == "ice":
+            iterations = 1
+            # Water flux and sediment take the macro step with the ice state averaged
+            # over the previous macro step, then the ice takes the sub-steps
+            solve_water()
+            solve_sediment(dt_macro)
+            T_c.assign(T)
+
+            U_c.vector().zero()
+            for i in range(substeps):
+                solve_ice(dt_step)
+                U_c.vector().axpy(1.0 / substeps, U.vector())
+
+            change = relative_change(U_c, saved[state.index(U_c)])
+        else:
+            iterations = 1
+            # Water flux and sediment take the sub-steps, then the ice takes the macro
+            # step with the sediment state averaged over the sub-steps
+            T_c.vector().zero()
+            for i in range(substeps):
+                solve_water()
+                solve_sediment(dt_step)
+                T_c.vector().axpy(1.0 / substeps, T.vector())
 
-        ph_hs.set_ydata(h_s0.compute_vertex_values())
-        ax[3].set_ylim(0, h_s0.compute_vertex_values().max() + 10)
+            solve_ice(dt_macro)
+            U_c.assign(U)
 
-        if counter % 10 == 0:
-            # pause(0.00001)
-            fig.canvas.start_event_loop(0.001)
-            fig.canvas.draw_idle()
+            change = relative_change(T_c, saved[state.index(T_c)])
 
-        t += dt_float
+        t += dt_macro
         counter += 1
+        coupling_iterations += iterations
+
+        # Increase time step if solvers complete successfully
+        dt_float = min(1.05 * dt_float, dt_max)
+
+        if options.adaptive_substeps:
+            if change < 0.5 * options.coupling_tol:
+                substeps = min(2 * substeps, options.max_substeps)
+            elif change > options.coupling_tol:
+                substeps = max(substeps // 2, 1)
+
+        run_state = dict(
+            volume=df.assemble(H0 * df.dx),
+            max_thickness=H0.vector().max(),
+            retries=failures,
+        )
+        output = scheduler.update(t, counter, run_state)
+        t_output = scheduler.groups["series"].last + options.output_interval
+
+        if options.out_file is not None and "series" in output:
+            series.write(t)
+
+        if options.checkpoint is not None and "checkpoint" in output:
+            write_checkpoint()
+
+        if "diagnostics" in output:
+            fields, scalars = compute_diagnostics()
+            if options.diag_file is not None:
+                diag_rows.append(scalars)
+            print("sediment volume: {}".format(scalars[5]))
+            if len(diag_rows) >= options.flush_interval:
+                flush_diagnostics()
+            if not options.headless:
+                plot_diagnostics(fields)
+
+        if counter % 100 == 0:
+            print(
+                "Mean time per step [s]: "
+                + ", ".join("{} {:.4f}".format(k, v / counter) for k, v in timings.items())
+            )
+        if stop is not None and stop(t, run_state):
+            print("Stopping at t = {}: {}".format(t, stop.reason))
+            break
     except RuntimeError:
+        # the failure may come after the step was counted (e.g. a checkpoint write)
+        for f, f_saved in zip(state, saved):
+            f.assign(f_saved)
+        t, counter, dt_float, substeps, coupling_iterations = saved_scalars
         dt_float /= 2.0
-        dt.assign(dt_float)
+        failures += 1
         print("convergence failed, reducing time step and trying again")
+
+flush_diagnostics()
+print(scheduler.report())
+if stop is not None:
+    stop.write(options.stop_file, t)
+if options.out_file is not None:
+    series.close()
+if options.checkpoint is not None:
+    write_checkpoint()
+
+print(
+    "Coupling {}: {} steps, {} failed steps, mean dt {:.4f}, "
+    "{:.2f} iterations per step, wall time {:.1f} s".format(
+        options.coupling
+        + (" ({})".format(options.acceleration) if options.coupling == "iterate" else ""),
+        counter,
+        failures,
+        (t - t_start) / max(counter, 1),
+        coupling_iterations / max(counter, 1),
+        time.perf_counter() - wall_start,
+    )
+)
+print(
+    "Mean time per step [s] over {} steps: ".format(counter)
+    + ", ".join("{} {:.4f}".format(k, v / max(counter, 1)) for k, v in timings.items())
+)
+
+final_state = [("B", B0), ("h_s", h_s0), ("Qs", Qs0), ("H", H0), ("ubar", ubar0), ("udef", udef0)]
+
+if options.final_state is not None:
+    hdf = df.HDF5File(mesh.mpi_comm(), options.final_state, "w")
+    hdf.write(mesh, "mesh")
+    for name, f in final_state:
+        hdf.write(f, name)
+    del hdf
+
+if options.reference is not None:
+    # Relative L2 difference of the final state from a reference run (e.g. lockstep)
+    hdf = df.HDF5File(mesh.mpi_comm(), options.reference, "r")
+    for name, f in final_state:
+        f_ref = df.Function(f.function_space())
+        hdf.read(f_ref, name)
+        print(
+            "{}: relative difference from reference {:.3e}".format(
+                name, df.errornorm(f_ref, f) / max(df.norm(f_ref), 1e-16)
+            )
+        )
+    del hdf
+
+if options.summary is not None:
+    # Final scalars and surface profile, e.g. for convergence studies
+    summary = dict(
+        volume=df.assemble(H0 * df.dx),
+        sediment_volume=df.assemble(h_s0 * df.dx),
+        max_thickness=H0.vector().max(),
+        dofs=V_g.dim() + V_sed.dim(),
+        erosion_rate=-df.project(Bdot, Q_dg).vector().min(),
+        x=mesh.coordinates().ravel().tolist(),
+        surface=df.project(S).compute_vertex_values().tolist(),
+    )
+    with open(options.summary, "w") as f:
+        json.dump(summary, f)
@@ -0,0 +1,31 @@
+"""Import timing for the model scripts.
+
+The scripts parse their arguments before importing dolfin and the other heavy modules,
+so that --help and argument errors return at once, and import plotting modules only when
+they plot. With --import_times they report how long each group of imports took:
+
+    timer = ImportTimer()
+    with timer("dolfin"):
+        from dolfin import *
+    print(timer.report())
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class ImportTimer(object):
+    def __init__(self):
+        self.times = []
+
+    @contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        yield
+        self.times.append((name, time.perf_counter() - start))
+
+    def report(self):
+        width = max([len(name) for name, _ in self.times] + [6])
+        lines = ["{:{}s} {:8.3f} s".format(name, width, seconds) for name, seconds in self.times]
+        lines.append("{:{}s} {:8.3f} s".format("total", width, sum(s for _, s in self.times)))
+        return "Import times:\n" + "\n".join(lines)
@@ -0,0 +1,149 @@
+"""Conditions that end a run before its end time.
+
+A stop expression combines conditions with "&" (and) and "|" (or), where "&" binds
+tighter, e.g.
+
+    steady:1e-4:500 | max_thickness:5.1 | wall_clock:3600
+    gl_crossing:20000 & steady:1e-3:100
+
+Conditions:
+
+    steady:EPS:WINDOW   relative volume change over the last WINDOW years below EPS
+    gl_crossing:X       the grounding line crossed x = X [m]
+    max_thickness:H     the maximum thickness is below H [m] (e.g. the glacier vanished)
+    wall_clock:SECONDS  the run has used this much wall-clock time
+
+Conditions are checked against a dict of scalars the model updates after every step
+(volume, gl_position, max_thickness). When the expression holds, the run stops, writes its
+final state and records the reason: the names of the conditions that held, and a code.
+"""
+
+import json
+import time
+
+# Reason codes
+END_TIME = 0
+STEADY = 1
+GL_CROSSING = 2
+MAX_THICKNESS = 3
+WALL_CLOCK = 4
+
+
+class Steady(object):
+    code = STEADY
+    key = "volume"
+
+    def __init__(self, epsilon, window):
+        self.epsilon = epsilon
+        self.window = window
+        self.history = []
+
+    def __call__(self, t, state):
+        self.history.append((t, state["volume"]))
+        # keep the last record at least `window` years old, and everything after it
+        while len(self.history) > 1 and self.history[1][0] <= t - self.window:
+            self.history.pop(0)
+        t_old, volume_old = self.history[0]
+        if t - t_old < self.window:
+            return False
+        change = abs(state["volume"] - volume_old) / max(abs(volume_old), 1e-300)
+        return change < self.epsilon
+
+
+class GLCrossing(object):
+    code = GL_CROSSING
+    key = "gl_position"
+
+    def __init__(self, x):
+        self.x = x
+        self.initial = None
+
+    def __call__(self, t, state):
+        if self.initial is None:
+            self.initial = state["gl_position"]
+        return (self.initial - self.x) * (state["gl_position"] - self.x) <= 0 and \
+            state["gl_position"] != self.initial
+
+
+class MaxThickness(object):
+    code = MAX_THICKNESS
+    key = "max_thickness"
+
+    def __init__(self, thickness):
+        self.thickness = thickness
+
+    def __call__(self, t, state):
+        return state["max_thickness"] < self.thickness
+
+
+class WallClock(object):
+    code = WALL_CLOCK
+    key = None
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start = time.time()
+
+    def __call__(self, t, state):
+        return time.time() - self.start > self.seconds
+
+
+conditions = dict(
+    steady=(Steady, 2),
+    gl_crossing=(GLCrossing, 1),
+    max_thickness=(MaxThickness, 1),
+    wall_clock=(WallClock, 1),
+)
+
+
+def parse_condition(spec):
+    "A condition from NAME:VALUE[:VALUE]."
+    name, *values = spec.strip().split(":")
+    if name not in conditions:
+        raise ValueError("unknown stop condition '{}' (choose from {})".format(
+            name, ", ".join(conditions)))
+    cls, count = conditions[name]
+    if len(values) != count:
+        raise ValueError("stop condition '{}' takes {} value(s)".format(name, count))
+    condition = cls(*[float(v) for v in values])
+    condition.name = spec.strip()
+    return condition
+
+
+class StopCriterion(object):
+    """A stop expression: a list of alternatives, each a list of conditions that all have
+    to hold.
+
+    `keys` : the state keys the model provides; conditions on other keys are an error
+    """
+
+    def __init__(self, expression, keys=None):
+        self.alternatives = [[parse_condition(spec) for spec in term.split("&")]
+                             for term in expression.split("|")]
+        self.reason = "end time"
+        self.code = END_TIME
+        self.t = None
+
+        if keys is not None:
+            for term in self.alternatives:
+                for condition in term:
+                    if condition.key is not None and condition.key not in keys:
+                        raise ValueError("stop condition '{}' is not available in this "
+                                         "model".format(condition.name))
+
+    def __call__(self, t, state):
+        "Whether the run stops after reaching `state` at time t."
+        for term in self.alternatives:
+            # evaluate every condition, so that all of them see every step
+            held = [condition(t, state) for condition in term]
+            if all(held):
+                self.reason = " & ".join(condition.name for condition in term)
+                self.code = term[0].code
+                self.t = t
+                return True
+        return False
+
+    def write(self, filename, t):
+        "Write the reason the run ended (at time t) to a JSON file."
+        with open(filename, "w") as f:
+            json.dump(dict(reason=self.reason, code=self.code, t=t), f)
@@ -0,0 +1,125 @@
+"""Tridiagonal solver for the DG0 upwind water flux equation of the sediment model.
+
+In 1-D the upwind discretization of the water flux (R_Qw) couples each cell only to its
+upstream neighbour, except for the two cells on either side of an ice divide, where the
+averaged flow direction vanishes and the interior facet flux is central. In the order of
+the cell midpoints the system is therefore tridiagonal (bidiagonal away from divides) and
+needs no pivoting or fill-in. It is solved exactly, in O(N), by one call of the LAPACK
+tridiagonal solver, without assembling or factorizing a sparse matrix. This is about as
+fast as the back-substitution with the LU factors the model computes once (see
+`benchmark`), so it is an alternative to the LU solve, not a speed-up. A cell-by-cell
+Python sweep along the flow would be exact too, but is an order of magnitude slower.
+
+For a facet between a left cell a and a right cell b with averaged flow direction
+f = (flow_dir_a + flow_dir_b) / 2, the discrete flux in the +x direction is
+
+    F = Q_a (1 + f) / 2 - Q_b (1 - f) / 2,
+
+so every cell satisfies
+
+    coef_i Q_i = w_left_i Q_(i-1) + w_right_i Q_(i+1) + source_i
+"""
+
+import time
+
+import numpy as np
+from scipy.linalg.lapack import dgtsv
+
+
+class UpwindSweep(object):
+    "Upwind DG0 transport on a 1-D mesh, solved as a tridiagonal system in the cell order."
+
+    def __init__(self, x, flow_dir, outflow=(True, True)):
+        """`x` : cell midpoints (in degree of freedom order)
+        `flow_dir` : +1 or -1 per cell
+        `outflow` : whether the left and right boundaries carry an outflow term
+        """
+        self.perm = np.argsort(x)
+        fd = np.sign(np.asarray(flow_dir, dtype=float)[self.perm])
+        n = len(fd)
+
+        if np.any(np.logical_and(fd[:-1] > 0, fd[1:] < 0)):
+            raise ValueError("converging flow directions are not supported")
+
+        f = 0.5 * (fd[:-1] + fd[1:])
+
+        self.coef = np.zeros(n)
+        self.w_left = np.zeros(n)
+        self.w_right = np.zeros(n)
+
+        # facet between cells i (left) and i + 1 (right)
+        self.coef[:-1] += 0.5 * (1 + f)
+        self.w_right[:-1] = 0.5 * (1 - f)
+        self.coef[1:] += 0.5 * (1 - f)
+        self.w_left[1:] = 0.5 * (1 + f)
+
+        # boundary outflow
+        if outflow[0] and fd[0] < 0:
+            self.coef[0] += 1.0
+        if outflow[1] and fd[-1] > 0:
+            self.coef[-1] += 1.0
+
+        # sub- and super-diagonal of the operator, and the inverse of the cell ordering
+        self.lower = -self.w_left[1:]
+        self.upper = -self.w_right[:-1]
+        self.inverse = np.empty(n, dtype=int)
+        self.inverse[self.perm] = np.arange(n)
+
+    def matrix(self):
+        "The transport operator as a scipy sparse matrix (in sorted cell order)."
+        from scipy.sparse import diags
+
+        n = len(self.coef)
+        return diags([self.lower, self.coef, self.upper], [-1, 0, 1], shape=(n, n),
+                     format="csr")
+
+    def solve(self, source):
+        """Solve the transport equation exactly.
+
+        `source` : integrated source per cell (e.g. the assembled right hand side), in
+                   degree of freedom order
+        """
+        s = np.asarray(source, dtype=float)[self.perm]
+
+        # every argument is a fresh copy, so LAPACK may work in place
+        Q, info = dgtsv(self.lower.copy(), self.coef.copy(), self.upper.copy(), s, True, True,
+                        True, True)[3:]
+        if info != 0:
+            raise ValueError("singular transport operator (LAPACK info {})".format(info))
+        return Q[self.inverse]
+
+
+def benchmark(n=500, repeat=1000, symmetric=True):
+    """Compare `UpwindSweep.solve` with the back-substitution of the same water flux system
+    factorized once (as the model's LU solver does).
+
+    Returns (sweep time, LU solve time, max. relative difference) per solve.
+    """
+    from scipy.sparse.linalg import splu
+
+    x = np.linspace(-1, 1, n + 1)
+    x = 0.5 * (x[:-1] + x[1:])
+    flow_dir = np.where(x > 0, 1.0, -1.0) if symmetric else np.ones(n)
+    sweep = UpwindSweep(x, flow_dir, outflow=(symmetric, True))
+    source = np.random.rand(n)
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        Q = sweep.solve(source)
+    t_sweep = (time.perf_counter() - start) / repeat
+
+    lu = splu(sweep.matrix().tocsc())
+    start = time.perf_counter()
+    for i in range(repeat):
+        Q_ref = lu.solve(source[sweep.perm])[sweep.inverse]
+    t_lu = (time.perf_counter() - start) / repeat
+
+    return t_sweep, t_lu, np.max(np.fabs(Q - Q_ref)) / np.max(np.fabs(Q_ref))
+
+
+if __name__ == "__main__":
+    for symmetric in (False, True):
+        t_sweep, t_lu, error = benchmark(symmetric=symmetric)
+        print("{}: tridiagonal solve {:.2e} s, pre-factorized LU solve {:.2e} s, max. rel. "
+              "difference {:.1e}".format("symmetric" if symmetric else "one-sided", t_sweep,
+                                         t_lu, error))